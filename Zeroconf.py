@@ -80,18 +80,18 @@ __version__ = "0.12"
 
 import string
 import time
+import os
+import errno
+import math
+import bisect
+import heapq
 import struct
 import socket
 import threading
 import select
-import traceback
 
 __all__ = ["Zeroconf", "ServiceInfo", "ServiceBrowser"]
 
-# hook for threads
-
-globals()['_GLOBAL_DONE'] = 0
-
 # Some timing constants
 
 _UNREGISTER_TIME = 125
@@ -99,15 +99,23 @@ _CHECK_TIME = 175
 _REGISTER_TIME = 225
 _LISTENER_TIME = 200
 _BROWSER_TIME = 500
+_BROWSER_MAX_TIME = 60 * 60 * 1000 # steady state query interval (RFC 6762 5.2)
+_DUPLICATE_QUESTION_TIME = 1000
+_SENT_PACKETS = 16 # how many sent packets to remember to spot our own
+_MAX_READS = 64 # datagrams read from a socket per engine wake-up
+_RCVBUF_SIZE = 256 * 1024
+_REAPER_TIME = 10 * 1000
+_RESOLVER_TIME = 20 # how long to gather requests before querying
 
 # Some DNS constants
 	
 _MDNS_ADDR = '224.0.0.251'
+_MDNS_ADDR6 = 'ff02::fb'
 _MDNS_PORT = 5353;
 _DNS_PORT = 53;
 _DNS_TTL = 60 * 60; # one hour default TTL
 
-_MAX_MSG_TYPICAL = 1460 # unused
+_MAX_MSG_TYPICAL = 1460
 _MAX_MSG_ABSOLUTE = 8972
 
 _FLAGS_QR_MASK = 0x8000 # query response mask
@@ -152,6 +160,18 @@ _TYPE_AAAA = 28
 _TYPE_SRV = 33
 _TYPE_ANY =  255
 
+# Socket constants, not all of which every Python has
+
+_SIOCGIFCONF = 0x8912
+_IP_MULTICAST_ALL = 49
+_IPPROTO_IPV6 = getattr(socket, 'IPPROTO_IPV6', 41)
+_IPV6_V6ONLY = getattr(socket, 'IPV6_V6ONLY', 26)
+_IPV6_MULTICAST_IF = getattr(socket, 'IPV6_MULTICAST_IF', 17)
+_IPV6_MULTICAST_HOPS = getattr(socket, 'IPV6_MULTICAST_HOPS', 18)
+_IPV6_MULTICAST_LOOP = getattr(socket, 'IPV6_MULTICAST_LOOP', 19)
+_IPV6_JOIN_GROUP = getattr(socket, 'IPV6_JOIN_GROUP', 20)
+_IPV6_LEAVE_GROUP = getattr(socket, 'IPV6_LEAVE_GROUP', 21)
+
 # Mapping constants to names
 
 _CLASSES = { _CLASS_IN : "in",
@@ -184,11 +204,33 @@ _TYPES = { _TYPE_A : "a",
 # utility functions
 import logging
 logger = logging.getLogger('fusedaap')
+logger.addHandler(logging.NullHandler())
 
 def currentTimeMillis():
 	"""Current system time in milliseconds"""
 	return time.time() * 1000
 
+def _questionSize(question):
+	"""Returns the most bytes a question can take in a packet."""
+	return len(question.name) + 2 + 4
+
+def _recordSize(record):
+	"""Returns the most bytes a record can take in a packet, or 0 for
+	None."""
+	if record is None:
+		return 0
+	if record.type == _TYPE_SRV:
+		data = 6 + len(record.server) + 2
+	elif record.type == _TYPE_TXT:
+		data = len(record.text)
+	elif record.type == _TYPE_A or record.type == _TYPE_AAAA:
+		data = len(record.address)
+	elif record.type == _TYPE_PTR or record.type == _TYPE_CNAME:
+		data = len(record.alias) + 2
+	else:
+		data = _MAX_MSG_TYPICAL
+	return len(record.name) + 2 + 10 + data
+
 # Exceptions
 
 class NonLocalNameException(Exception):
@@ -206,6 +248,122 @@ class AbstractMethodException(Exception):
 class BadTypeInNameException(Exception):
 	pass
 
+# statistics
+
+class Histogram(object):
+	"""Counts values, e.g. latencies in milliseconds, in buckets that
+	grow by a fixed ratio, four to a doubling by default, which is enough
+	to estimate percentiles cheaply."""
+
+	def __init__(self, smallest=0.01, buckets=128, growth=2 ** 0.25):
+		self.bounds = [smallest * (growth ** i) for i in range(buckets)]
+		self.counts = [0] * (buckets + 1)
+		self.count = 0
+		self.total = 0.0
+		self.min = None
+		self.max = None
+
+	def add(self, value):
+		"""Records a value."""
+		self.counts[bisect.bisect_left(self.bounds, value)] += 1
+		self.count += 1
+		self.total += value
+		if self.min is None or value < self.min:
+			self.min = value
+		if self.max is None or value > self.max:
+			self.max = value
+
+	def percentile(self, percent):
+		"""Returns an estimate of the given percentile, interpolated
+		within the bucket holding it, or None if nothing has been
+		recorded."""
+		if not self.count:
+			return None
+		wanted = self.count * percent / 100.0
+		seen = 0
+		for i in range(len(self.counts)):
+			count = self.counts[i]
+			if count and seen + count >= wanted:
+				# bucket i holds values above bounds[i - 1], up to bounds[i]
+				low = self.min
+				if i > 0:
+					low = max(self.bounds[i - 1], low)
+				high = self.max
+				if i < len(self.bounds):
+					high = min(self.bounds[i], high)
+				return low + (high - low) * (wanted - seen) / count
+			seen += count
+		return self.max
+
+	def summary(self):
+		"""Returns a dictionary of count, mean, min, max and the 50th,
+		95th and 99th percentiles."""
+		result = {'count' : self.count, 'min' : self.min, 'max' : self.max,
+			'p50' : self.percentile(50), 'p95' : self.percentile(95),
+			'p99' : self.percentile(99), 'mean' : None}
+		if self.count:
+			result['mean'] = self.total / self.count
+		return result
+
+
+class Stats(object):
+	"""Named counters and histograms.  Updates are cheap enough to make
+	from the engine thread for every packet."""
+
+	def __init__(self):
+		self.counters = {}
+		self.histograms = {}
+		self.lock = threading.Lock()
+
+	def incr(self, name, count=1):
+		"""Adds count to the named counter."""
+		self.lock.acquire()
+		self.counters[name] = self.counters.get(name, 0) + count
+		self.lock.release()
+
+	def add(self, name, value):
+		"""Records a value in the named histogram."""
+		self.lock.acquire()
+		histogram = self.histograms.get(name)
+		if histogram is None:
+			histogram = self.histograms[name] = Histogram()
+		histogram.add(value)
+		self.lock.release()
+
+	def snapshot(self):
+		"""Returns a dictionary of the counters and of a summary of each
+		histogram."""
+		self.lock.acquire()
+		try:
+			result = dict(self.counters)
+			for name, histogram in self.histograms.items():
+				result[name] = histogram.summary()
+		finally:
+			self.lock.release()
+		return result
+
+
+def formatStats(stats):
+	"""Returns a dictionary of statistics as lines of text, one per
+	item, sorted by name."""
+	lines = []
+	names = stats.keys()
+	names.sort()
+	for name in names:
+		value = stats[name]
+		if isinstance(value, dict):
+			keys = value.keys()
+			keys.sort()
+			value = ' '.join(['%s=%s' % (k, _formatValue(value[k])) for k in keys])
+		lines.append('%s: %s' % (name, _formatValue(value)))
+	return '\n'.join(lines) + '\n'
+
+def _formatValue(value):
+	if isinstance(value, float):
+		return '%.3f' % value
+	return str(value)
+
+
 # implementation classes
 
 class DNSEntry(object):
@@ -341,6 +499,7 @@ class DNSAddress(DNSRecord):
 	def __init__(self, name, type, clazz, ttl, address):
 		DNSRecord.__init__(self, name, type, clazz, ttl)
 		self.address = address
+		self.scope = 0 # interface index an AAAA record arrived on
 
 	def write(self, out):
 		"""Used in constructing an outgoing packet"""
@@ -355,6 +514,8 @@ class DNSAddress(DNSRecord):
 	def __repr__(self):
 		"""String representation"""
 		try:
+			if self.type == _TYPE_AAAA:
+				return socket.inet_ntop(socket.AF_INET6, self.address)
 			return socket.inet_ntoa(self.address)
 		except:
 			return self.address
@@ -467,6 +628,7 @@ class DNSIncoming(object):
 		self.numAnswers = 0
 		self.numAuthorities = 0
 		self.numAdditionals = 0
+		self.errors = 0 # questions and records that could not be read
 		
 		self.readHeader()
 		self.readQuestions()
@@ -500,7 +662,7 @@ class DNSIncoming(object):
 				self.questions.append(question)
 			except:
 				logger.info("zconf readName error")
-				pass
+				self.errors += 1
 
 	def readInt(self):
 		"""Reads an integer from the packet"""
@@ -542,7 +704,7 @@ class DNSIncoming(object):
 				domain = self.readName()
 			except:
 				logger.info("bad readName error")
-				pass
+				self.errors += 1
 			info = struct.unpack(format, self.data[self.offset:self.offset+length])
 			self.offset += length
 
@@ -723,7 +885,7 @@ class DNSOutgoing(object):
 		# An index was found, so write a pointer to it
 		#
 		self.writeByte((index >> 8) | 0xC0)
-		self.writeByte(index)
+		self.writeByte(index & 0xFF)
 
 	def writeQuestion(self, question):
 		"""Writes a question to the packet"""
@@ -816,8 +978,19 @@ class DNSCache(object):
 	def getByDetails(self, name, type, clazz):
 		"""Gets an entry by details.  Will return None if there is
 		no matching entry."""
-		entry = DNSEntry(name, type, clazz)
-		return self.get(entry)
+		# Records compare on their data as well, so DNSCache.get() can
+		# never match a bare DNSEntry; compare the details directly.
+		for record in self.entriesWithName(string.lower(name)):
+			if record.type == type and record.clazz == clazz:
+				return record
+		return None
+
+	def __len__(self):
+		"""Returns the number of entries"""
+		total = 0
+		for list in self.cache.values():
+			total += len(list)
+		return total
 
 	def entriesWithName(self, name):
 		"""Returns a list of entries whose key matches the name."""
@@ -828,21 +1001,97 @@ class DNSCache(object):
 
 	def entries(self):
 		"""Returns a list of all entries"""
-		def add(x, y): return x+y
+		result = []
+		for list in self.cache.values():
+			result.extend(list)
+		return result
+
+
+class Timer(object):
+	"""A callback scheduled to run on the Engine thread at a given time.
+
+	Returned by Engine.callLater(); call cancel() to stop it from
+	running."""
+
+	def __init__(self, when, callback, args):
+		self.when = when
+		self.callback = callback
+		self.args = args
+		self.cancelled = 0
+
+	def cancel(self):
+		"""Stops the timer from running if it has not run yet."""
+		self.cancelled = 1
+
+
+class Poller(object):
+	"""Waits for file descriptors to become readable, using epoll or
+	poll where the platform has them and select otherwise.  File
+	descriptors stay registered until they are unregistered, so nothing
+	is rebuilt on each wait."""
+
+	def __init__(self):
+		self.fds = {}
+		if hasattr(select, 'epoll'):
+			self.epoll = select.epoll()
+			self.poll = None
+		elif hasattr(select, 'poll'):
+			self.epoll = None
+			self.poll = select.poll()
+		else:
+			self.epoll = None
+			self.poll = None
+
+	def register(self, fd):
+		self.fds[fd] = 1
+		if self.epoll is not None:
+			self.epoll.register(fd, select.EPOLLIN)
+		elif self.poll is not None:
+			self.poll.register(fd, select.POLLIN)
+
+	def unregister(self, fd):
+		del self.fds[fd]
+		if self.epoll is not None:
+			self.epoll.unregister(fd)
+		elif self.poll is not None:
+			self.poll.unregister(fd)
+
+	def wait(self, timeout):
+		"""Returns the file descriptors that are readable, waiting up to
+		timeout seconds, or forever if timeout is None."""
 		try:
-			return reduce(add, self.cache.values())
-		except:
-			return []
+			if self.epoll is not None:
+				if timeout is None:
+					timeout = -1
+				return [fd for fd, event in self.epoll.poll(timeout)]
+			if self.poll is not None:
+				if timeout is not None:
+					timeout = int(math.ceil(timeout * 1000))
+				return [fd for fd, event in self.poll.poll(timeout)]
+			return select.select(self.fds.keys(), [], [], timeout)[0]
+		except (select.error, IOError), e:
+			if e.args[0] == errno.EINTR:
+				return []
+			raise
+
+	def close(self):
+		if self.epoll is not None:
+			self.epoll.close()
 
 
 class Engine(threading.Thread):
-	"""An engine wraps read access to sockets, allowing objects that
-	need to receive data from sockets to be called back when the
-	sockets are ready.
+	"""An engine wraps read access to sockets and a queue of timers,
+	allowing objects that need to receive data from sockets, or to do
+	work at a later time, to be called back from a single thread.
 
 	A reader needs a handle_read() method, which is called when the socket
 	it is interested in is ready for reading.
 
+	Timers are added with callLater() and work is handed over from other
+	threads with callSoon().  Both write to a wake-up pipe so the loop
+	notices new work, and shutdown, immediately.  Once the loop has
+	finished they do nothing.
+
 	Writers are not implemented here, because we only send short
 	packets.
 	"""
@@ -851,31 +1100,130 @@ class Engine(threading.Thread):
 		threading.Thread.__init__(self)
 		self.zeroconf = zeroconf
 		self.readers = {} # maps socket to reader
-		self.timeout = 5
+		self.fds = {} # maps file descriptor to reader
+		self.timers = [] # heap of (when, sequence, Timer)
+		self.pending = [] # (callback, args) queued by callSoon
+		self.sequence = 0
+		self.done = 0
+		self.closed = 0 # set once the loop is finishing, under condition
 		self.condition = threading.Condition()
+		self.wakeRead, self.wakeWrite = os.pipe()
+		self.poller = Poller()
+		self.poller.register(self.wakeRead)
 		#self.setDaemon(True)#PMS
 		self.start()
 
 	def run(self):
-		while not globals()['_GLOBAL_DONE']:
-			rs = self.getReaders()
-			if len(rs) == 0:
-				# No sockets to manage, but we wait for the timeout
-				# or addition of a socket
-				#
-				self.condition.acquire()
-				self.condition.wait(self.timeout)
-				self.condition.release()
-			else:
-				try:
-					rr, wr, er = select.select(rs, [], [], self.timeout)
-					for socket in rr:
-						try:
-							self.readers[socket].handle_read()
-						except:
-							traceback.print_exc()
-				except:
-					pass
+		while not self.done:
+			timeout = self.runTimers()
+			if self.pending:
+				# queued by a callback on this thread, which does not wake
+				# the loop
+				timeout = 0
+			try:
+				ready = self.poller.wait(timeout)
+			except:
+				logger.exception("Engine could not poll")
+				ready = []
+			for fd in ready:
+				if fd == self.wakeRead:
+					os.read(self.wakeRead, 4096)
+					continue
+				reader = self.fds.get(fd)
+				if reader is not None:
+					try:
+						reader.handle_read()
+					except:
+						logger.exception("Engine reader failed")
+			self.runPending()
+		# no more work can be queued, nor the pipe written, after this
+		self.condition.acquire()
+		self.closed = 1
+		self.timers = []
+		self.condition.release()
+		self.runPending() # work queued as it was closed, e.g. by Zeroconf.close()
+		self.poller.close()
+		os.close(self.wakeRead)
+		os.close(self.wakeWrite)
+
+	def runTimers(self):
+		"""Runs any timers that are due and returns the number of seconds
+		until the next one, or None if there are none."""
+		now = currentTimeMillis()
+		due = []
+		self.condition.acquire()
+		while self.timers and self.timers[0][0] <= now:
+			due.append(heapq.heappop(self.timers)[2])
+		if self.timers:
+			timeout = (self.timers[0][0] - now) / 1000.0
+		else:
+			timeout = None
+		self.condition.release()
+		for timer in due:
+			if not timer.cancelled:
+				self.call(timer.callback, timer.args)
+		if due:
+			# timers may have queued more work
+			return 0
+		return timeout
+
+	def runPending(self):
+		"""Runs the callbacks queued with callSoon()."""
+		self.condition.acquire()
+		pending = self.pending
+		self.pending = []
+		self.condition.release()
+		for callback, args in pending:
+			self.call(callback, args)
+
+	def call(self, callback, args):
+		try:
+			callback(*args)
+		except:
+			logger.exception("Engine callback %r failed", callback)
+
+	def callLater(self, delay, callback, *args):
+		"""Calls callback(*args) on the engine thread after delay
+		milliseconds.  Returns a Timer that can be cancelled, and that
+		never runs if the engine is closed."""
+		timer = Timer(currentTimeMillis() + delay, callback, args)
+		self.condition.acquire()
+		if self.closed:
+			self.condition.release()
+			return timer
+		self.sequence += 1
+		heapq.heappush(self.timers, (timer.when, self.sequence, timer))
+		self.condition.release()
+		self.wakeup()
+		return timer
+
+	def callSoon(self, callback, *args):
+		"""Calls callback(*args) on the engine thread as soon as
+		possible.  Safe to call from any thread.  Does nothing if the
+		engine is closed."""
+		self.condition.acquire()
+		if self.closed:
+			self.condition.release()
+			return
+		self.pending.append((callback, args))
+		self.condition.release()
+		self.wakeup()
+
+	def isEngineThread(self):
+		"""Returns true if the calling thread is the engine thread."""
+		return threading.currentThread() is self
+
+	def wakeup(self):
+		"""Interrupts the select loop, unless it has finished and closed
+		the pipe, whose descriptor may since belong to another file."""
+		if not self.isEngineThread():
+			self.condition.acquire()
+			try:
+				if not self.closed:
+					os.write(self.wakeWrite, 'x')
+			except OSError:
+				pass
+			self.condition.release()
 
 	def getReaders(self):
 		result = []
@@ -887,37 +1235,94 @@ class Engine(threading.Thread):
 	def addReader(self, reader, socket):
 		self.condition.acquire()
 		self.readers[socket] = reader
-		self.condition.notify()
+		self.fds[socket.fileno()] = reader
+		self.poller.register(socket.fileno())
 		self.condition.release()
+		self.wakeup()
 
 	def delReader(self, socket):
 		self.condition.acquire()
 		del(self.readers[socket])
-		self.condition.notify()
+		del(self.fds[socket.fileno()])
+		self.poller.unregister(socket.fileno())
 		self.condition.release()
+		self.wakeup()
+
+	def getCounters(self):
+		"""Returns a dictionary mapping each reader's name to its
+		(packets, dropped) counters."""
+		result = {}
+		for reader in self.readers.values():
+			result[repr(reader)] = (getattr(reader, 'packets', 0),
+				getattr(reader, 'dropped', 0))
+		return result
 
 	def notify(self):
-		self.condition.acquire()
-		self.condition.notify()
-		self.condition.release()
+		self.wakeup()
+
+	def close(self, timeout=1.0):
+		"""Stops the loop and waits up to timeout seconds for the engine
+		thread to finish."""
+		self.done = 1
+		self.wakeup()
+		if not self.isEngineThread():
+			self.join(timeout)
 
 class Listener(object):
 	"""A Listener is used by this module to listen on the multicast
 	group to which DNS messages are sent, allowing the implementation
-	to cache information as it arrives.
+	to cache information as it arrives.  There is one Listener for
+	each Interface.
 
 	It requires registration with an Engine object in order to have
 	the read() method called when a socket is availble for reading."""
 	
-	def __init__(self, zeroconf):
+	def __init__(self, zeroconf, interface):
 		self.zeroconf = zeroconf
-		self.zeroconf.engine.addReader(self, self.zeroconf.socket)
+		self.interface = interface
+		self.buffer = bytearray(_MAX_MSG_ABSOLUTE + 1)
+		self.packets = 0 # datagrams received
+		self.dropped = 0 # datagrams too big, unparseable or unhandled
+		self.zeroconf.engine.addReader(self, self.interface.socket)
 
 	def handle_read(self):
-		data, (addr, port) = self.zeroconf.socket.recvfrom(_MAX_MSG_ABSOLUTE)
+		"""Reads and handles every datagram waiting on the socket, up to
+		_MAX_READS at a time so one busy interface can't starve the
+		rest of the engine."""
+		for i in range(_MAX_READS):
+			try:
+				length, address = self.interface.socket.recvfrom_into(self.buffer)
+			except socket.error, e:
+				if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return
+				raise
+			self.packets += 1
+			if length > _MAX_MSG_ABSOLUTE:
+				self.dropped += 1
+				continue
+			try:
+				self.handle(str(self.buffer[:length]), address)
+			except:
+				self.dropped += 1
+				logger.debug("Could not handle a packet from %s", address,
+					exc_info=True)
+
+	def handle(self, data, address):
+		"""Handles a single datagram."""
+		addr, port = address[:2]
 		self.data = data
-		msg = DNSIncoming(data)
+		stats = self.zeroconf.stats
+		try:
+			msg = DNSIncoming(data)
+		except:
+			stats.incr('parse.failures')
+			raise
+		if msg.errors:
+			stats.incr('parse.errors', msg.errors)
 		if msg.isQuery():
+			stats.incr('packets.in.query')
+			if not self.zeroconf.isOwnPacket(data):
+				self.zeroconf.handleForeignQuery(msg)
 			# Always multicast responses
 			#
 			if port == _MDNS_PORT:
@@ -929,54 +1334,68 @@ class Listener(object):
 				self.zeroconf.handleQuery(msg, addr, port)
 				self.zeroconf.handleQuery(msg, _MDNS_ADDR, _MDNS_PORT)
 		else:
+			stats.incr('packets.in.response')
+			for record in msg.answers:
+				if record.type == _TYPE_AAAA:
+					# link-local addresses are only usable with the
+					# interface they were seen on
+					record.scope = self.interface.index
 			self.zeroconf.handleResponse(msg)
 
+	def __repr__(self):
+		return repr(self.interface)
+
 
-class Reaper(threading.Thread):
+class Reaper(object):
 	"""A Reaper is used by this module to remove cache entries that
-	have expired."""
+	have expired.  It runs from a timer on the engine thread."""
 	
 	def __init__(self, zeroconf):
-		threading.Thread.__init__(self)
 		self.zeroconf = zeroconf
-		#self.setDaemon(True)#PMS
-		self.start()
+		self.timer = self.zeroconf.engine.callLater(_REAPER_TIME, self.run)
 
 	def run(self):
-		while 1:
-			self.zeroconf.wait(10 * 1000)
-			if globals()['_GLOBAL_DONE']:
-				return
-			now = currentTimeMillis()
-			for record in self.zeroconf.cache.entries():
-				if record.isExpired(now):
-					self.zeroconf.updateRecord(now, record)
-					self.zeroconf.cache.remove(record)
+		now = currentTimeMillis()
+		for record in self.zeroconf.cache.entries():
+			if record.isExpired(now):
+				self.zeroconf.updateRecord(now, record)
+				self.zeroconf.cache.remove(record)
+				self.zeroconf.stats.incr('cache.expired')
+		self.timer = self.zeroconf.engine.callLater(_REAPER_TIME, self.run)
 
 
-class ServiceBrowser(threading.Thread):
+class ServiceBrowser(object):
 	"""Used to browse for a service of a specific type.
 
 	The listener object will have its addService() and
 	removeService() methods called when this browser
-	discovers changes in the services availability."""
+	discovers changes in the services availability.
+
+	All of the browser's work happens on the engine thread; queries
+	are sent from engine timers and listener methods are called from
+	the engine thread, so they should not block."""
 	
 	def __init__(self, zeroconf, type, listener):
 		"""Creates a browser for a specific type"""
-		threading.Thread.__init__(self)
 		self.zeroconf = zeroconf
 		self.type = type
 		self.listener = listener
 		self.services = {}
 		self.nextTime = currentTimeMillis()
 		self.delay = _BROWSER_TIME
-		self.list = []
+		self.timer = None
+		self.foreignQueryTime = 0
 		
 		self.done = 0
 
+		self.zeroconf.engine.callSoon(self.start)
+
+	def start(self):
+		"""Starts browsing, called on the engine thread."""
+		if self.done:
+			return
 		self.zeroconf.addListener(self, DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN))
-		#self.setDaemon(True)#PMS
-		self.start()
+		self.schedule()
 
 	def updateRecord(self, zeroconf, now, record):
 		"""Callback invoked by Zeroconf when new information arrives.
@@ -984,54 +1403,82 @@ class ServiceBrowser(threading.Thread):
 		Updates information required by browser in the Zeroconf cache."""
 		if record.type == _TYPE_PTR and record.name == self.type:
 			expired = record.isExpired(now)
-			try:
-				oldrecord = self.services[record.alias.lower()]
+			key = record.alias.lower()
+			oldrecord = self.services.get(key)
+			if oldrecord is not None:
 				if not expired:
 					oldrecord.resetTTL(record)
 				else:
-					del(self.services[record.alias.lower()])
-					callback = lambda x: self.listener.removeService(x, self.type, record.alias)
-					self.list.append(callback)
+					del(self.services[key])
+					self.zeroconf.engine.callSoon(self.listener.removeService, self.zeroconf, self.type, record.alias)
 					return
-			except:
-				if not expired:
-					self.services[record.alias.lower()] = record
-					callback = lambda x: self.listener.addService(x, self.type, record.alias)
-					self.list.append(callback)
+			elif not expired:
+				self.services[key] = record
+				self.zeroconf.engine.callSoon(self.listener.addService, self.zeroconf, self.type, record.alias)
 
 			expires = record.getExpirationTime(75)
 			if expires < self.nextTime:
 				self.nextTime = expires
+				self.schedule()
+
+	def schedule(self):
+		"""(Re)starts the timer for the next query at self.nextTime."""
+		if self.timer is not None:
+			self.timer.cancel()
+		delay = max(0, self.nextTime - currentTimeMillis())
+		self.timer = self.zeroconf.engine.callLater(delay, self.run)
 
 	def cancel(self):
 		self.done = 1
-		self.zeroconf.notifyAll()
+		self.zeroconf.engine.callSoon(self.stop)
+
+	def stop(self):
+		"""Stops browsing, called on the engine thread."""
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+		self.zeroconf.removeListener(self)
+
+	def questionSeen(self, now):
+		"""Called when another host asks our question with known answers
+		that cover ours, which makes our next query redundant."""
+		self.foreignQueryTime = now
+
+	def knownAnswers(self, now):
+		"""Returns the PTR records to send as known answers: those with
+		at least half of their TTL left."""
+		return [record for record in self.services.values()
+			if not record.isStale(now)]
 
 	def run(self):
-		while 1:
-			event = None
-			now = currentTimeMillis()
-			if len(self.list) == 0 and self.nextTime > now:
-				self.zeroconf.wait(self.nextTime - now)
-			if globals()['_GLOBAL_DONE'] or self.done:
-				return
-			now = currentTimeMillis()
-
-			if self.nextTime <= now:
-				out = DNSOutgoing(_FLAGS_QR_QUERY)
-				out.addQuestion(DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN))
-				for record in self.services.values():
-					if not record.isExpired(now):
-						out.addAnswerAtTime(record, now)
-				self.zeroconf.send(out)
-				self.nextTime = now + self.delay
-				self.delay = min(20 * 1000, self.delay * 2)
-
-			if len(self.list) > 0:
-				event = self.list.pop(0)
-
-			if event is not None:
-				event(self.zeroconf)
+		"""Sends a query for the browsed type, called from an engine
+		timer.
+
+		The query carries known answers so responders don't repeat PTRs
+		we already have, and is skipped if another host just asked the
+		same question (RFC 6762 7.1 and 7.3).  The interval between
+		queries doubles up to _BROWSER_MAX_TIME."""
+		if self.done:
+			return
+		now = currentTimeMillis()
+		if now - self.foreignQueryTime > _DUPLICATE_QUESTION_TIME:
+			question = DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN)
+			out = DNSOutgoing(_FLAGS_QR_QUERY)
+			out.addQuestion(question)
+			size = 12 + _questionSize(question)
+			for record in self.knownAnswers(now):
+				if size + _recordSize(record) > _MAX_MSG_TYPICAL:
+					# the rest of the known answers follow in another packet
+					out.flags |= _FLAGS_TC
+					self.zeroconf.send(out)
+					out = DNSOutgoing(_FLAGS_QR_QUERY)
+					size = 12
+				out.addAnswerAtTime(record, now)
+				size += _recordSize(record)
+			self.zeroconf.send(out)
+		self.nextTime = now + self.delay
+		self.delay = min(_BROWSER_MAX_TIME, self.delay * 2)
+		self.timer = self.zeroconf.engine.callLater(self.nextTime - now, self.run)
 				
 
 class ServiceInfo(object):
@@ -1042,7 +1489,7 @@ class ServiceInfo(object):
 
 		type: fully qualified service type name
 		name: fully qualified service name
-		address: IP address as unsigned short, network byte order
+		address: IPv4 address as a packed string, network byte order
 		port: port that the service runs on
 		weight: weight of the service
 		priority: priority of the service
@@ -1062,6 +1509,13 @@ class ServiceInfo(object):
 		else:
 			self.server = name
 		self.setProperties(properties)
+		self.addresses = [] # (family, packed address, scope)
+		if address is not None:
+			self.addAddress(socket.AF_INET, address, 0)
+		self.expires = None # when the first SRV or address record expires
+		self.pending = None # (callback, timeout Timer) while requesting
+		self.nextTime = 0 # when the resolver should next query for us
+		self.delay = _LISTENER_TIME
 
 	def setProperties(self, properties):
 		"""Sets properties and text of this info from a dictionary"""
@@ -1123,7 +1577,7 @@ class ServiceInfo(object):
 
 			self.properties = result
 		except:
-			traceback.print_exc()
+			logger.exception("Could not decode the text of %s", self.name)
 			self.properties = None
 			
 	def getType(self):
@@ -1164,13 +1618,27 @@ class ServiceInfo(object):
 		"""Server accessor"""
 		return self.server
 
+	def getExpirationTime(self):
+		"""Returns the time in milliseconds at which the first of the
+		SRV and address records this service resolved from expires."""
+		return self.expires
+
 	def updateRecord(self, zeroconf, now, record):
 		"""Updates service information from a DNS record"""
 		if record is not None and not record.isExpired(now):
+			if record.type in (_TYPE_A, _TYPE_AAAA, _TYPE_SRV) and \
+					record.name in (self.name, self.server):
+				expires = record.getExpirationTime(100)
+				if self.expires is None or expires < self.expires:
+					self.expires = expires
 			if record.type == _TYPE_A:
 				#if record.name == self.name: PMS
 				if record.name == self.server:
 					self.address = record.address
+					self.addAddress(socket.AF_INET, record.address, 0)
+			elif record.type == _TYPE_AAAA:
+				if record.name == self.server:
+					self.addAddress(socket.AF_INET6, record.address, record.scope)
 			elif record.type == _TYPE_SRV:
 				if record.name == self.name:
 					self.server = record.server
@@ -1178,45 +1646,117 @@ class ServiceInfo(object):
 					self.weight = record.weight
 					self.priority = record.priority
 					#self.address = None PMS
+					if self.pending is not None:
+						zeroconf.addListener(self, DNSQuestion(self.server, _TYPE_A, _CLASS_IN))
+						zeroconf.addListener(self, DNSQuestion(self.server, _TYPE_AAAA, _CLASS_IN))
 					self.updateRecord(zeroconf, now, zeroconf.cache.getByDetails(self.server, _TYPE_A, _CLASS_IN))
+					self.updateRecord(zeroconf, now, zeroconf.cache.getByDetails(self.server, _TYPE_AAAA, _CLASS_IN))
 			elif record.type == _TYPE_TXT:
 				if record.name == self.name:
 					self.setText(record.text)
+			if self.pending is not None and self.isResolved():
+				# finish once the rest of the packet is in, so that both
+				# the A and AAAA records of a response are seen
+				zeroconf.engine.callSoon(self.finishRequest, zeroconf, 1)
+
+	def addAddress(self, family, address, scope):
+		"""Adds an IPv4 or IPv6 address of the service's server."""
+		if (family, address, scope) not in self.addresses:
+			self.addresses.append((family, address, scope))
+
+	def getAddresses(self):
+		"""Returns the addresses of the service's server as strings,
+		IPv4 and IPv6, with the interface index appended to link-local
+		IPv6 addresses (e.g. 'fe80::1%2')."""
+		result = []
+		for family, address, scope in self.addresses:
+			text = socket.inet_ntop(family, address)
+			if family == socket.AF_INET6 and text.startswith('fe80:') and scope:
+				text = '%s%%%d' % (text, scope)
+			result.append(text)
+		return result
+
+	def isResolved(self):
+		"""Returns true once server, an address and text are all known."""
+		return self.server is not None and self.addresses and self.text is not None
 
 	def request(self, zeroconf, timeout):
 		"""Returns true if the service could be discovered on the
 		network, and updates this object with details discovered.
+
+		This blocks the calling thread, so it must not be called from
+		the engine thread; use asyncRequest() there instead.
 		"""
-		now = currentTimeMillis()
-		delay = _LISTENER_TIME
-		next = now + delay
-		last = now + timeout
-		result = 0
-		try:
-			zeroconf.addListener(self, DNSQuestion(self.name, _TYPE_ANY, _CLASS_IN))
-			while self.server is None or self.address is None or self.text is None:
-				if last <= now:
-					return 0
-				if next <= now:
-					out = DNSOutgoing(_FLAGS_QR_QUERY)
-					out.addQuestion(DNSQuestion(self.name, _TYPE_SRV, _CLASS_IN))
-					out.addAnswerAtTime(zeroconf.cache.getByDetails(self.name, _TYPE_SRV, _CLASS_IN), now)
-					out.addQuestion(DNSQuestion(self.name, _TYPE_TXT, _CLASS_IN))
-					out.addAnswerAtTime(zeroconf.cache.getByDetails(self.name, _TYPE_TXT, _CLASS_IN), now)
-					if self.server is not None:
-						out.addQuestion(DNSQuestion(self.server, _TYPE_A, _CLASS_IN))
-						out.addAnswerAtTime(zeroconf.cache.getByDetails(self.server, _TYPE_A, _CLASS_IN), now)
-					zeroconf.send(out)
-					next = now + delay
-					delay = delay * 2
-
-				zeroconf.wait(min(next, last) - now)
-				now = currentTimeMillis()
-			result = 1
-		finally:
-			zeroconf.removeListener(self)
-			
-		return result
+		if zeroconf.engine.isEngineThread():
+			raise RuntimeError("ServiceInfo.request would block the engine thread")
+		event = threading.Event()
+		results = []
+		def done(info, result):
+			results.append(result)
+			event.set()
+		self.asyncRequest(zeroconf, timeout, done)
+		event.wait(timeout / 1000.0 + 1)
+		if results:
+			return results[0]
+		return 0
+
+	def asyncRequest(self, zeroconf, timeout, callback):
+		"""Starts discovering the service and returns immediately.
+
+		callback(info, result) is called on the engine thread with a
+		true result once the service resolves, or a false one if it has
+		not resolved after timeout milliseconds."""
+		zeroconf.engine.callSoon(self.startRequest, zeroconf, timeout, callback)
+
+	def startRequest(self, zeroconf, timeout, callback):
+		"""Begins a request, called on the engine thread."""
+		engine = zeroconf.engine
+		self.pending = (callback,
+			engine.callLater(timeout, self.finishRequest, zeroconf, 0))
+		self.delay = _LISTENER_TIME
+		self.requestTime = currentTimeMillis()
+		self.nextTime = self.requestTime + _RESOLVER_TIME
+		zeroconf.addListener(self, DNSQuestion(self.name, _TYPE_ANY, _CLASS_IN))
+		if self.pending is not None:
+			zeroconf.resolver.add(self)
+
+	def getQuestions(self, zeroconf, now):
+		"""Returns a list of (question, known answer) pairs for the
+		information that is still missing.  The known answer is None
+		unless the cache holds a record with at least half its TTL left."""
+		result = []
+		srv = zeroconf.cache.getByDetails(self.name, _TYPE_SRV, _CLASS_IN)
+		if srv is None or srv.isExpired(now):
+			result.append((self.name, _TYPE_SRV))
+		if self.text is None:
+			result.append((self.name, _TYPE_TXT))
+		if srv is not None and not self.addresses:
+			result.append((self.server, _TYPE_A))
+			result.append((self.server, _TYPE_AAAA))
+		questions = []
+		for name, type in result:
+			known = zeroconf.cache.getByDetails(name, type, _CLASS_IN)
+			if known is not None and known.isStale(now):
+				known = None
+			questions.append((DNSQuestion(name, type, _CLASS_IN), known))
+		return questions
+
+	def finishRequest(self, zeroconf, result):
+		"""Ends a request and calls its callback, on the engine thread."""
+		if self.pending is None:
+			return
+		callback, timeoutTimer = self.pending
+		self.pending = None
+		timeoutTimer.cancel()
+		zeroconf.resolver.remove(self)
+		zeroconf.removeListener(self)
+		if result:
+			elapsed = currentTimeMillis() - self.requestTime
+			zeroconf.stats.add('resolve.ms', elapsed)
+			zeroconf.resolveTimes[self.name] = elapsed
+		else:
+			zeroconf.stats.incr('resolve.timeouts')
+		callback(self, result)
 
 	def __eq__(self, other):
 		"""Tests equality of service name"""
@@ -1230,7 +1770,7 @@ class ServiceInfo(object):
 
 	def __repr__(self):
 		"""String representation"""
-		result = "service[%s,%s:%s," % (self.name, socket.inet_ntoa(self.getAddress()), self.port)
+		result = "service[%s,%s:%s," % (self.name, ','.join(self.getAddresses()), self.port)
 		if self.text is None:
 			result += "None"
 		else:
@@ -1242,24 +1782,101 @@ class ServiceInfo(object):
 		return result
 				
 
-class Zeroconf(object):
-	"""Implementation of Zeroconf Multicast DNS Service Discovery
+class Resolver(object):
+	"""Sends the queries for all ServiceInfo requests in flight.
 
-	Supports registration, unregistration, queries and browsing.
-	"""
-	def __init__(self, bindaddress=None):
-		"""Creates an instance of the Zeroconf class, establishing
-		multicast communications, listening and reaping threads."""
-		globals()['_GLOBAL_DONE'] = 0
-		if bindaddress is None:
-			self.intf = socket.gethostbyname(socket.gethostname())
-		else:
-			self.intf = bindaddress
-		self.group = ('', _MDNS_PORT)
-		self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	Rather than each request querying for itself, questions from every
+	pending request that is due are packed together, with their known
+	answers, into as few packets of up to _MAX_MSG_TYPICAL bytes as
+	possible.  Requests are held back for _RESOLVER_TIME first, so that
+	services announced with their SRV, TXT and A records in the
+	additional section of a PTR response resolve from the cache without
+	sending anything.  Runs on the engine thread."""
+
+	def __init__(self, zeroconf):
+		self.zeroconf = zeroconf
+		self.pending = [] # ServiceInfos being resolved
+		self.timer = None
+
+	def add(self, info):
+		"""Adds a ServiceInfo whose request has started."""
+		self.pending.append(info)
+		self.schedule()
+
+	def remove(self, info):
+		"""Removes a ServiceInfo whose request has finished."""
+		for i in range(len(self.pending)):
+			if self.pending[i] is info:
+				del self.pending[i]
+				break
+		if not self.pending and self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+
+	def schedule(self):
+		"""(Re)starts the timer for the earliest pending query."""
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+		if self.pending:
+			nextTime = min([info.nextTime for info in self.pending])
+			delay = max(0, nextTime - currentTimeMillis())
+			self.timer = self.zeroconf.engine.callLater(delay, self.run)
+
+	def run(self):
+		"""Queries for every request that is due."""
+		self.timer = None
+		now = currentTimeMillis()
+		out = None
+		size = 0
+		for info in self.pending:
+			# also take requests that are nearly due, rather than
+			# sending them on their own a moment later
+			if info.nextTime > now + _RESOLVER_TIME:
+				continue
+			questions = info.getQuestions(self.zeroconf, now)
+			needed = 0
+			for question, known in questions:
+				needed += _questionSize(question) + _recordSize(known)
+			if out is not None and size + needed > _MAX_MSG_TYPICAL:
+				self.zeroconf.send(out)
+				out = None
+			if out is None:
+				out = DNSOutgoing(_FLAGS_QR_QUERY)
+				size = 12
+			for question, known in questions:
+				out.addQuestion(question)
+				out.addAnswerAtTime(known, now)
+			size += needed
+			info.nextTime = now + info.delay
+			info.delay = info.delay * 2
+		if out is not None and out.questions:
+			self.zeroconf.send(out)
+		self.schedule()
+
+
+class Interface(object):
+	"""A network interface that mDNS traffic is sent and received on,
+	with its own multicast socket.
+
+	family is socket.AF_INET or socket.AF_INET6, address is the
+	interface's address in text form and index its interface index
+	(needed to join the IPv6 group and for link-local addresses)."""
+
+	def __init__(self, family, address, index=0, name=None):
+		self.family = family
+		self.address = address
+		self.index = index
+		self.name = name
+		self.socket = None
+
+	def open(self):
+		"""Creates the socket, bound to the mDNS port and joined to the
+		mDNS group on this interface only."""
+		s = socket.socket(self.family, socket.SOCK_DGRAM)
 		try:
-			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+			s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 		except:
 			# SO_REUSEADDR should be equivalent to SO_REUSEPORT for
 			# multicast UDP sockets (p 731, "TCP/IP Illustrated,
@@ -1271,30 +1888,237 @@ class Zeroconf(object):
 			# work as expected.
 			#
 			pass
-		self.socket.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_TTL, 255)
-		self.socket.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_LOOP, 1)
+		if self.family == socket.AF_INET6:
+			s.setsockopt(_IPPROTO_IPV6, _IPV6_V6ONLY, 1)
+			s.setsockopt(_IPPROTO_IPV6, _IPV6_MULTICAST_HOPS, 255)
+			s.setsockopt(_IPPROTO_IPV6, _IPV6_MULTICAST_LOOP, 1)
+		else:
+			s.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_TTL, 255)
+			s.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_LOOP, 1)
+			try:
+				# only deliver groups joined on this socket (Linux)
+				s.setsockopt(socket.SOL_IP, _IP_MULTICAST_ALL, 0)
+			except:
+				pass
+		try:
+			# room for bursts of responses while the engine is busy
+			s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _RCVBUF_SIZE)
+		except:
+			pass
+		s.setblocking(0)
 		try:
-			self.socket.bind(self.group)
+			s.bind(('', _MDNS_PORT))
 		except:
 			# Some versions of linux raise an exception even though
 			# the SO_REUSE* options have been set, so ignore it
 			#
 			pass
-		#self.socket.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.intf) + socket.inet_aton('0.0.0.0')) PMS
-		self.socket.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(_MDNS_ADDR) + socket.inet_aton('0.0.0.0'))
+		if self.family == socket.AF_INET6:
+			s.setsockopt(_IPPROTO_IPV6, _IPV6_MULTICAST_IF, self.index)
+			s.setsockopt(_IPPROTO_IPV6, _IPV6_JOIN_GROUP, self.membership())
+		else:
+			s.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.address))
+			s.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, self.membership())
+		self.socket = s
+		return s
+
+	def membership(self):
+		"""Returns the request structure for joining the mDNS group."""
+		if self.family == socket.AF_INET6:
+			return socket.inet_pton(socket.AF_INET6, _MDNS_ADDR6) + struct.pack('@I', self.index)
+		return socket.inet_aton(_MDNS_ADDR) + socket.inet_aton(self.address)
+
+	def group(self, port=_MDNS_PORT):
+		"""Returns the socket address of the mDNS group."""
+		if self.family == socket.AF_INET6:
+			return (_MDNS_ADDR6, port, 0, self.index)
+		return (_MDNS_ADDR, port)
 
-		self.listeners = []
+	def close(self):
+		"""Leaves the group and closes the socket."""
+		try:
+			if self.family == socket.AF_INET6:
+				self.socket.setsockopt(_IPPROTO_IPV6, _IPV6_LEAVE_GROUP, self.membership())
+			else:
+				self.socket.setsockopt(socket.SOL_IP, socket.IP_DROP_MEMBERSHIP, self.membership())
+		except:
+			pass
+		self.socket.close()
+
+	def kernelDrops(self):
+		"""Returns the number of datagrams the kernel dropped for this
+		socket because its receive buffer was full, from /proc/net/udp
+		(Linux), or None if that can't be read."""
+		if self.family == socket.AF_INET6:
+			path = '/proc/net/udp6'
+		else:
+			path = '/proc/net/udp'
+		try:
+			inode = str(os.fstat(self.socket.fileno()).st_ino)
+			for line in open(path).readlines()[1:]:
+				fields = line.split()
+				if fields[9] == inode:
+					return int(fields[-1])
+		except (IOError, OSError, IndexError, ValueError):
+			pass
+		return None
+
+	def __repr__(self):
+		return "interface[%s,%s]" % (self.name or self.index, self.address)
+
+
+def _getIPv4Interfaces():
+	"""Returns an Interface for each configured IPv4 address, using the
+	SIOCGIFCONF ioctl.  Returns an empty list where that is not
+	available."""
+	try:
+		import fcntl
+		import array
+	except ImportError:
+		return []
+	if struct.calcsize('P') == 8:
+		ifreqSize = 40
+	else:
+		ifreqSize = 32
+	maxBytes = 128 * ifreqSize
+	s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	try:
+		buf = array.array('B', '\0' * maxBytes)
+		try:
+			length = struct.unpack('iL', fcntl.ioctl(s.fileno(), _SIOCGIFCONF,
+				struct.pack('iL', maxBytes, buf.buffer_info()[0])))[0]
+		except IOError:
+			return []
+	finally:
+		s.close()
+	data = buf.tostring()
+	result = []
+	for i in range(0, length, ifreqSize):
+		name = data[i:i+16].split('\0', 1)[0]
+		address = socket.inet_ntoa(data[i+20:i+24])
+		result.append(Interface(socket.AF_INET, address, _getInterfaceIndex(name), name))
+	return result
+
+def _getIPv6Interfaces(path='/proc/net/if_inet6'):
+	"""Returns an Interface for the link-local IPv6 address of each
+	interface, read from /proc/net/if_inet6 (Linux)."""
+	try:
+		lines = open(path).readlines()
+	except IOError:
+		return []
+	return _parseIfInet6(lines)
+
+def _parseIfInet6(lines):
+	"""Parses the lines of /proc/net/if_inet6, returning an Interface for
+	the first link-local address of each interface."""
+	result = []
+	seen = {}
+	for line in lines:
+		fields = line.split()
+		if len(fields) < 6:
+			continue
+		addr, index, scope, name = fields[0], int(fields[1], 16), int(fields[3], 16), fields[5]
+		if scope != 0x20 or index in seen:
+			continue
+		seen[index] = 1
+		packed = ''.join([chr(int(addr[i:i+2], 16)) for i in range(0, 32, 2)])
+		result.append(Interface(socket.AF_INET6, socket.inet_ntop(socket.AF_INET6, packed), index, name))
+	return result
+
+def _getInterfaceIndex(name):
+	"""Returns the index of the named interface, or 0 if unknown."""
+	try:
+		return int(open('/sys/class/net/%s/ifindex' % name).read())
+	except (IOError, ValueError):
+		return 0
+
+def getInterfaces():
+	"""Returns the interfaces to use for mDNS: every IPv4 address and the
+	link-local IPv6 address of every interface, leaving out loopback
+	unless there is nothing else."""
+	interfaces = _getIPv4Interfaces()
+	if socket.has_ipv6:
+		interfaces += _getIPv6Interfaces()
+	result = [i for i in interfaces
+		if not i.address.startswith('127.') and i.name != 'lo']
+	if not result:
+		result = [i for i in interfaces if i.family == socket.AF_INET]
+	if not result:
+		result = [Interface(socket.AF_INET, socket.gethostbyname(socket.gethostname()))]
+	return result
+
+
+class Zeroconf(object):
+	"""Implementation of Zeroconf Multicast DNS Service Discovery
+
+	Supports registration, unregistration, queries and browsing.
+	"""
+	def __init__(self, bindaddress=None, interfaces=None):
+		"""Creates an instance of the Zeroconf class, establishing
+		multicast communications and starting the engine thread, which
+		does all listening, browsing and reaping.
+
+		interfaces is a list of Interface objects to use; it defaults to
+		every interface found by getInterfaces(), or only the IPv4
+		address bindaddress if that is given.  Interfaces that already
+		have a socket are used as they are.  Raises socket.error if none
+		of them can be listened on."""
+		if interfaces is None:
+			if bindaddress is None:
+				interfaces = getInterfaces()
+			else:
+				interfaces = [Interface(socket.AF_INET, bindaddress)]
+		self.interfaces = []
+		for interface in interfaces:
+			try:
+				if interface.socket is None:
+					interface.open()
+				self.interfaces.append(interface)
+			except socket.error, e:
+				logger.info("Could not listen on %s: %s" % (interface, e))
+		if not self.interfaces:
+			raise socket.error("Could not listen on any interface of %s" % \
+				(interfaces,))
+		self.intf = self.interfaces[0].address
+		self.socket = self.interfaces[0].socket
+
+		self.listeners = {} # (name, type) -> listeners, None -> all records
+		self.listenerKeys = {} # id(listener) -> keys it was added with
 		self.browsers = []
 		self.services = {}
 
 		self.cache = DNSCache()
 
 		self.condition = threading.Condition()
+		self.closed = 0
+		self.resolver = Resolver(self)
+		self.sentPackets = [] # recently sent packets, to spot our own
+		self.stats = Stats()
+		self.resolveTimes = {} # service name -> last resolution time in ms
 		
 		self.engine = Engine(self)
-		self.listener = Listener(self)
+		self.listener = [Listener(self, i) for i in self.interfaces]
 		self.reaper = Reaper(self)
 
+	def getStats(self):
+		"""Returns a dictionary of statistics: packet, cache and parse
+		counters, histograms of listener dispatch and service resolution
+		times in milliseconds, the current cache size, per socket packet
+		and drop counts, and the last resolution time of each service."""
+		result = self.stats.snapshot()
+		result['cache.size'] = len(self.cache)
+		result['listeners'] = len(self.listenerKeys)
+		for name, (packets, dropped) in self.engine.getCounters().items():
+			result['socket.packets %s' % name] = packets
+			result['socket.dropped %s' % name] = dropped
+		for interface in self.interfaces:
+			drops = interface.kernelDrops()
+			if drops is not None:
+				result['socket.kernel_drops %r' % interface] = drops
+		for name, elapsed in self.resolveTimes.items():
+			result['resolve.ms %s' % name] = elapsed
+		return result
+
 	def isLoopback(self):
 		return self.intf.startswith("127.0.0.1")
 
@@ -1332,10 +2156,10 @@ class Zeroconf(object):
 
 	def removeServiceListener(self, listener):
 		"""Removes a listener from the set that is currently listening."""
-		for browser in self.browsers:
+		for browser in self.browsers[:]:
 			if browser.listener == listener:
 				browser.cancel()
-				del(browser)
+				self.browsers.remove(browser)
 
 	def registerService(self, info, ttl=_DNS_TTL):
 		"""Registers service information to the network with a default TTL
@@ -1437,49 +2261,95 @@ class Zeroconf(object):
 	def addListener(self, listener, question):
 		"""Adds a listener for a given question.  The listener will have
 		its updateRecord method called when information is available to
-		answer the question."""
+		answer the question.
+
+		Listeners are only called for records matching the name and type
+		of a question they were added with (a question of type ANY
+		matches every type).  A listener added with a question of None
+		is called for every record.  A listener may be added with several
+		questions."""
 		now = currentTimeMillis()
-		self.listeners.append(listener)
+		if question is None:
+			key = None
+		else:
+			key = (question.key, question.type)
+		keys = self.listenerKeys.setdefault(id(listener), [])
+		if key in keys:
+			return
+		keys.append(key)
+		self.listeners.setdefault(key, []).append(listener)
 		if question is not None:
-			for record in self.cache.entriesWithName(question.name):
+			for record in self.cache.entriesWithName(question.key):
 				if question.answeredBy(record) and not record.isExpired(now):
 					listener.updateRecord(self, now, record)
-		self.notifyAll()
 
 	def removeListener(self, listener):
-		"""Removes a listener."""
-		try:
-			self.listeners.remove(listener)
-			self.notifyAll()
-		except:
-			pass
+		"""Removes a listener from all of the questions it was added with."""
+		for key in self.listenerKeys.pop(id(listener), []):
+			listeners = self.listeners.get(key)
+			if listeners is None:
+				continue
+			for i in range(len(listeners)):
+				if listeners[i] is listener:
+					del listeners[i]
+					break
+			if not listeners:
+				del self.listeners[key]
 
 	def updateRecord(self, now, rec):
 		"""Used to notify listeners of new information that has updated
-		a record."""
-		for listener in self.listeners:
+		a record.  Only listeners interested in the record's name and type
+		are called."""
+		listeners = self.listeners.get((rec.key, rec.type), []) + \
+			self.listeners.get((rec.key, _TYPE_ANY), []) + \
+			self.listeners.get(None, [])
+		start = time.time()
+		for listener in listeners:
 			listener.updateRecord(self, now, rec)
-		self.notifyAll()
+		self.stats.add('dispatch.ms', (time.time() - start) * 1000)
 
 	def handleResponse(self, msg):
 		"""Deal with incoming response packets.  All answers
 		are held in the cache, and listeners are notified."""
 		now = currentTimeMillis()
 		for record in msg.answers:
-			expired = record.isExpired(now)
-			if record in self.cache.entries():
-				if expired:
+			entry = self.cache.get(record)
+			if entry is not None:
+				if record.isExpired(now):
 					self.cache.remove(record)
+					self.stats.incr('cache.removes')
 				else:
-					entry = self.cache.get(record)
-					if entry is not None:
-						entry.resetTTL(record)
-						record = entry
+					entry.resetTTL(record)
+					record = entry
+					self.stats.incr('cache.refreshes')
 			else:
 				self.cache.add(record)
+				self.stats.incr('cache.adds')
 				
 			self.updateRecord(now, record)
 
+	def isOwnPacket(self, data):
+		"""Returns true if data is a packet we sent recently, looped
+		back to us by the multicast group."""
+		return data in self.sentPackets
+
+	def handleForeignQuery(self, msg):
+		"""Deal with a query sent by another host.  Browsers asking the
+		same question may skip their next query if the other host's
+		known answers include everything they know."""
+		now = currentTimeMillis()
+		for question in msg.questions:
+			if question.type != _TYPE_PTR:
+				continue
+			for browser in self.browsers:
+				if browser.type.lower() != question.key:
+					continue
+				for record in browser.knownAnswers(now):
+					if not record.suppressedBy(msg):
+						break
+				else:
+					browser.questionSeen(now)
+
 	def handleQuery(self, msg, addr, port):
 		"""Deal with incoming query packets.  Provides a response if
 		possible."""
@@ -1520,34 +2390,67 @@ class Zeroconf(object):
 					if question.type == _TYPE_SRV:
 						out.addAdditionalAnswer(DNSAddress(service.server, _TYPE_A, _CLASS_IN | _CLASS_UNIQUE, _DNS_TTL, service.address))
 				except:
-					traceback.print_exc()
+					logger.exception("Could not answer a query")
 				
 		if out is not None and out.answers:
 			out.id = msg.id
 			self.send(out, addr, port)
 
 	def send(self, out, addr = _MDNS_ADDR, port = _MDNS_PORT):
-		"""Sends an outgoing packet."""
+		"""Sends an outgoing packet.  Multicast packets go out on every
+		interface, unicast ones on the first interface of the right
+		address family."""
 		# This is a quick test to see if we can parse the packets we generate
 		#temp = DNSIncoming(out.packet())
-		try:
-			bytes_sent = self.socket.sendto(out.packet(), 0, (addr, port))
-		except:
-			logger.error("send packet problem")
-			# Ignore this, it may be a temporary loss of network connection
-			pass
+		packet = out.packet()
+		if out.flags & _FLAGS_QR_MASK == _FLAGS_QR_QUERY:
+			self.stats.incr('packets.out.query')
+		else:
+			self.stats.incr('packets.out.response')
+		self.stats.incr('bytes.out', len(packet))
+		self.sentPackets.append(packet)
+		del self.sentPackets[:-_SENT_PACKETS]
+		for interface in self.interfaces:
+			if addr == _MDNS_ADDR:
+				destination = interface.group(port)
+			elif (':' in addr) == (interface.family == socket.AF_INET6):
+				destination = (addr, port)
+			else:
+				continue
+			try:
+				bytes_sent = interface.socket.sendto(packet, 0, destination)
+			except:
+				logger.error("send packet problem on %s" % interface)
+				# Ignore this, it may be a temporary loss of network connection
+				pass
+			if addr != _MDNS_ADDR:
+				break
 
-	def close(self):
+	def close(self, timeout=1.0):
 		"""Ends the background threads, and prevent this instance from
-		servicing further queries."""
+		servicing further queries.  Waits up to timeout seconds for the
+		engine thread to finish.  The sockets are closed by the engine
+		thread, before it finishes, so that none is closed while it is
+		being polled.  Closing an instance again does nothing."""
 		logger.info("Closing in zeroconf.");
-		if globals()['_GLOBAL_DONE'] == 0:
-			globals()['_GLOBAL_DONE'] = 1
-			self.notifyAll()
-			self.engine.notify()
-			self.unregisterAllServices()
-			self.socket.setsockopt(socket.SOL_IP, socket.IP_DROP_MEMBERSHIP, socket.inet_aton(_MDNS_ADDR) + socket.inet_aton('0.0.0.0'))
-			self.socket.close()
+		self.condition.acquire()
+		closed = self.closed
+		self.closed = 1
+		self.condition.release()
+		if closed:
+			return
+		self.notifyAll()
+		self.unregisterAllServices()
+		self.engine.callSoon(self.closeInterfaces)
+		self.engine.close(timeout)
+
+	def closeInterfaces(self):
+		"""Stops reading from the interfaces and closes their sockets.
+		Called on the engine thread."""
+		for interface in self.interfaces:
+			if interface.socket in self.engine.readers:
+				self.engine.delReader(interface.socket)
+			interface.close()
 			
 # Test a few module features, including service registration, service
 # query (for Zoe), and service unregistration.
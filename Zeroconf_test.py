@@ -0,0 +1,550 @@
+#!/usr/bin/env python
+"""
+	Unit tests for the parts of Zeroconf.py that fusedaap relies on.
+	
+	Copyright 2006, Peter Sanford
+	
+	This file is part of fusedaap.
+
+    Fusedaap is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    Fusedaap is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fusedaap; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+
+
+import Zeroconf
+import threading
+import os
+import select
+import socket
+import time
+import unittest
+
+
+class LoopbackZeroconf(Zeroconf.Zeroconf):
+	"""A Zeroconf that keeps sent packets in a list instead of
+	opening a multicast socket."""
+	def __init__(self):
+		self.listeners = {}
+		self.listenerKeys = {}
+		self.browsers = []
+		self.services = {}
+		self.cache = Zeroconf.DNSCache()
+		self.condition = threading.Condition()
+		self.sent = []
+		self.sentPackets = []
+		self.stats = Zeroconf.Stats()
+		self.resolveTimes = {}
+		self.interfaces = []
+		self.resolver = Zeroconf.Resolver(self)
+		self.engine = Zeroconf.Engine(self)
+
+	def send(self, out, addr=Zeroconf._MDNS_ADDR, port=Zeroconf._MDNS_PORT):
+		self.sent.append(out)
+
+	def close(self):
+		self.engine.close()
+
+
+def callAndWait(engine, callback, *args):
+	"""Runs callback on the engine thread and waits for it to finish."""
+	done = threading.Event()
+	def run():
+		callback(*args)
+		done.set()
+	engine.callSoon(run)
+	done.wait(5)
+
+
+class Test_Histogram(unittest.TestCase):
+	def test_percentiles(self):
+		"""Histogram percentiles should be within 2% of the true value."""
+		histogram = Zeroconf.Histogram()
+		for i in range(1, 1001):
+			histogram.add(i / 10.0)
+		summary = histogram.summary()
+		self.assertEqual(1000, summary['count'])
+		self.assertEqual(0.1, summary['min'])
+		self.assertEqual(100.0, summary['max'])
+		self.assertAlmostEqual(50.0, summary['p50'], delta=1.0)
+		self.assertAlmostEqual(95.0, summary['p95'], delta=1.9)
+		self.assertAlmostEqual(99.0, summary['p99'], delta=2.0)
+		self.assertAlmostEqual(50.05, summary['mean'])
+
+	def test_smallSample(self):
+		"""Percentiles of 1..100 should be within 2% of the true value,
+		not the top of a bucket."""
+		histogram = Zeroconf.Histogram()
+		for i in range(1, 101):
+			histogram.add(i)
+		self.assertAlmostEqual(50, histogram.percentile(50), delta=1.0)
+		self.assertAlmostEqual(95, histogram.percentile(95), delta=1.9)
+		self.assertAlmostEqual(99, histogram.percentile(99), delta=2.0)
+		self.assertEqual(1, histogram.percentile(0))
+		self.assertEqual(100, histogram.percentile(100))
+
+	def test_skewed(self):
+		"""A percentile within one bucket should stay within that
+		bucket's range of the true value."""
+		histogram = Zeroconf.Histogram()
+		for i in range(99):
+			histogram.add(10.0)
+		histogram.add(1000.0)
+		self.assertTrue(abs(histogram.percentile(50) - 10.0) < 10.0 * 0.2)
+		self.assertEqual(1000.0, histogram.percentile(100))
+
+	def test_empty(self):
+		"""An empty Histogram should have no percentiles."""
+		self.assertEqual(None, Zeroconf.Histogram().percentile(50))
+
+
+class Test_Engine(unittest.TestCase):
+	def setUp(self):
+		self.zeroconf = LoopbackZeroconf()
+		self.engine = self.zeroconf.engine
+
+	def tearDown(self):
+		self.zeroconf.close()
+
+	def test_callLaterOrder(self):
+		"""Engine.callLater should run timers in order of their due time."""
+		calls = []
+		done = threading.Event()
+		self.engine.callLater(60, calls.append, 3)
+		self.engine.callLater(20, calls.append, 1)
+		self.engine.callLater(40, calls.append, 2)
+		self.engine.callLater(80, done.set)
+		done.wait(5)
+		self.assertEqual([1, 2, 3], calls)
+
+	def test_cancelledTimerDoesNotRun(self):
+		"""A cancelled Timer should never be called."""
+		calls = []
+		timer = self.engine.callLater(10, calls.append, 1)
+		timer.cancel()
+		time.sleep(0.05)
+		callAndWait(self.engine, lambda: None)
+		self.assertEqual([], calls)
+
+	def test_callSoonRunsOnEngineThread(self):
+		"""Engine.callSoon should run the callback on the engine thread."""
+		threads = []
+		callAndWait(self.engine,
+			lambda: threads.append(threading.currentThread()))
+		self.assertEqual([self.engine], threads)
+
+	def test_nestedCallSoon(self):
+		"""A callSoon made on the engine thread should run without waiting
+		for a timer or packet."""
+		self.engine.callLater(60 * 1000, lambda: None)
+		done = threading.Event()
+		start = []
+		def first():
+			start.append(time.time())
+			self.engine.callSoon(done.set)
+		self.engine.callSoon(first)
+		done.wait(5)
+		self.assertTrue(done.isSet())
+		self.assertTrue(time.time() - start[0] < 0.5)
+
+	def test_closeIsImmediate(self):
+		"""Engine.close should not wait for a select timeout."""
+		self.engine.callLater(60 * 1000, lambda: None)
+		start = time.time()
+		self.engine.close()
+		self.assertFalse(self.engine.isAlive())
+		self.assertTrue(time.time() - start < 0.5)
+
+	def test_closedEngineIgnoresCalls(self):
+		"""Once closed, the engine should neither queue work nor write to
+		its old wake-up pipe, whose descriptors may have been reused."""
+		self.engine.close()
+		read, write = os.pipe()
+		try:
+			calls = []
+			self.engine.callSoon(calls.append, 1)
+			timer = self.engine.callLater(0, calls.append, 2)
+			self.engine.wakeup()
+			self.assertEqual([], select.select([read], [], [], 0)[0])
+			self.assertEqual([], self.engine.pending)
+			self.assertEqual([], self.engine.timers)
+		finally:
+			os.close(read)
+			os.close(write)
+
+
+class Test_Zeroconf_close(unittest.TestCase):
+	def test_closeWhileBusy(self):
+		"""Zeroconf.close should leave the sockets to the engine thread if
+		it does not finish in time."""
+		interface = Zeroconf.Interface(socket.AF_INET, '127.0.0.1')
+		interface.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		interface.socket.bind(('127.0.0.1', 0))
+		interface.socket.setblocking(0)
+		zeroconf = Zeroconf.Zeroconf(interfaces=[interface])
+		release = threading.Event()
+		zeroconf.engine.callSoon(release.wait, 5)
+		zeroconf.close(0)
+		self.assertTrue(zeroconf.engine.isAlive())
+		interface.socket.getsockname() # still open
+		release.set()
+		zeroconf.engine.join(2)
+		self.assertFalse(zeroconf.engine.isAlive())
+		self.assertRaises(socket.error, interface.socket.getsockname)
+
+	def test_closeTwoInstances(self):
+		"""Zeroconf.close should stop each instance's engine, and closing
+		one again should do nothing."""
+		instances = []
+		for i in range(2):
+			interface = Zeroconf.Interface(socket.AF_INET, '127.0.0.1')
+			interface.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			interface.socket.bind(('127.0.0.1', 0))
+			interface.socket.setblocking(0)
+			instances.append(Zeroconf.Zeroconf(interfaces=[interface]))
+		for zeroconf in instances:
+			zeroconf.close()
+		for zeroconf in instances:
+			self.assertFalse(zeroconf.engine.isAlive())
+		instances[0].close()
+		self.assertFalse(instances[0].engine.isAlive())
+
+
+class Test_Zeroconf_noInterfaces(unittest.TestCase):
+	def test_noInterfaces(self):
+		"""Zeroconf should raise socket.error if it can't listen on any
+		interface."""
+		class BrokenInterface(Zeroconf.Interface):
+			def open(self):
+				raise socket.error("no")
+		self.assertRaises(socket.error, Zeroconf.Zeroconf, interfaces=[])
+		self.assertRaises(socket.error, Zeroconf.Zeroconf,
+			interfaces=[BrokenInterface(socket.AF_INET, '192.0.2.1')])
+
+
+class Test_Listener(unittest.TestCase):
+	def setUp(self):
+		self.zeroconf = LoopbackZeroconf()
+		self.interface = Zeroconf.Interface(socket.AF_INET, '127.0.0.1')
+		self.interface.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.interface.socket.bind(('127.0.0.1', 0))
+		self.interface.socket.setblocking(0)
+		self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+	def tearDown(self):
+		self.zeroconf.close()
+		self.interface.socket.close()
+		self.sender.close()
+
+	def test_drainsAllPackets(self):
+		"""Listener should handle every queued datagram and count the
+		ones it could not parse."""
+		count = 100
+		for i in range(count):
+			out = Zeroconf.DNSOutgoing(Zeroconf._FLAGS_QR_RESPONSE | Zeroconf._FLAGS_AA)
+			out.addAnswerAtTime(Zeroconf.DNSPointer("_daap._tcp.local.",
+				Zeroconf._TYPE_PTR, Zeroconf._CLASS_IN, 120,
+				"music %d._daap._tcp.local." % i), 0)
+			self.sender.sendto(out.packet(), self.interface.socket.getsockname())
+		self.sender.sendto('bad', self.interface.socket.getsockname())
+		listener = Zeroconf.Listener(self.zeroconf, self.interface)
+		for i in range(50):
+			if listener.packets == count + 1:
+				break
+			time.sleep(0.02)
+		self.assertEqual(count + 1, listener.packets)
+		self.assertEqual(1, listener.dropped)
+		self.assertEqual(count,
+			len(self.zeroconf.cache.entriesWithName("_daap._tcp.local.")))
+		self.assertEqual({repr(self.interface): (count + 1, 1)},
+			self.zeroconf.engine.getCounters())
+		stats = self.zeroconf.getStats()
+		self.assertEqual(count, stats['packets.in.response'])
+		self.assertEqual(1, stats['parse.failures'])
+		self.assertEqual(count, stats['cache.adds'])
+		self.assertEqual(count, stats['cache.size'])
+		self.assertEqual(count, stats['dispatch.ms']['count'])
+
+
+class Test_parseIfInet6(unittest.TestCase):
+	lines = ["fd000000000000000000000000000002 04 40 00 82     eth0\n",
+		"00000000000000000000000000000001 01 80 10 80       lo\n",
+		"fe8000000000000000fc00fffe000001 04 40 20 80     eth0\n",
+		"fe800000000000000000000000000002 04 40 20 80     eth0\n",
+		"fe800000000000000000000000000005 05 40 20 80     wlan0\n"]
+
+	def test_linkLocalPerInterface(self):
+		"""_parseIfInet6 should return the first link-local address of
+		each interface."""
+		result = Zeroconf._parseIfInet6(self.lines)
+		self.assertEqual([('fe80::fc:ff:fe00:1', 4, 'eth0'),
+			('fe80::5', 5, 'wlan0')],
+			[(i.address, i.index, i.name) for i in result])
+		for i in result:
+			self.assertEqual(socket.AF_INET6, i.family)
+
+
+class RecordingListener(object):
+	def __init__(self):
+		self.records = []
+
+	def updateRecord(self, zeroconf, now, record):
+		self.records.append(record)
+
+
+class Test_Zeroconf_listenerDispatch(unittest.TestCase):
+	def setUp(self):
+		self.zeroconf = LoopbackZeroconf()
+		self.now = Zeroconf.currentTimeMillis()
+		self.ptr = Zeroconf.DNSPointer("_daap._tcp.local.", Zeroconf._TYPE_PTR,
+			Zeroconf._CLASS_IN, 120, "music._daap._tcp.local.")
+		self.txt = Zeroconf.DNSText("music._daap._tcp.local.",
+			Zeroconf._TYPE_TXT, Zeroconf._CLASS_IN, 120, "")
+
+	def tearDown(self):
+		self.zeroconf.close()
+
+	def test_dispatchByNameAndType(self):
+		"""Zeroconf.updateRecord should only call listeners added for the
+		record's name and type, or for type ANY."""
+		ptrListener = RecordingListener()
+		anyListener = RecordingListener()
+		otherListener = RecordingListener()
+		self.zeroconf.addListener(ptrListener, Zeroconf.DNSQuestion(
+			"_daap._tcp.local.", Zeroconf._TYPE_PTR, Zeroconf._CLASS_IN))
+		self.zeroconf.addListener(anyListener, Zeroconf.DNSQuestion(
+			"Music._daap._tcp.local.", Zeroconf._TYPE_ANY, Zeroconf._CLASS_IN))
+		self.zeroconf.addListener(otherListener, Zeroconf.DNSQuestion(
+			"other._daap._tcp.local.", Zeroconf._TYPE_ANY, Zeroconf._CLASS_IN))
+		self.zeroconf.updateRecord(self.now, self.ptr)
+		self.zeroconf.updateRecord(self.now, self.txt)
+		self.assertEqual([self.ptr], ptrListener.records)
+		self.assertEqual([self.txt], anyListener.records)
+		self.assertEqual([], otherListener.records)
+
+	def test_listenerForAllRecords(self):
+		"""A listener added without a question should see every record."""
+		listener = RecordingListener()
+		self.zeroconf.addListener(listener, None)
+		self.zeroconf.updateRecord(self.now, self.ptr)
+		self.zeroconf.updateRecord(self.now, self.txt)
+		self.assertEqual([self.ptr, self.txt], listener.records)
+
+	def test_removeListener(self):
+		"""Zeroconf.removeListener should remove a listener from every
+		question it was added with."""
+		listener = RecordingListener()
+		self.zeroconf.addListener(listener, Zeroconf.DNSQuestion(
+			"_daap._tcp.local.", Zeroconf._TYPE_PTR, Zeroconf._CLASS_IN))
+		self.zeroconf.addListener(listener, Zeroconf.DNSQuestion(
+			"music._daap._tcp.local.", Zeroconf._TYPE_TXT, Zeroconf._CLASS_IN))
+		self.zeroconf.removeListener(listener)
+		self.zeroconf.updateRecord(self.now, self.ptr)
+		self.zeroconf.updateRecord(self.now, self.txt)
+		self.assertEqual([], listener.records)
+		self.assertEqual({}, self.zeroconf.listeners)
+
+
+class Test_Zeroconf_handleResponse(unittest.TestCase):
+	def setUp(self):
+		self.zeroconf = LoopbackZeroconf()
+
+	def tearDown(self):
+		self.zeroconf.close()
+
+	def response(self, ttl):
+		out = Zeroconf.DNSOutgoing(Zeroconf._FLAGS_QR_RESPONSE)
+		out.addAnswerAtTime(Zeroconf.DNSPointer("_daap._tcp.local.",
+			Zeroconf._TYPE_PTR, Zeroconf._CLASS_IN, ttl,
+			"music._daap._tcp.local."), 0)
+		return Zeroconf.DNSIncoming(out.packet())
+
+	def test_addRefreshRemove(self):
+		"""Announcements should be cached once and refreshed after that,
+		and a goodbye should remove the cached record."""
+		self.zeroconf.handleResponse(self.response(120))
+		self.zeroconf.handleResponse(self.response(120))
+		self.assertEqual(1, len(self.zeroconf.cache))
+		self.assertEqual(1, len(self.zeroconf.cache.entries()))
+		self.zeroconf.handleResponse(self.response(0))
+		self.assertEqual(0, len(self.zeroconf.cache))
+		stats = self.zeroconf.stats.snapshot()
+		self.assertEqual(1, stats['cache.adds'])
+		self.assertEqual(1, stats['cache.refreshes'])
+		self.assertEqual(1, stats['cache.removes'])
+
+
+class Test_ServiceBrowser(unittest.TestCase):
+	type = "_daap._tcp.local."
+
+	def setUp(self):
+		self.zeroconf = LoopbackZeroconf()
+		self.browser = Zeroconf.ServiceBrowser(self.zeroconf, self.type,
+			object())
+		self.zeroconf.browsers.append(self.browser)
+		callAndWait(self.zeroconf.engine, lambda: None)
+		del self.zeroconf.sent[:]
+		self.browser.timer.cancel()
+
+	def tearDown(self):
+		self.zeroconf.close()
+
+	def addService(self, name, ttl, age=0):
+		record = Zeroconf.DNSPointer(self.type, Zeroconf._TYPE_PTR,
+			Zeroconf._CLASS_IN, ttl, name)
+		record.created -= age * 1000
+		self.browser.services[name.lower()] = record
+		return record
+
+	def test_knownAnswers(self):
+		"""Browse queries should only carry PTRs with over half their TTL
+		left as known answers."""
+		fresh = self.addService("fresh." + self.type, 120, 30)
+		self.addService("stale." + self.type, 120, 90)
+		self.browser.run()
+		self.assertEqual(1, len(self.zeroconf.sent))
+		answers = [record for record, now in self.zeroconf.sent[0].answers]
+		self.assertEqual([fresh], answers)
+
+	def test_backoff(self):
+		"""The interval between browse queries should double up to
+		_BROWSER_MAX_TIME."""
+		delays = []
+		for i in range(30):
+			delays.append(self.browser.delay)
+			self.browser.run()
+			self.browser.timer.cancel()
+		self.assertEqual(2 * delays[0], delays[1])
+		self.assertEqual(Zeroconf._BROWSER_MAX_TIME, delays[-1])
+
+	def test_duplicateQuestionSuppression(self):
+		"""A browse query should be skipped if another host has just
+		asked the same question with our known answers."""
+		record = self.addService("music." + self.type, 120)
+		self.zeroconf.handleForeignQuery(self.foreignQuery([]))
+		self.browser.run()
+		self.browser.timer.cancel()
+		self.assertEqual(1, len(self.zeroconf.sent))
+		del self.zeroconf.sent[:]
+		self.zeroconf.handleForeignQuery(self.foreignQuery([record]))
+		self.browser.run()
+		self.assertEqual(0, len(self.zeroconf.sent))
+
+	def foreignQuery(self, knownAnswers):
+		out = Zeroconf.DNSOutgoing(Zeroconf._FLAGS_QR_QUERY)
+		out.addQuestion(Zeroconf.DNSQuestion(self.type, Zeroconf._TYPE_PTR,
+			Zeroconf._CLASS_IN))
+		for record in knownAnswers:
+			out.addAnswerAtTime(record, 0)
+		return Zeroconf.DNSIncoming(out.packet())
+
+
+class Test_ServiceInfo_asyncRequest(unittest.TestCase):
+	type = "_daap._tcp.local."
+	name = "music._daap._tcp.local."
+	server = "music.local."
+
+	def setUp(self):
+		self.zeroconf = LoopbackZeroconf()
+		self.results = []
+		self.done = threading.Event()
+
+	def tearDown(self):
+		self.zeroconf.close()
+
+	def resolved(self, info, result):
+		self.results.append(result)
+		self.done.set()
+
+	def addRecords(self):
+		cache = self.zeroconf.cache
+		cache.add(Zeroconf.DNSService(self.name, Zeroconf._TYPE_SRV,
+			Zeroconf._CLASS_IN, 120, 0, 0, 3689, self.server))
+		cache.add(Zeroconf.DNSText(self.name, Zeroconf._TYPE_TXT,
+			Zeroconf._CLASS_IN, 120, '\x05a=b c'))
+		cache.add(Zeroconf.DNSAddress(self.server, Zeroconf._TYPE_A,
+			Zeroconf._CLASS_IN, 120, socket.inet_aton('10.0.0.2')))
+
+	def test_resolvesFromCache(self):
+		"""ServiceInfo.asyncRequest should resolve from cached records
+		without sending a query."""
+		self.addRecords()
+		info = Zeroconf.ServiceInfo(self.type, self.name)
+		info.asyncRequest(self.zeroconf, 1000, self.resolved)
+		self.done.wait(5)
+		self.assertEqual([1], self.results)
+		self.assertEqual(socket.inet_aton('10.0.0.2'), info.address)
+		self.assertEqual(3689, info.port)
+		self.assertTrue(Zeroconf.currentTimeMillis() + 119 * 1000 <
+			info.getExpirationTime() <= Zeroconf.currentTimeMillis() + 120 * 1000)
+		self.assertEqual([], self.zeroconf.sent)
+		self.assertEqual({}, self.zeroconf.listeners)
+
+	def test_timeout(self):
+		"""ServiceInfo.asyncRequest should call back with a false result
+		after the timeout and stop listening."""
+		info = Zeroconf.ServiceInfo(self.type, self.name)
+		info.asyncRequest(self.zeroconf, 100, self.resolved)
+		self.done.wait(5)
+		self.assertEqual([0], self.results)
+		self.assertTrue(len(self.zeroconf.sent) > 0)
+		self.assertEqual({}, self.zeroconf.listeners)
+
+	def test_resolvesIPv6Addresses(self):
+		"""ServiceInfo should collect the server's A and AAAA addresses,
+		keeping the interface of link-local IPv6 addresses."""
+		self.addRecords()
+		aaaa = Zeroconf.DNSAddress(self.server, Zeroconf._TYPE_AAAA,
+			Zeroconf._CLASS_IN, 120, socket.inet_pton(socket.AF_INET6, 'fe80::1'))
+		aaaa.scope = 3
+		self.zeroconf.cache.add(aaaa)
+		info = Zeroconf.ServiceInfo(self.type, self.name)
+		info.asyncRequest(self.zeroconf, 1000, self.resolved)
+		self.done.wait(5)
+		self.assertEqual([1], self.results)
+		self.assertEqual(['10.0.0.2', 'fe80::1%3'], info.getAddresses())
+
+	def test_requestIsSynchronous(self):
+		"""ServiceInfo.request should block until the service resolves."""
+		self.addRecords()
+		info = Zeroconf.ServiceInfo(self.type, self.name)
+		self.assertTrue(info.request(self.zeroconf, 1000))
+		self.assertEqual(self.server, info.server)
+
+	def test_requestsAreBatched(self):
+		"""Questions for services resolving at the same time should be
+		sent together in packets no bigger than _MAX_MSG_TYPICAL."""
+		count = 40
+		done = threading.Event()
+		def resolved(info, result):
+			self.results.append(result)
+			if len(self.results) == count:
+				done.set()
+		for i in range(count):
+			info = Zeroconf.ServiceInfo(self.type,
+				"music number %d.%s" % (i, self.type))
+			info.asyncRequest(self.zeroconf, 150, resolved)
+		done.wait(5)
+		self.assertEqual([0] * count, self.results)
+		questions = 0
+		for out in self.zeroconf.sent:
+			self.assertTrue(len(out.packet()) <= Zeroconf._MAX_MSG_TYPICAL)
+			questions += len(out.questions)
+		# a packet per service each round without batching
+		self.assertTrue(questions >= 2 * count)
+		self.assertTrue(len(self.zeroconf.sent) < count / 2)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,689 @@
+#!/usr/bin/env python
+"""
+	Measures fusedaap end to end against a synthetic DAAP server.
+
+	DaapServer is a stand-in for an iTunes share: it answers the login,
+	database and track listing requests fusedaap makes and serves track
+	data with Range support, after an injectable latency and at an
+	injectable bandwidth.  The benchmark imports its library through
+	HostManager.addHost() and reads tracks through DaapFS.read(), and
+	reports import time, read throughput, requests per MB and read
+	latency percentiles.  With -M it instead measures the memory the
+	imported tracks take, with -g the rate of getattr calls on the
+	directory tree, and with -S the time from starting Python to the
+	first listing of the mount.
+
+	Copyright 2006, Peter Sanford
+
+	This file is part of fusedaap.
+
+    Fusedaap is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    Fusedaap is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fusedaap; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+
+import BaseHTTPServer
+import SocketServer
+import cStringIO
+import cgi
+import daap
+import gc
+import logging
+import optparse
+import os
+import re
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import thread
+import threading
+import time
+import urlparse
+import zlib
+
+import fusedaap
+import Zeroconf
+
+# DMAP content codes the server sends, with their types
+_CONTAINER, _BYTE, _SHORT, _INT, _LONG, _STRING, _VERSION = range(7)
+dmapTypes = {
+	'msrv': _CONTAINER, 'mccr': _CONTAINER, 'mlog': _CONTAINER,
+	'avdb': _CONTAINER, 'adbs': _CONTAINER, 'mlcl': _CONTAINER,
+	'mlit': _CONTAINER, 'mupd': _CONTAINER,
+	'mstt': _INT, 'mlid': _INT, 'miid': _INT, 'mimc': _INT, 'mtco': _INT,
+	'mrco': _INT, 'musr': _INT, 'assz': _INT, 'astm': _INT, 'mctc': _INT,
+	'muty': _BYTE, 'mikd': _BYTE,
+	'astn': _SHORT, 'asyr': _SHORT,
+	'mper': _LONG,
+	'minm': _STRING, 'asal': _STRING, 'asar': _STRING, 'asfm': _STRING,
+	'asgn': _STRING,
+	'apro': _VERSION, 'mpro': _VERSION,
+}
+
+# meta= field names and the codes they select
+metaCodes = {
+	'dmap.itemkind': 'mikd', 'dmap.itemid': 'miid',
+	'dmap.itemname': 'minm', 'dmap.persistentid': 'mper',
+	'daap.songalbum': 'asal', 'daap.songartist': 'asar',
+	'daap.songformat': 'asfm', 'daap.songtime': 'astm',
+	'daap.songsize': 'assz', 'daap.songgenre': 'asgn',
+	'daap.songyear': 'asyr', 'daap.songtracknumber': 'astn',
+}
+
+def dmapAtom(code, value):
+	"""Returns the DMAP encoding of an atom.  A container's value is a
+	list of (code, value) pairs."""
+	type = dmapTypes[code]
+	if type == _CONTAINER:
+		data = ''.join([dmapAtom(c, v) for c, v in value])
+	elif type == _BYTE:
+		data = struct.pack('!B', value)
+	elif type == _SHORT:
+		data = struct.pack('!H', value)
+	elif type == _INT:
+		data = struct.pack('!I', value)
+	elif type == _LONG:
+		data = struct.pack('!Q', value)
+	elif type == _VERSION:
+		data = struct.pack('!HH', value[0], value[1])
+	else:
+		if isinstance(value, unicode):
+			value = value.encode('utf-8')
+		data = value
+	return code + struct.pack('!I', len(data)) + data
+
+
+class Library(object):
+	"""A synthetic music library: tracks tracks of size bytes each, by a
+	few artists over several albums."""
+	patternSize = 4099 # not a power of two, so blocks don't repeat
+
+	def __init__(self, tracks=1000, size=4*1024*1024, artists=50, albums=4):
+		self.sizes = {}
+		self.items = []
+		for i in range(tracks):
+			id = i + 1
+			artist = i % artists
+			album = (i / artists) % albums
+			self.sizes[id] = size
+			self.items.append({
+				'mikd': 2, 'miid': id, 'mper': id,
+				'minm': u'Track %d' % id,
+				'asar': u'Artist %d' % artist,
+				'asal': u'Album %d-%d' % (artist, album),
+				'asfm': 'mp3', 'astm': 240000, 'assz': size,
+				'asgn': u'Genre %d' % (artist % 7), 'asyr': 2006,
+				'astn': i / (artists * albums) + 1,
+			})
+		self.patterns = {}
+
+	def data(self, id, offset, length):
+		"""Returns length bytes of track id starting at offset.  The data
+		depend on the id and offset, so misplaced bytes are detected."""
+		pattern = self.patterns.get(id)
+		if pattern is None:
+			pattern = ''.join([chr((id * 31 + i * 7) & 0xff)
+				for i in range(self.patternSize)])
+			pattern = self.patterns[id] = pattern * 2
+		chunks = []
+		while length > 0:
+			start = offset % self.patternSize
+			chunk = pattern[start:start + min(length, self.patternSize)]
+			chunks.append(chunk)
+			offset += len(chunk)
+			length -= len(chunk)
+		return ''.join(chunks)
+
+
+class DaapRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	itemPath = re.compile(r'^/databases/(\d+)/items/(\d+)\.\w+$')
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		server = self.server
+		url = urlparse.urlparse(self.path)
+		path = url[2]
+		query = cgi.parse_qs(url[4])
+		server.count('requests')
+		if server.latency:
+			time.sleep(server.latency)
+		match = self.itemPath.match(path)
+		if match is not None:
+			return self.sendTrack(int(match.group(2)))
+		if path == '/server-info':
+			body = dmapAtom('msrv', [('mstt', 200), ('mpro', (2, 0)),
+				('apro', (3, 0)), ('minm', 'bench')])
+		elif path == '/content-codes':
+			body = dmapAtom('mccr', [('mstt', 200)])
+		elif path == '/login':
+			body = dmapAtom('mlog', [('mstt', 200), ('mlid', server.newSession())])
+		elif path == '/update':
+			body = dmapAtom('mupd', [('mstt', 200), ('musr', 1)])
+		elif path == '/logout':
+			return self.sendBody('', 204)
+		elif path == '/databases':
+			body = dmapAtom('avdb', [('mstt', 200), ('muty', 0), ('mtco', 1),
+				('mrco', 1), ('mlcl', [('mlit', [('miid', 1), ('mper', 1),
+				('minm', 'bench library'),
+				('mimc', len(server.library.items))])])])
+		elif path == '/databases/1/items':
+			body = self.listItems(query.get('meta', [''])[0],
+				query.get('query', [''])[0])
+		else:
+			return self.sendBody('', 404)
+		encoding = None
+		if server.gzip and 'gzip' in (self.headers.getheader('Accept-encoding') or ''):
+			compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+			body = compressor.compress(body) + compressor.flush()
+			encoding = 'gzip'
+		server.count('listingBytes', len(body))
+		self.sendBody(body, 200, 'application/x-dmap-tagged', encoding)
+
+	def listItems(self, meta, query):
+		"""Returns the adbs listing with the fields meta asks for, of the
+		item a 'dmap.itemid:N' query asks for or of every item."""
+		codes = [metaCodes[m] for m in meta.split(',') if m in metaCodes]
+		if not codes:
+			codes = ['mikd', 'miid', 'minm']
+		items = self.server.library.items
+		match = re.match(r"^'dmap.itemid:(\d+)'$", query)
+		if match is not None:
+			items = [i for i in items if i['miid'] == int(match.group(1))]
+		listing = [('mlit', [(c, item[c]) for c in codes]) for item in items]
+		return dmapAtom('adbs', [('mstt', 200), ('muty', 0),
+			('mtco', len(items)), ('mrco', len(items)), ('mlcl', listing)])
+
+	def sendTrack(self, id):
+		library = self.server.library
+		size = library.sizes.get(id)
+		if size is None:
+			return self.sendBody('', 404)
+		start, end = 0, size - 1
+		status = 200
+		range = self.headers.getheader('Range')
+		if range and range.startswith('bytes='):
+			first, last = range[6:].split('-', 1)
+			start = int(first)
+			if last:
+				end = min(int(last), size - 1)
+			status = 206
+		self.server.count('trackRequests')
+		self.send_response(status)
+		self.send_header('Content-Type', 'audio/mp3')
+		self.send_header('Content-Length', str(end - start + 1))
+		if status == 206:
+			self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+		self.end_headers()
+		offset = start
+		chunkSize = 16384
+		while offset <= end:
+			length = min(chunkSize, end - offset + 1)
+			self.wfile.write(library.data(id, offset, length))
+			offset += length
+			self.server.count('bytes', length)
+			if self.server.bandwidth:
+				time.sleep(float(length) / self.server.bandwidth)
+
+	def sendBody(self, body, status, type='text/plain', encoding=None):
+		self.send_response(status)
+		self.send_header('Content-Type', type)
+		if encoding is not None:
+			self.send_header('Content-Encoding', encoding)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+class DaapServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	"""A synthetic DAAP server for benchmarks.
+
+	latency is added to every request, in seconds, and bandwidth limits
+	each track transfer, in bytes per second (0 for no limit).  Listings
+	are compressed for clients that accept it if gzip is true.
+	counters holds the number of requests, track requests, track bytes
+	and listing bytes sent.
+	"""
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, library, address=('127.0.0.1', 0), latency=0.0,
+		bandwidth=0, gzip=True):
+		BaseHTTPServer.HTTPServer.__init__(self, address, DaapRequestHandler)
+		self.library = library
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.gzip = gzip
+		self.counters = {'requests': 0, 'trackRequests': 0, 'bytes': 0,
+			'listingBytes': 0}
+		self.sessions = 0
+		self.lock = threading.Lock()
+		self.connections = {} # request socket -> handler thread
+
+	def process_request(self, request, client_address):
+		t = threading.Thread(target=self.process_request_thread,
+			args=(request, client_address))
+		t.setDaemon(True)
+		self.lock.acquire()
+		self.connections[request] = t
+		self.lock.release()
+		t.start()
+
+	def shutdown_request(self, request):
+		self.lock.acquire()
+		self.connections.pop(request, None)
+		self.lock.release()
+		BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+	def handle_error(self, request, client_address):
+		pass # clients hang up mid-transfer; that is not an error here
+
+	def count(self, name, n=1):
+		self.lock.acquire()
+		self.counters[name] += n
+		self.lock.release()
+
+	def newSession(self):
+		self.lock.acquire()
+		self.sessions += 1
+		session = self.sessions
+		self.lock.release()
+		return session
+
+	def start(self):
+		"""Serves requests from a daemon thread and returns the port."""
+		t = threading.Thread(target=self.serve_forever)
+		t.setDaemon(True)
+		t.start()
+		return self.server_address[1]
+
+	def close(self):
+		"""Stops serving and hangs up on clients still connected."""
+		self.shutdown()
+		self.server_close()
+		self.lock.acquire()
+		connections = self.connections.items()
+		self.lock.release()
+		for request, t in connections:
+			try:
+				request.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+			t.join(1.0)
+
+
+def songPaths(directory, path):
+	"""Returns the paths of the songs below a DirInode, in order."""
+	paths = []
+	names = directory.children.keys()
+	names.sort()
+	for name in names:
+		child = directory.children[name]
+		if isinstance(child, fusedaap.DirInode):
+			paths.extend(songPaths(child, "%s/%s" % (path, name)))
+		else:
+			paths.append("%s/%s" % (path, name))
+	return paths
+
+def readTrack(fs, path, size, blockSize, stats, name='read.ms', fh=None):
+	"""Reads a file through DaapFS.read() in blockSize reads the way the
+	kernel would, with the file handle fh from DaapFS.open() if given,
+	adding each read's latency in ms to stats under name.  Returns the
+	data."""
+	data = []
+	offset = 0
+	while offset < size:
+		start = time.time()
+		buf = fs.read(path, blockSize, offset, fh)
+		stats.add(name, (time.time() - start) * 1000)
+		if not buf:
+			break
+		data.append(buf)
+		offset += len(buf)
+	return ''.join(data)
+
+# the fields PythonDaap's DAAPDatabase.tracks() lists, which fusedaap
+# asked for before it listed trackMeta itself
+daapTrackMeta = "dmap.itemid,dmap.itemname,daap.songalbum,daap.songartist," \
+	"daap.songformat,daap.songtime,daap.songsize,daap.songgenre," \
+	"daap.songyear,daap.songtracknumber"
+
+def residentKB():
+	"""Returns the resident set size of this process in KB."""
+	pages = int(open('/proc/self/statm').read().split()[1])
+	return pages * resource.getpagesize() / 1024
+
+def keptKB(build):
+	"""Returns the memory in KB still in use after build() returns, and
+	held by its result.  Measured in a forked child, so that each
+	measurement starts from the same heap."""
+	read, write = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(read)
+		gc.collect()
+		before = residentKB()
+		kept = build()
+		gc.collect()
+		os.write(write, str(residentKB() - before))
+		os._exit(0)
+	os.close(write)
+	result = os.read(read, 64)
+	os.close(read)
+	os.waitpid(pid, 0)
+	return int(result)
+
+def listingBody(library, meta):
+	"""Returns the DMAP listing of the library with the fields in meta."""
+	codes = [metaCodes[m] for m in meta.split(',')]
+	return dmapAtom('adbs', [('mlcl', [('mlit', [(c, item[c]) for c in codes])
+		for item in library.items])])
+
+def trackMemory(library):
+	"""Prints the memory taken by the library's tracks as fusedaap kept
+	them before TrackTable, as daap.DAAPTracks over the DAAPObject tree
+	decoded from DAAPDatabase.tracks()'s listing, and now, as a
+	TrackTable decoded from fusedaap's listing with a Track per row (the
+	inodes keep one each)."""
+	daapBody = listingBody(library, daapTrackMeta)
+	body = listingBody(library, fusedaap.trackMeta)
+	def items():
+		for item in fusedaap._iterListing(cStringIO.StringIO(body)):
+			yield fusedaap._decodeItem(item)
+	def daapTracks():
+		response = daap.DAAPObject()
+		response.processData(cStringIO.StringIO(daapBody))
+		return [daap.DAAPTrack(None, atom)
+			for atom in response.getAtom('mlcl').contains]
+	def table():
+		table = fusedaap.TrackTable(None)
+		return table, [table.append(fields) for fields in items()]
+	tracks = len(library.items)
+	for name, build in (('daap tracks', daapTracks), ('track table', table)):
+		kb = keptKB(build)
+		print "%-15s %6d tracks in %7d KB, %4d bytes per track" % \
+			(name, tracks, kb, kb * 1024 / tracks)
+
+
+def nodePaths(directory, path):
+	"""Returns the paths of every inode below a DirInode."""
+	paths = []
+	for name, child in directory.children.items():
+		childPath = "%s/%s" % (path, name)
+		paths.append(childPath)
+		if isinstance(child, fusedaap.DirInode):
+			paths.extend(nodePaths(child, childPath))
+	return paths
+
+statFields = ('st_mode', 'st_ino', 'st_dev', 'st_nlink', 'st_uid', 'st_gid',
+	'st_size', 'st_atime', 'st_mtime', 'st_ctime')
+
+def getattrRate(library, profile=False, passes=3):
+	"""Builds the /hosts and /artists trees for the library's tracks,
+	without a server, and prints how fast DaapFS.getattr() answers for
+	every inode, profiled if profile is true, against building a
+	fuse.Stat per call.  Each field of the answer is read, as fuse does.
+	Then prints the memory the inodes' owner and times would take in
+	each inode, as before Inode.setDefaults()."""
+	fs = fusedaap.DaapFS()
+	if profile:
+		fusedaap.Profiler().instrument(fs, 'getattr')
+	hosts = fusedaap.HostDirHandler(fs.dirSup.requestDirLease("/hosts"))
+	artists = fusedaap.ArtistDirHandler(fs.dirSup.requestDirLease("/artists"))
+	codes = [metaCodes[m] for m in fusedaap.trackMeta.split(',')]
+	table = fusedaap.TrackTable(None)
+	tracks = [table.append(dict([(c, item[c]) for c in codes]))
+		for item in library.items]
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	start = time.time()
+	hosts.newHost('bench', tracks)
+	artists.newHost('bench', tracks)
+	buildTime = time.time() - start
+	paths = nodePaths(fs.dirSup.fetchInode('/'), '')
+	print "tree            %6d inodes in %7.3fs, peak rss +%d KB" % \
+		(len(paths), buildTime,
+		resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss)
+	def timeCalls(name, call):
+		start = time.time()
+		for i in range(passes):
+			for path in paths:
+				result = call(path)
+				for field in statFields:
+					getattr(result, field)
+		elapsed = time.time() - start
+		print "%-15s %6d calls in %7.3fs: %8.0f calls/s" % (name,
+			len(paths) * passes, elapsed, len(paths) * passes / elapsed)
+	def statPerCall(path):
+		node = fs.dirSup.fetchInode(path)
+		return fusedaap.fuse.Stat(**dict([(field, getattr(node, field))
+			for field in statFields]))
+	timeCalls('getattr', fs.getattr)
+	timeCalls('Stat per call', statPerCall)
+	# before Inode.setDefaults(), each inode held every field in its own
+	# dict
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	for path in paths:
+		node = fs.dirSup.fetchInode(path)
+		node.__dict__.update(dict([(field, getattr(node, field))
+			for field in statFields]))
+	print "fields per inode         +%d KB, as before" % \
+		(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss)
+
+
+startupScript = """
+import time
+start = time.time()
+import fusedaap
+fs = fusedaap.DaapFS()
+fs.setup()
+fs.fsinit() # as fuse does once mounted
+fs.readdir('/', 0).next()
+print time.time() - start
+import sys
+sys.stdout.flush()
+fs.shutdown()
+"""
+
+def startupTime(runs=5):
+	"""Prints the time from starting a Python process to its first
+	readdir of the mount's root, going through the same setup as
+	fusedaap.main() and fsinit(), the best of runs."""
+	best = bestInside = None
+	for i in range(runs):
+		start = time.time()
+		child = subprocess.Popen([sys.executable, '-c', startupScript],
+			stdout=subprocess.PIPE)
+		inside = float(child.stdout.readline())
+		elapsed = time.time() - start
+		child.communicate()
+		if best is None or elapsed < best:
+			best, bestInside = elapsed, inside
+	print "first readdir   %7.1f ms after starting Python, %.1f ms in fusedaap" % \
+		(best * 1000, bestInside * 1000)
+
+
+def main():
+	parser = optparse.OptionParser(usage="%prog [options]")
+	parser.add_option("-t", "--tracks", type="int", default=2000,
+		help="tracks in the library (default 2000)")
+	parser.add_option("-s", "--size", type="int", default=4096,
+		help="track size in KB (default 4096)")
+	parser.add_option("-r", "--reads", type="int", default=4,
+		help="tracks to read (default 4)")
+	parser.add_option("-p", "--players", type="int", default=1,
+		help="concurrent readers of each track (default 1)")
+	parser.add_option("-b", "--block", type="int", default=128,
+		help="read size in KB (default 128)")
+	parser.add_option("-l", "--latency", type="float", default=0.0,
+		help="server latency per request in ms (default 0)")
+	parser.add_option("-w", "--bandwidth", type="float", default=0.0,
+		help="server bandwidth per transfer in MB/s (default unlimited)")
+	parser.add_option("-a", "--readahead", type="int", default=512,
+		help="readahead in KB (default 512)")
+	parser.add_option("-n", "--segments", type="int", default=1,
+		help="parallel segments per fetch (default 1)")
+	parser.add_option("-c", "--connections", type="int", default=4,
+		help="connections per host (default 4)")
+	parser.add_option("-m", "--limit", type="int", default=0,
+		help="client bandwidth limit per host in KB/s (default none)")
+	parser.add_option("-z", "--nogzip", action="store_true", default=False,
+		help="don't compress listings")
+	parser.add_option("-k", "--bulk", type="int", default=0,
+		help="tracks to copy in bulk while reading (default 0)")
+	parser.add_option("-M", "--memory", action="store_true", default=False,
+		help="only measure the memory the tracks take")
+	parser.add_option("-g", "--getattr", action="store_true", default=False,
+		help="only measure getattr calls on the directory tree")
+	parser.add_option("-P", "--profile", action="store_true", default=False,
+		help="profile the filesystem operations, as -o profile does")
+	parser.add_option("-S", "--startup", action="store_true", default=False,
+		help="only measure the time to the first readdir of the mount")
+	parser.add_option("-L", "--log", metavar="PATH",
+		help="log to PATH, as -d does to fd.log")
+	parser.add_option("-E", "--eventlog", metavar="PATH",
+		help="log events to PATH, as -o eventlog does")
+	options, args = parser.parse_args()
+
+	if options.log:
+		handler = logging.FileHandler(options.log)
+		handler.setFormatter(logging.Formatter(
+			'%(asctime)s %(levelname)s %(message)s'))
+		fusedaap.logger.addHandler(handler)
+		fusedaap.logger.setLevel(logging.DEBUG)
+	if options.eventlog:
+		fusedaap.enableEventLog(options.eventlog)
+
+	if options.startup:
+		startupTime()
+		return
+	library = Library(options.tracks, options.size * 1024)
+	if options.memory:
+		trackMemory(library)
+		return
+	if options.getattr:
+		getattrRate(library, options.profile)
+		return
+	server = DaapServer(library, latency=options.latency / 1000.0,
+		bandwidth=int(options.bandwidth * 1024 * 1024),
+		gzip=not options.nogzip)
+	port = server.start()
+
+	fs = fusedaap.DaapFS()
+	fs.fetcher.readahead = options.readahead * 1024
+	fs.fetcher.segments = options.segments
+	# a process per thread, as far as DaapFS.open() can tell
+	fs.GetContext = lambda: {'pid': thread.get_ident()}
+	hostMan = fusedaap.HostManager(maxConnections=options.connections,
+		bandwidth=options.limit * 1024, stats=fs.fetcher.stats)
+	hostMan.addHandler(fusedaap.HostDirHandler(fs.dirSup.requestDirLease("/hosts")))
+	if options.profile:
+		profiler = fusedaap.Profiler(fs.fetcher.stats)
+		for method in ('getattr', 'readdir', 'open', 'read'):
+			profiler.instrument(fs, method)
+		profiler.instrument(hostMan, 'addHost')
+		hostMan.profiler = profiler
+	firstTrack = []
+	class FirstTrack(object):
+		def newHost(self, host, songs):
+			firstTrack.append(time.time())
+		def addSongs(self, host, songs):
+			pass
+		def hostListed(self, host):
+			pass
+		def delHost(self, host):
+			pass
+	hostMan.addHandler(FirstTrack())
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	start = time.time()
+	if not hostMan.addHost("bench.%s" % fusedaap.daapZConfType,
+		['127.0.0.1'], port):
+		print "Could not import the library from the benchmark server"
+		sys.exit(1)
+	importTime = time.time() - start
+	print "library import  %6d tracks in %7.3fs, first after %.3fs, peak rss +%d KB" % \
+		(len(library.items), importTime, firstTrack[0] - start,
+		resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss)
+	print "listing         %6d KB sent" % (server.counters['listingBytes'] / 1024)
+	interned = fusedaap.nameTable.stats.snapshot()
+	print "names           %6d interned, %d KB saved, %d cleaned, %d reused" % \
+		(interned.get('intern.strings', 0),
+		interned.get('intern.bytesSaved', 0) / 1024,
+		interned.get('intern.cleaned', 0), interned.get('intern.cleanHits', 0))
+	paths = songPaths(fs.dirSup.fetchInode("/hosts"), "/hosts")
+	directories = [p for p in nodePaths(fs.dirSup.fetchInode("/"), "")
+		if isinstance(fs.dirSup.fetchInode(p), fusedaap.DirInode)]
+	start = time.time()
+	entries = 0
+	for path in directories:
+		entries += len(list(fs.readdir(path, 0)))
+	print "readdir         %6d directories, %d entries in %7.3fs" % \
+		(len(directories), entries, time.time() - start)
+
+	stats = Zeroconf.Stats()
+	server.counters['trackRequests'] = server.counters['bytes'] = 0
+	readBytes = []
+	def play(path, inode):
+		data = readTrack(fs, path, inode.st_size, options.block * 1024, stats)
+		if data != library.data(inode.song.id, 0, inode.st_size):
+			print "wrong data read from %s" % path
+		readBytes.append(len(data))
+	copying = []
+	def copy(paths):
+		for path in paths:
+			inode = fs.dirSup.fetchInode(path)
+			fh = fs.open(path, os.O_RDONLY)
+			readTrack(fs, path, inode.st_size, options.block * 1024, stats,
+				'bulk.ms', fh)
+			fs.release(path, os.O_RDONLY, fh)
+	if options.bulk:
+		copying.append(threading.Thread(target=copy,
+			args=(paths[-options.bulk:],)))
+		copying[0].start()
+	start = time.time()
+	for i in range(min(options.reads, len(paths))):
+		path = paths[i * len(paths) / options.reads]
+		inode = fs.dirSup.fetchInode(path)
+		players = [threading.Thread(target=play, args=(path, inode))
+			for p in range(options.players)]
+		for t in players:
+			t.start()
+		for t in players:
+			t.join()
+	readBytes = sum(readBytes)
+	readTime = time.time() - start
+	if copying:
+		copying.pop().join()
+	megabytes = readBytes / 1048576.0
+	if readTime and megabytes:
+		print "read            %6.1f MB in %7.3fs: %7.2f MB/s, %.1f requests/MB" % \
+			(megabytes, readTime, megabytes / readTime,
+			server.counters['trackRequests'] / megabytes)
+	for name, label in (('read.ms', 'read latency'), ('bulk.ms', 'bulk latency')):
+		summary = stats.snapshot().get(name)
+		if summary:
+			print "%-15s p50 %.2f ms p95 %.2f ms p99 %.2f ms max %.2f ms" % \
+				(label, summary['p50'], summary['p95'], summary['p99'],
+				summary['max'])
+	print
+	sys.stdout.write(Zeroconf.formatStats(fs.fetcher.stats.snapshot()))
+	hostMan.closeAllConnections()
+	server.close()
+
+
+if __name__ == '__main__':
+	main()
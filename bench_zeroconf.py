@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""
+	Replays mDNS traffic into Zeroconf to measure the discovery hot path:
+	Listener.handle_read, DNSIncoming and Zeroconf.handleResponse.
+
+	Traffic is either synthetic (announcements of services of several
+	types, TTL refreshes and goodbyes) or read from a pcap capture of
+	UDP port 5353.  Packets are fed through an in-memory socket that
+	the Zeroconf engine reads like a real one, so no network is used.
+
+	Copyright 2006, Peter Sanford
+	
+	This file is part of fusedaap.
+
+    Fusedaap is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    Fusedaap is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fusedaap; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+
+import Zeroconf
+import errno
+import optparse
+import os
+import resource
+import socket
+import struct
+import sys
+import threading
+import time
+
+serviceTypes = ["_daap._tcp.local.", "_http._tcp.local.", "_ipp._tcp.local.",
+	"_ssh._tcp.local.", "_raop._tcp.local.", "_workstation._tcp.local."]
+
+
+class MemorySocket(object):
+	"""Stands in for a multicast socket.  Packets given to feed() are
+	returned by recvfrom_into(); a pipe makes the socket look readable
+	to the engine while packets are queued."""
+	def __init__(self):
+		self.packets = []
+		self.lock = threading.Lock()
+		self.empty = threading.Event()
+		self.readFd, self.writeFd = os.pipe()
+		self.sent = 0
+
+	def feed(self, packets):
+		self.lock.acquire()
+		self.packets.extend(packets)
+		self.empty.clear()
+		self.lock.release()
+		os.write(self.writeFd, 'x')
+
+	def recvfrom_into(self, buffer):
+		self.lock.acquire()
+		try:
+			if not self.packets:
+				os.read(self.readFd, 4096)
+				self.empty.set()
+				raise socket.error(errno.EAGAIN, "no packets queued")
+			data = self.packets.pop(0)
+		finally:
+			self.lock.release()
+		buffer[:len(data)] = data
+		return len(data), ('192.0.2.1', Zeroconf._MDNS_PORT)
+
+	def sendto(self, data, flags, address):
+		self.sent += 1
+		return len(data)
+
+	def fileno(self):
+		return self.readFd
+
+	def setsockopt(self, *args):
+		pass
+
+	def close(self):
+		os.close(self.readFd)
+		os.close(self.writeFd)
+
+
+class CountingListener(object):
+	"""A ServiceBrowser listener that counts its callbacks."""
+	def __init__(self):
+		self.added = 0
+		self.removed = 0
+
+	def addService(self, zeroconf, type, name):
+		self.added += 1
+
+	def removeService(self, zeroconf, type, name):
+		self.removed += 1
+
+
+def announcement(type, index, ttl, host):
+	"""Returns the packet a responder sends to announce a service, with
+	SRV, TXT and A records as additionals."""
+	name = "share %d.%s" % (index, type)
+	server = "host%d.local." % host
+	out = Zeroconf.DNSOutgoing(Zeroconf._FLAGS_QR_RESPONSE | Zeroconf._FLAGS_AA)
+	out.addAnswerAtTime(Zeroconf.DNSPointer(type, Zeroconf._TYPE_PTR,
+		Zeroconf._CLASS_IN, ttl, name), 0)
+	out.addAdditionalAnswer(Zeroconf.DNSService(name, Zeroconf._TYPE_SRV,
+		Zeroconf._CLASS_IN | Zeroconf._CLASS_UNIQUE, ttl, 0, 0, 3689, server))
+	out.addAdditionalAnswer(Zeroconf.DNSText(name, Zeroconf._TYPE_TXT,
+		Zeroconf._CLASS_IN | Zeroconf._CLASS_UNIQUE, ttl,
+		"\x0atxtvers=1\x0fMachine Name=%02d" % (index % 100)))
+	out.addAdditionalAnswer(Zeroconf.DNSAddress(server, Zeroconf._TYPE_A,
+		Zeroconf._CLASS_IN | Zeroconf._CLASS_UNIQUE, ttl,
+		socket.inet_aton("10.%d.%d.%d" % (host >> 16 & 255, host >> 8 & 255, host & 255))))
+	return out.packet()
+
+def syntheticTraffic(services, refreshes):
+	"""Returns lists of announcement, refresh and goodbye packets for
+	services spread over several service types."""
+	announce = []
+	goodbye = []
+	for i in range(services):
+		type = serviceTypes[i % len(serviceTypes)]
+		announce.append(announcement(type, i, 4500, i))
+		goodbye.append(announcement(type, i, 0, i))
+	return announce, announce * refreshes, goodbye
+
+def readPcap(path):
+	"""Returns the payloads of the IPv4 UDP port 5353 packets in a pcap
+	capture with Ethernet framing."""
+	f = open(path, 'rb')
+	data = f.read()
+	f.close()
+	magic = struct.unpack('<I', data[:4])[0]
+	if magic == 0xa1b2c3d4:
+		endian = '<'
+	elif magic == 0xd4c3b2a1:
+		endian = '>'
+	else:
+		raise ValueError("%s is not a pcap file" % path)
+	packets = []
+	offset = 24
+	while offset + 16 <= len(data):
+		caplen = struct.unpack(endian + 'I', data[offset+8:offset+12])[0]
+		frame = data[offset+16:offset+16+caplen]
+		offset += 16 + caplen
+		if len(frame) < 42 or frame[12:14] != '\x08\x00':
+			continue
+		ihl = (ord(frame[14]) & 0x0f) * 4
+		if ord(frame[23]) != 17: # UDP
+			continue
+		udp = 14 + ihl
+		if struct.unpack('!H', frame[udp+2:udp+4])[0] != Zeroconf._MDNS_PORT:
+			continue
+		packets.append(frame[udp+8:])
+	return packets
+
+
+def maxRSS():
+	"""Returns the peak resident set size in kilobytes."""
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def replay(zeroconf, memSocket, packets):
+	"""Feeds packets to the engine and returns the seconds taken for it
+	to handle them all."""
+	start = time.time()
+	memSocket.feed(packets)
+	memSocket.empty.wait(600)
+	done = threading.Event()
+	zeroconf.engine.callSoon(done.set) # let queued callbacks run
+	done.wait(600)
+	return time.time() - start
+
+def timeCacheOps(cache, count=2000):
+	"""Returns the microseconds per DNSCache get, getByDetails and
+	entries call on a populated cache."""
+	entries = cache.entries()
+	if not entries:
+		return {}
+	sample = [entries[i % len(entries)] for i in range(count)]
+	result = {}
+	start = time.time()
+	for entry in sample:
+		cache.get(entry)
+	result['get'] = (time.time() - start) / count * 1e6
+	start = time.time()
+	for entry in sample:
+		cache.getByDetails(entry.name, entry.type, entry.clazz)
+	result['getByDetails'] = (time.time() - start) / count * 1e6
+	start = time.time()
+	for i in range(count / 100):
+		cache.entries()
+	result['entries'] = (time.time() - start) / (count / 100) * 1e6
+	return result
+
+def report(label, packets, seconds):
+	rate = 0
+	if seconds:
+		rate = packets / seconds
+	print "%-10s %6d packets in %7.3fs: %9.0f packets/s" % (label, packets, seconds, rate)
+
+def main():
+	parser = optparse.OptionParser(usage="%prog [options]")
+	parser.add_option("-n", "--services", type="int", default=500,
+		help="number of synthetic services (default 500)")
+	parser.add_option("-r", "--refreshes", type="int", default=3,
+		help="TTL refresh rounds of synthetic traffic (default 3)")
+	parser.add_option("-p", "--pcap", metavar="FILE",
+		help="replay mDNS packets from a pcap capture instead")
+	options, args = parser.parse_args()
+
+	memSocket = MemorySocket()
+	interface = Zeroconf.Interface(socket.AF_INET, '192.0.2.2', 0, 'mem')
+	interface.socket = memSocket
+	rssBefore = maxRSS()
+	zeroconf = Zeroconf.Zeroconf(interfaces=[interface])
+	listener = CountingListener()
+	zeroconf.addServiceListener("_daap._tcp.local.", listener)
+
+	if options.pcap:
+		phases = [("replay", readPcap(options.pcap))]
+	else:
+		announce, refresh, goodbye = syntheticTraffic(options.services,
+			options.refreshes)
+		phases = [("announce", announce), ("refresh", refresh),
+			("goodbye", goodbye)]
+
+	cacheOps = {}
+	for label, packets in phases:
+		seconds = replay(zeroconf, memSocket, packets)
+		report(label, len(packets), seconds)
+		if label != "goodbye":
+			cacheOps = timeCacheOps(zeroconf.cache)
+	stats = zeroconf.getStats()
+	print
+	for op, micros in cacheOps.items():
+		print "cache %-12s %8.1f us" % (op, micros)
+	print "peak rss growth    %8d KB" % (maxRSS() - rssBefore)
+	dispatch = stats.get('dispatch.ms')
+	if dispatch:
+		print "listener dispatch  p50 %.3f ms p95 %.3f ms p99 %.3f ms max %.3f ms" % \
+			(dispatch['p50'], dispatch['p95'], dispatch['p99'], dispatch['max'])
+	print "browser callbacks  %d added, %d removed" % (listener.added, listener.removed)
+	print "packets sent       %d" % memSocket.sent
+	print
+	sys.stdout.write(Zeroconf.formatStats(dict([(k, v) for k, v in stats.items()
+		if not k.startswith('resolve.ms ')])))
+	zeroconf.close()
+
+
+if __name__ == '__main__':
+	main()
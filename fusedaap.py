@@ -32,6 +32,14 @@ import os, stat, errno, sys, socket, time, signal
 import fuse
 import threading
 import logging
+import heapq
+import types
+import array
+import httplib
+import urllib
+import struct
+import zlib
+import cPickle as pickle
 import daap
 import Zeroconf
 
@@ -43,8 +51,35 @@ if not hasattr(fuse, '__version__'):
 daapZConfType = "_daap._tcp.local."
 daapPort = 3689
 
-#logging set using -d flag
+blockSize = 128 * 1024 # unit of the block cache, the kernel's usual read size
+
+# DMAP codes of the track fields fusedaap knows, by listing field name,
+# and whether each is a string or a number
+fieldCodes = {
+	'dmap.itemid' : 'miid', 'dmap.itemname' : 'minm',
+	'daap.songalbum' : 'asal', 'daap.songartist' : 'asar',
+	'daap.songformat' : 'asfm', 'daap.songsize' : 'assz',
+	'daap.songtracknumber' : 'astn', 'daap.songtime' : 'astm',
+	'daap.songgenre' : 'asgn', 'daap.songyear' : 'asyr',
+	'daap.songcomposer' : 'ascp', 'daap.songdiscnumber' : 'asdn',
+	'daap.songbitrate' : 'asbr', 'daap.songcomment' : 'ascm',
+}
+stringCodes = dict.fromkeys(['minm', 'asal', 'asar', 'asfm', 'asgn',
+	'ascp', 'ascm'])
+intCodes = dict.fromkeys([c for c in fieldCodes.values()
+	if c not in stringCodes])
+# the fields of the track listing: only what the directories need
+trackMeta = "dmap.itemid,dmap.itemname,daap.songalbum,daap.songartist," \
+	"daap.songformat,daap.songsize,daap.songtracknumber"
+listingChunk = 500 # tracks given to the handlers at a time
+
+# classes of transfer, most urgent first
+INTERACTIVE, PREFETCH, BULK = range(3)
+transferClasses = ('interactive', 'prefetch', 'bulk')
+
+#logging set using -d flag, or -o eventlog=PATH
 logger = logging.getLogger('fusedaap')
+logger.addHandler(logging.NullHandler())
 
 def enableLogging():
 	hdlr = logging.FileHandler('fd.log')
@@ -53,53 +88,101 @@ def enableLogging():
 	logger.addHandler(hdlr)
 	logger.setLevel(logging.DEBUG)
 
+def enableEventLog(path):
+	"""Logs to path as structured events, one JSON object a line."""
+	logger.addHandler(EventLogHandler(path))
+	logger.setLevel(logging.DEBUG)
 
-def inject_requestRange_into_DAAPTrack():
-	"""This function does something a bit scary... It adds the method
-		requestRange() to daap.DAAPTrack class at runtime. 
-		
-		I resisted this solution for a long time before I finally gave in.
-		I was subclassing DAAPTrack, but every DAAPTrack returned by a
-		database had to be 'converted' to an AdvancedDAAPTrack. This seemed
-		to be fairly silly given that I could simply add requestRange at 
-		runtime. 
-	"""
 
-	def requestRange(self, offset, length):
-		"""Performs a request for a byte range of the file instead of the entire file.
-		"""
-        # gotta bump this every track download
-		self.database.session.connection.request_id += 1
-		
-		return self.database.session.connection._getResponseWithHeaders(
-			self.database.session.connection, "/databases/%s/items/%s.%s"% \
-			(self.database.id, self.id, self.type),
-			{'session-id':self.database.session.sessionid}, gzip = 0,
-			headers = {'Range' : 'bytes=%d-%d'%(offset, offset+length-1)})
-	
-	daap.DAAPTrack.requestRange = requestRange
+class EventLogHandler(logging.FileHandler):
+	"""Writes each log record as a JSON object on a line of its own,
+	with its time, level, thread, message template ("event") and
+	arguments as well as the formatted message, so that a log can be
+	filtered and aggregated by event without parsing the messages."""
+	def __init__(self, path):
+		logging.FileHandler.__init__(self, path)
+		import json # only needed for the event log
+		self.dumps = json.dumps
+	def format(self, record):
+		args = record.args
+		if not isinstance(args, tuple):
+			args = (args,)
+		event = {'time': record.created, 'level': record.levelname,
+			'thread': record.threadName, 'event': record.msg,
+			'args': args, 'message': record.getMessage()}
+		if record.exc_info:
+			event['exception'] = logging.Formatter().formatException(
+				record.exc_info)
+		return self.dumps(event, default=repr)
+
+
+class SampledLog(object):
+	"""Logs at most rate messages a second, at level, for events that
+	happen for every track or directory entry.  Nothing is formatted
+	unless it is logged, and the number of messages skipped is added to
+	the next one logged.  The counts are not locked, so under
+	concurrency the rate is approximate."""
+	def __init__(self, level=logging.DEBUG, rate=10):
+		self.level = level
+		self.rate = rate
+		self.second = 0
+		self.count = 0
+		self.skipped = 0
+
+	def log(self, message, *args):
+		if not logger.isEnabledFor(self.level):
+			return
+		now = int(time.time())
+		if now != self.second:
+			self.second = now
+			self.count = 0
+		if self.count >= self.rate:
+			self.skipped += 1
+			return
+		self.count += 1
+		if self.skipped:
+			message += " (%d similar skipped)"
+			args += (self.skipped,)
+			self.skipped = 0
+		logger.log(self.level, message, *args)
+
+# per-entry events
+trackLog = SampledLog()
+lookupLog = SampledLog()
 
 
-## This does something a litte bit scary, read comment in function
-inject_requestRange_into_DAAPTrack()
+class Inode(fuse.Stat):
+	"""Stores basic information about a file.
 
+	The fields that are the same for every file, owner and times
+	included, are class attributes set once per mount by setDefaults(),
+	so an inode only holds its own name, mode and size.
+	"""
+	st_ino = 0
+	st_dev = 0
+	st_nlink = 1
+	st_size = 0
 
-class Inode(fuse.Stat):
-	"""Stores basic information about a file."""
 	def __init__(self, name, permissions):
 		"""Populates the values of name and st_mode."""
 		self.name = name
 		self.st_mode = permissions
-		self.st_ino = 0
-		self.st_dev = 0
-		self.st_nlink = 1
-		self.st_uid = int(os.getuid())
-		self.st_gid = int(os.getgid())
-		now = int(time.time())
-		self.st_atime = now
-		self.st_mtime = now
-		self.st_ctime = now
-		self.st_size = 0
+
+	def setDefaults(cls, uid=None, gid=None, now=None):
+		"""Sets the owner and times of every inode, by default to the
+		current user and time."""
+		if uid is None:
+			uid = os.getuid()
+		if gid is None:
+			gid = os.getgid()
+		if now is None:
+			now = int(time.time())
+		cls.st_uid = uid
+		cls.st_gid = gid
+		cls.st_atime = cls.st_mtime = cls.st_ctime = now
+	setDefaults = classmethod(setDefaults)
+
+Inode.setDefaults()
 
 
 class DirInode(Inode):
@@ -129,40 +212,975 @@ class SongInode(Inode):
 		self.song = song
 
 
-class ServiceResolver(threading.Thread):
-	"""A class to wrap the Zeroconf.getServiceInfo() method into a thread.
-	If the service resolves, will call addHost() method in listener."""
-	
-	threadCounter = 0
+class VirtualFile(Inode):
+	"""A read-only file whose contents, a string, are made by calling
+	generate() whenever it is read, e.g. to report runtime statistics."""
+	def __init__(self, name, generate, permissions=stat.S_IFREG | 0444):
+		Inode.__init__(self, name, permissions)
+		self.generate = generate
+
+	def getSize(self):
+		"""Returns the size of the contents now."""
+		return len(self.generate())
+	st_size = property(getSize)
+
+
+class Track(object):
+	"""A track of a DAAP database: a row of its host's TrackTable.
+	Tracks compare by row, so any Track for a row stands for it, e.g.
+	in the block cache.  Other fields are fetched when asked for with
+	field()."""
+	__slots__ = ('table', 'row')
+
+	def __init__(self, table, row):
+		self.table = table
+		self.row = row
+
+	def __eq__(self, other):
+		return isinstance(other, Track) and self.table is other.table \
+			and self.row == other.row
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __hash__(self):
+		return hash((id(self.table), self.row))
+
+	database = property(lambda self: self.table.database)
+	id = property(lambda self: self.table.ids[self.row])
+	size = property(lambda self: self.table.sizes[self.row])
+	name = property(lambda self: self.table.name(self.row))
+	artist = property(lambda self: self.table.values[self.table.artists[self.row]])
+	album = property(lambda self: self.table.values[self.table.albums[self.row]])
+	type = property(lambda self: self.table.values[self.table.types[self.row]])
+	trackNumber = property(lambda self: self.table.trackNumbers[self.row] or None)
+
+	def fetchRange(self, offset, length, priority=INTERACTIVE):
+		"""Returns a byte range of the file, fetched over one of the
+		host's pooled connections."""
+		database = self.table.database
+		return database.session.connection.fetchRange(
+			"/databases/%s/items/%s.%s"%(database.id, self.id, self.type),
+			{'session-id':database.session.sessionid}, offset, length,
+			priority)
+
+	def field(self, meta):
+		"""Returns the value of the listing field meta for this track,
+		e.g. 'daap.songgenre', or None if the server has none."""
+		database = self.table.database
+		return database.session.connection.itemField(database, self.id, meta)
+
+
+class NameTable(object):
+	"""Interns metadata strings, and the file names they are cleaned
+	into, so that an artist, album or format is one object however many
+	tracks, hosts and directory trees share it.  Strings are never
+	released, so only repeated values should be interned, not per-track
+	ones like track names.
+
+	stats counts the distinct strings (intern.strings, intern.bytes),
+	the duplicates replaced (intern.hits, intern.bytesSaved) and the
+	names cleaned (intern.cleaned, intern.cleanHits).
+	"""
+	def __init__(self):
+		self.strings = {str: {}, unicode: {}} # so 'a' doesn't become u'a'
+		self.cleanNames = {}
+		self.lock = threading.Lock()
+		self.stats = Zeroconf.Stats()
+
+	def intern(self, value):
+		"""Returns the interned string equal to value."""
+		strings = self.strings.get(type(value))
+		if strings is None:
+			return value
+		self.lock.acquire()
+		try:
+			interned = strings.get(value)
+			if interned is None:
+				interned = strings[value] = value
+				self.stats.incr('intern.strings')
+				self.stats.incr('intern.bytes', sys.getsizeof(value))
+			elif interned is not value:
+				self.stats.incr('intern.hits')
+				self.stats.incr('intern.bytesSaved', sys.getsizeof(value))
+		finally:
+			self.lock.release()
+		return interned
+
+	def clean(self, value):
+		"""Returns the interned _getCleanName() of value."""
+		cleaned = self.cleanNames.get(value)
+		if cleaned is None:
+			cleaned = self.intern(_getCleanName(value))
+			self.cleanNames[value] = cleaned
+			self.stats.incr('intern.cleaned')
+		else:
+			self.stats.incr('intern.cleanHits')
+		return cleaned
+
+nameTable = NameTable()
+
+
+class TrackTable(object):
+	"""The tracks of one host's database, stored by column so that a
+	track costs a few dozen bytes rather than a few objects.  Numbers
+	are kept in arrays, names UTF-8 encoded back to back, and artists,
+	albums and formats, which repeat, as indexes into the list of their
+	distinct values.
+
+	Rows are only ever appended, by the thread reading the listing, so
+	the tracks already handed out can be read without locking.
+	"""
+	def __init__(self, database):
+		self.database = database
+		self.ids = array.array('I')
+		self.sizes = array.array('L')
+		self.trackNumbers = array.array('H') # 0 for none
+		self.artists = array.array('I') # indexes into values
+		self.albums = array.array('I')
+		self.types = array.array('I')
+		self.names = array.array('c')
+		self.nameEnds = array.array('L') # offset in names after each name
+		self.values = []
+		self.valueIndexes = {}
+
+	def __len__(self):
+		return len(self.ids)
+
+	def append(self, fields):
+		"""Adds a track from its decoded listing fields, by DMAP code,
+		and returns it."""
+		self.ids.append(fields.get('miid', 0))
+		self.sizes.append(fields.get('assz', 0))
+		self.trackNumbers.append(fields.get('astn') or 0)
+		self.artists.append(self.valueIndex(fields.get('asar')))
+		self.albums.append(self.valueIndex(fields.get('asal')))
+		self.types.append(self.valueIndex(fields.get('asfm')))
+		name = fields.get('minm')
+		if name:
+			self.names.fromstring(name.encode('utf-8'))
+		self.nameEnds.append(len(self.names))
+		return Track(self, len(self.ids) - 1)
+
+	def valueIndex(self, value):
+		"""Returns the index of value in values, adding it if needed."""
+		index = self.valueIndexes.get(value)
+		if index is None:
+			value = nameTable.intern(value)
+			index = self.valueIndexes[value] = len(self.values)
+			self.values.append(value)
+		return index
+
+	def name(self, row):
+		start = 0
+		if row > 0:
+			start = self.nameEnds[row - 1]
+		if start == self.nameEnds[row]:
+			return None
+		return self.names[start:self.nameEnds[row]].tostring().decode('utf-8')
+
+
+class ServiceResolver(object):
+	"""Resolves a zeroconf service on the Zeroconf engine thread.
+	If the service resolves, will call rememberService() and then, from
+	a new thread since connecting to a DAAP server blocks, addHost() in
+	listener."""
 	
 	def __init__(self, zeroconf, serviceInfo, listener, timeout):
-		threading.Thread.__init__(self)
 		self.zeroconf = zeroconf
 		self.info = serviceInfo
 		self.timeout = timeout
 		self.listener = listener
-		self.__class__.threadCounter += 1
-		logger.info("Total number of ServiceResolver threads created %d"
-			% self.__class__.threadCounter)
-		self.start()
+		self.info.asyncRequest(self.zeroconf, self.timeout, self.resolved)
 
-	def run(self):
-		if self.info.request(self.zeroconf, self.timeout):
+	def resolved(self, info, result):
+		if result:
 			logger.info("Found service, setting call back")
-			self.listener.addHost(self.info.name, self.info.address)
+			self.listener.rememberService(info, result)
+			self.listener.startThread(self.listener.addHost, info.name,
+				info.getAddresses(), info.port)
 		else:
-			logger.info("Service discovery failed for %s"%self.info.name)
+			logger.info("Service discovery failed for %s"%info.name)
 		
 
+class ServiceCache(object):
+	"""Remembers the addresses and port of resolved services until the
+	records they were resolved from expire, so that a share that comes
+	back can be connected to without resolving it again.
+
+	If a path is given, the cache is loaded from it and saved to it
+	saveDelay seconds after it changes, from a timer thread, so that it
+	lasts across mounts.  put() and remove() are called on the Zeroconf
+	engine thread, which must not wait for the disk.
+	"""
+	def __init__(self, path=None, saveDelay=1.0):
+		self.path = path
+		self.saveDelay = saveDelay
+		self.services = {} # name -> (addresses, port, expiry time in s)
+		self.lock = threading.Lock()
+		self.saveLock = threading.Lock() # one save at a time
+		self.saveTimer = None
+		if path is not None:
+			self.load()
+
+	def get(self, name):
+		"""Returns (addresses, port) for the service, or None if it is
+		not cached or has expired."""
+		self.lock.acquire()
+		try:
+			entry = self.services.get(name)
+			if entry is None:
+				return None
+			addresses, port, expires = entry
+			if expires <= time.time():
+				del self.services[name]
+				return None
+			return addresses, port
+		finally:
+			self.lock.release()
+
+	def put(self, name, addresses, port, expires):
+		"""Caches a service until expires (seconds since the epoch)."""
+		self.lock.acquire()
+		self.services[name] = (addresses, port, expires)
+		self.lock.release()
+		self.changed()
+
+	def remove(self, name):
+		"""Forgets a service, e.g. because its cached address failed."""
+		self.lock.acquire()
+		removed = self.services.pop(name, None)
+		self.lock.release()
+		if removed is not None:
+			self.changed()
+
+	def changed(self):
+		"""Saves the cache saveDelay seconds from now, with any other
+		changes made by then, unless a save is already due."""
+		if self.path is None:
+			return
+		self.lock.acquire()
+		if self.saveTimer is None:
+			self.saveTimer = threading.Timer(self.saveDelay, self.save)
+			self.saveTimer.setDaemon(True)
+			self.saveTimer.start()
+		self.lock.release()
+
+	def load(self):
+		"""Reads the cache from self.path, ignoring a missing or corrupt
+		file."""
+		try:
+			f = open(self.path, 'rb')
+			try:
+				services = pickle.load(f)
+			finally:
+				f.close()
+		except Exception, e: # missing, truncated or not a pickle
+			logger.info("Could not load service cache %s: %s"%(self.path, e))
+			return
+		now = time.time()
+		self.lock.acquire()
+		for name, entry in services.items():
+			if entry[2] > now:
+				self.services[name] = entry
+		self.lock.release()
+
+	def save(self):
+		"""Writes the cache to self.path, if there is one, in place of
+		any save that is due."""
+		if self.path is None:
+			return
+		self.saveLock.acquire()
+		try:
+			self.lock.acquire()
+			if self.saveTimer is not None:
+				self.saveTimer.cancel()
+				self.saveTimer = None
+			services = dict(self.services)
+			self.lock.release()
+			tmpPath = "%s.%d" % (self.path, os.getpid())
+			try:
+				f = open(tmpPath, 'wb')
+				try:
+					pickle.dump(services, f, 2)
+				finally:
+					f.close()
+				os.rename(tmpPath, self.path)
+			except (IOError, OSError), e:
+				logger.info("Could not save service cache %s: %s"%(self.path, e))
+		finally:
+			self.saveLock.release()
+
+
+class BlockCache(object):
+	"""An LRU cache of track data in blockSize blocks, shared by every
+	file.  Blocks are keyed by (song, block index).
+
+	The blocks of pinned songs are kept apart, are never evicted and do
+	not count towards maxBytes.  Instead the sizes of the pinned songs,
+	cached or not, are counted in pinnedSize, which callers keep within
+	maxPinnedBytes."""
+	def __init__(self, maxBytes=64*1024*1024, maxPinnedBytes=256*1024*1024):
+		self.maxBytes = maxBytes
+		self.maxPinnedBytes = maxPinnedBytes
+		self.bytes = 0
+		self.blocks = {} # key -> data
+		self.ticks = {} # key -> tick of its last use
+		self.heap = [] # (tick, key), including stale ticks
+		self.tick = 0
+		self.pinned = {} # song -> number of pins
+		self.pinnedBlocks = {} # key -> data
+		self.pinnedBytes = 0
+		self.pinnedSizes = {} # song -> its size, as given to pin()
+		self.pinnedSize = 0
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.blocks) + len(self.pinnedBlocks)
+
+	def __contains__(self, key):
+		return key in self.blocks or key in self.pinnedBlocks
+
+	def get(self, key):
+		"""Returns the block, or None if it is not cached."""
+		self.lock.acquire()
+		try:
+			data = self.blocks.get(key)
+			if data is not None:
+				self._touch(key)
+				return data
+			return self.pinnedBlocks.get(key)
+		finally:
+			self.lock.release()
+
+	def put(self, key, data):
+		"""Caches a block, evicting the least recently used blocks if the
+		cache is full."""
+		self.lock.acquire()
+		try:
+			if key[0] in self.pinned:
+				old = self.pinnedBlocks.get(key)
+				if old is not None:
+					self.pinnedBytes -= len(old)
+				self.pinnedBlocks[key] = data
+				self.pinnedBytes += len(data)
+				return
+			old = self.blocks.get(key)
+			if old is not None:
+				self.bytes -= len(old)
+			self.blocks[key] = data
+			self.bytes += len(data)
+			self._touch(key)
+			self._evict()
+		finally:
+			self.lock.release()
+
+	def pin(self, song, size=0):
+		"""Keeps the blocks of song, which is size bytes long, cached now
+		or later, until it is unpinned as many times as it was pinned."""
+		self.lock.acquire()
+		try:
+			self.pinned[song] = self.pinned.get(song, 0) + 1
+			if self.pinned[song] > 1:
+				return
+			self.pinnedSizes[song] = size
+			self.pinnedSize += size
+			for key in [k for k in self.blocks if k[0] == song]:
+				data = self.blocks.pop(key)
+				del self.ticks[key]
+				self.bytes -= len(data)
+				self.pinnedBlocks[key] = data
+				self.pinnedBytes += len(data)
+		finally:
+			self.lock.release()
+
+	def unpin(self, song):
+		"""Returns the blocks of song to the LRU once it is no longer
+		pinned."""
+		self.lock.acquire()
+		try:
+			count = self.pinned.get(song, 0) - 1
+			if count > 0:
+				self.pinned[song] = count
+				return
+			self.pinned.pop(song, None)
+			self.pinnedSize -= self.pinnedSizes.pop(song, 0)
+			for key in [k for k in self.pinnedBlocks if k[0] == song]:
+				data = self.pinnedBlocks.pop(key)
+				self.pinnedBytes -= len(data)
+				self.blocks[key] = data
+				self.bytes += len(data)
+				self._touch(key)
+			self._evict()
+		finally:
+			self.lock.release()
+
+	def isPinned(self, song):
+		return song in self.pinned
+
+	def drop(self, match):
+		"""Drops the blocks and pins of the songs for which match(song)
+		is true, e.g. those of a host that has gone."""
+		self.lock.acquire()
+		try:
+			for key in [k for k in self.blocks if match(k[0])]:
+				del self.ticks[key]
+				self.bytes -= len(self.blocks.pop(key))
+			for key in [k for k in self.pinnedBlocks if match(k[0])]:
+				self.pinnedBytes -= len(self.pinnedBlocks.pop(key))
+			for song in [s for s in self.pinned if match(s)]:
+				del self.pinned[song]
+				self.pinnedSize -= self.pinnedSizes.pop(song, 0)
+		finally:
+			self.lock.release()
+
+	def _touch(self, key):
+		self.tick += 1
+		self.ticks[key] = self.tick
+		heapq.heappush(self.heap, (self.tick, key))
+		if len(self.heap) > 2 * len(self.blocks) + 64:
+			self.heap = [(tick, key) for key, tick in self.ticks.items()]
+			heapq.heapify(self.heap)
+
+	def _evict(self):
+		while self.bytes > self.maxBytes and self.heap:
+			tick, key = heapq.heappop(self.heap)
+			if self.ticks.get(key) != tick:
+				continue # used again since
+			del self.ticks[key]
+			self.bytes -= len(self.blocks.pop(key))
+
+
+class PendingFetch(object):
+	"""A fetch of blocks in progress, for other readers of the same
+	blocks to wait on."""
+	def __init__(self):
+		self.done = threading.Event()
+		self.blocks = {}
+		self.error = None
+
+
+class Fetcher(object):
+	"""Reads track data through a BlockCache, fetching missing blocks
+	with song.fetchRange().
+
+	A miss fetches up to readahead bytes of missing blocks at once.  If
+	segments is more than 1, a fetch of at least two minSegment sized
+	pieces is split into up to that many range requests made in
+	parallel, which are reassembled in order into the cache.  The
+	connection pool of each host limits how many of them run at once.
+
+	Blocks being fetched are kept in a table, so that readers of
+	overlapping ranges wait for the fetch in progress instead of
+	fetching the same blocks again.
+	"""
+	def __init__(self, cache, readahead=512*1024, segments=1,
+		minSegment=256*1024):
+		self.cache = cache
+		self.readahead = readahead
+		self.segments = segments
+		self.minSegment = minSegment
+		self.pending = {} # (song, block index) -> PendingFetch
+		self.lock = threading.Lock()
+		self.stats = Zeroconf.Stats()
+
+	def read(self, song, size, offset, length, priority=INTERACTIVE):
+		"""Returns length bytes of song, which is size bytes long, from
+		offset.  Fetches are made in the given transfer class."""
+		if offset >= size or length <= 0:
+			return ''
+		length = min(length, size - offset)
+		first = offset / blockSize
+		last = (offset + length - 1) / blockSize
+		blocks = {}
+		for index in range(first, last + 1):
+			if index in blocks:
+				continue
+			data = self.cache.get((song, index))
+			if data is not None:
+				self.stats.incr('cache.hits')
+				blocks[index] = data
+				continue
+			self.stats.incr('cache.misses')
+			blocks.update(self.fetchMissing(song, size, index, last, priority))
+		data = ''.join([blocks[i] for i in range(first, last + 1)])
+		start = offset - first * blockSize
+		return data[start:start + length]
+
+	def fetchMissing(self, song, size, index, last, priority=INTERACTIVE):
+		"""Fetches block index, and the window of missing blocks after it,
+		or waits for the fetch already in progress for it.  Returns a
+		dictionary of index -> data which includes block index."""
+		key = (song, index)
+		self.lock.acquire()
+		try:
+			pending = self.pending.get(key)
+			if pending is None:
+				data = self.cache.get(key)
+				if data is not None: # fetched since the caller looked
+					return {index: data}
+				count = self.windowBlocks(song, size, index, last)
+				pending = PendingFetch()
+				for i in range(index, index + count):
+					self.pending[(song, i)] = pending
+				owner = True
+			else:
+				owner = False
+		finally:
+			self.lock.release()
+		if not owner:
+			self.stats.incr('fetch.coalesced')
+			pending.done.wait()
+			if pending.error is not None:
+				raise IOError("Shared fetch failed: %s" % pending.error)
+			return pending.blocks
+		try:
+			try:
+				pending.blocks = self.fetchBlocks(song, size, index, count,
+					priority)
+			except Exception, e:
+				pending.error = e
+				raise
+		finally:
+			self.lock.acquire()
+			for i in range(index, index + count):
+				del self.pending[(song, i)]
+			self.lock.release()
+			pending.done.set()
+		return pending.blocks
+
+	def windowBlocks(self, song, size, first, last):
+		"""Returns how many blocks from first to fetch: the missing blocks
+		up to last, and beyond it up to the readahead window, stopping at
+		any that are cached or being fetched."""
+		end = max(last, first + self.readahead / blockSize - 1)
+		end = min(end, (size - 1) / blockSize)
+		index = first + 1
+		while index <= end and (song, index) not in self.cache and \
+			(song, index) not in self.pending:
+			index += 1
+		return index - first
+
+	def fetchBlocks(self, song, size, first, count, priority=INTERACTIVE):
+		"""Fetches count blocks from first into the cache and returns
+		them as a dictionary of index -> data."""
+		offset = first * blockSize
+		length = min(count * blockSize, size - offset)
+		segments = min(self.segments, length / self.minSegment)
+		if segments > 1:
+			data = self.fetchSegments(song, offset, length, count, segments,
+				priority)
+		else:
+			data = self.fetchRange(song, offset, length, priority)
+		if len(data) != length:
+			raise IOError("short read: %d of %d bytes at %d" % \
+				(len(data), length, offset))
+		blocks = {}
+		for i in range(count):
+			block = data[i * blockSize:(i + 1) * blockSize]
+			self.cache.put((song, first + i), block)
+			blocks[first + i] = block
+		return blocks
+
+	def fetchSegments(self, song, offset, length, count, segments,
+		priority=INTERACTIVE):
+		"""Fetches a range as segments parallel requests, split on block
+		boundaries, and returns the data in order."""
+		perSegment = (count + segments - 1) / segments * blockSize
+		ranges = []
+		start = offset
+		while start < offset + length:
+			ranges.append((start, min(perSegment, offset + length - start)))
+			start += perSegment
+		results = [None] * len(ranges)
+		def fetch(i):
+			try:
+				results[i] = self.fetchRange(song, ranges[i][0], ranges[i][1],
+					priority)
+			except Exception, e:
+				results[i] = e
+		threads = []
+		for i in range(1, len(ranges)):
+			t = threading.Thread(target=fetch, args=(i,))
+			t.setDaemon(True)
+			t.start()
+			threads.append(t)
+		fetch(0)
+		for t in threads:
+			t.join()
+		self.stats.incr('fetch.segmented')
+		for result in results:
+			if isinstance(result, Exception):
+				raise result
+		return ''.join(results)
+
+	def fetchRange(self, song, offset, length, priority=INTERACTIVE):
+		start = time.time()
+		data = song.fetchRange(offset, length, priority)
+		self.stats.add('fetch.ms', (time.time() - start) * 1000)
+		self.stats.incr('fetch.requests')
+		self.stats.incr('fetch.bytes', len(data))
+		return data
+
+
+class Prefetcher(object):
+	"""Fetches whole tracks into the block cache from a background
+	thread, so that playback carries on through a network blip.
+
+	Tracks are fetched one at a time, a readahead window per request,
+	pinned tracks before those of open files, as PREFETCH transfers.  A track of an open file
+	is only fetched if it fits in a quarter of the cache, so that it
+	does not push out what is being played.  A pinned track that fails
+	to fetch is tried again after retryDelay seconds, doubling with each
+	failure up to maxRetryDelay, for as long as it stays pinned.
+	"""
+	PIN, OPEN = 0, 1 # priorities, most urgent first
+
+	def __init__(self, fetcher):
+		self.fetcher = fetcher
+		self.heap = [] # (priority, sequence, song, size)
+		self.queued = {} # song -> priority it is queued at
+		self.sequence = 0
+		self.condition = threading.Condition()
+		self.thread = None
+		self.closed = False
+		self.failures = {} # pinned song -> fetches failed in a row
+		self.retryDelay = 30
+		self.maxRetryDelay = 600
+
+	def add(self, song, size, priority):
+		"""Queues song to be fetched, unless it is already queued at the
+		same or a more urgent priority."""
+		cache = self.fetcher.cache
+		if priority == self.OPEN and size > cache.maxBytes / 4:
+			return
+		self.condition.acquire()
+		try:
+			if self.closed or self.queued.get(song, priority + 1) <= priority:
+				return
+			self.queued[song] = priority
+			self.sequence += 1
+			heapq.heappush(self.heap, (priority, self.sequence, song, size))
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.run)
+				self.thread.setDaemon(True)
+				self.thread.start()
+			self.condition.notify()
+		finally:
+			self.condition.release()
+
+	def cancel(self, song):
+		"""Stops fetching song if it was queued because its file was
+		open; pinned songs are fetched regardless."""
+		self.condition.acquire()
+		if self.queued.get(song) == self.OPEN:
+			del self.queued[song]
+		self.condition.release()
+
+	def drop(self, match):
+		"""Stops fetching the songs for which match(song) is true,
+		pinned or not."""
+		self.condition.acquire()
+		for song in [s for s in self.queued if match(s)]:
+			del self.queued[song]
+		for song in [s for s in self.failures if match(s)]:
+			del self.failures[song]
+		self.condition.release()
+
+	def next(self):
+		"""Waits for and returns the most urgent queued (song, size), or
+		None once closed."""
+		self.condition.acquire()
+		try:
+			while not self.closed:
+				while self.heap:
+					priority, sequence, song, size = heapq.heappop(self.heap)
+					if self.queued.get(song) == priority:
+						return song, size
+				self.condition.wait()
+			return None
+		finally:
+			self.condition.release()
+
+	def run(self):
+		while True:
+			item = self.next()
+			if item is None:
+				return
+			song, size = item
+			try:
+				self.fetch(song, size)
+				failed = False
+			except (IOError, socket.error, httplib.HTTPException), e:
+				logger.info("Could not prefetch %s: %s", song, e)
+				failed = True
+			self.condition.acquire()
+			if self.queued.get(song) is not None:
+				del self.queued[song]
+			self.condition.release()
+			if failed and self.fetcher.cache.isPinned(song):
+				self.retry(song, size)
+			else:
+				self.failures.pop(song, None)
+
+	def retry(self, song, size):
+		"""Queues a pinned song again once the retry delay has passed."""
+		failures = self.failures.get(song, 0) + 1
+		self.failures[song] = failures
+		delay = min(self.retryDelay * 2 ** (failures - 1), self.maxRetryDelay)
+		def requeue():
+			if self.fetcher.cache.isPinned(song):
+				self.add(song, size, self.PIN)
+		timer = threading.Timer(delay, requeue)
+		timer.setDaemon(True)
+		timer.start()
+
+	def fetch(self, song, size):
+		"""Fetches the blocks of song that are not cached, a window at a
+		time, for as long as it stays queued."""
+		cache = self.fetcher.cache
+		index = 0
+		last = (size - 1) / blockSize
+		while index <= last:
+			if self.closed or song not in self.queued:
+				return # cancelled
+			if (song, index) in cache:
+				index += 1
+				continue
+			blocks = self.fetcher.fetchMissing(song, size, index, index,
+				PREFETCH)
+			self.fetcher.stats.incr('prefetch.blocks', len(blocks))
+			index = max(blocks.keys()) + 1
+
+	def close(self):
+		self.condition.acquire()
+		self.closed = True
+		self.condition.notifyAll()
+		self.condition.release()
+
+
+class Profiler(object):
+	"""Times calls to the methods it instruments, recording each call's
+	latency in stats as a histogram op.<name>.ms, failures (exceptions
+	and negative errnos) as op.<name>.errors, and the bytes returned by
+	read() as op.read.bytes.
+
+	Profiling is opt-in: nothing is instrumented unless asked for, so it
+	costs nothing otherwise.
+	"""
+	def __init__(self, stats=None):
+		if stats is None:
+			stats = Zeroconf.Stats()
+		self.stats = stats
+		self.closing = threading.Event()
+		self.thread = None
+
+	def instrument(self, obj, method, name=None):
+		"""Replaces obj's method with one that records its calls under
+		name, by default the method's.  Generators, like readdir()'s, are
+		run to the end within the call."""
+		original = getattr(obj, method)
+		if name is None:
+			name = method
+		add, incr, now = self.stats.add, self.stats.incr, time.time
+		timeName = 'op.%s.ms'%name
+		errorName = 'op.%s.errors'%name
+		bytesName = 'op.%s.bytes'%name
+		def timed(*args, **kw):
+			start = now()
+			try:
+				result = original(*args, **kw)
+				if type(result) is types.GeneratorType:
+					result = list(result)
+			except:
+				incr(errorName)
+				raise
+			add(timeName, (now() - start) * 1000)
+			if type(result) is int:
+				if result < 0:
+					incr(errorName)
+			elif type(result) is str:
+				incr(bytesName, len(result))
+			return result
+		setattr(obj, method, timed)
+
+	def report(self):
+		"""Returns the stats as text, with the block cache's hit ratio."""
+		stats = self.stats.snapshot()
+		lookups = stats.get('cache.hits', 0) + stats.get('cache.misses', 0)
+		if lookups:
+			stats['cache.hitRatio'] = stats.get('cache.hits', 0) / float(lookups)
+		return Zeroconf.formatStats(stats)
+
+	def dumpStats(self, interval):
+		"""Logs the report every interval seconds until close()."""
+		if interval > 0:
+			self.thread = threading.Thread(target=self.run, args=(interval,))
+			self.thread.start()
+
+	def run(self, interval):
+		while True:
+			self.closing.wait(interval)
+			if self.closing.isSet():
+				return
+			if logger.isEnabledFor(logging.INFO):
+				logger.info("profile:\n%s", self.report())
+
+	def close(self):
+		self.closing.set()
+
+
+class OpenTrack(object):
+	"""An open track file, returned by DaapFS.open() for fuse to give
+	back to read() and release(), with the transfer class of its reads."""
+	__slots__ = ('song', 'priority')
+
+	def __init__(self, song, priority):
+		self.song = song
+		self.priority = priority
+
+
 class DaapFS(fuse.Fuse):
+	pinAttr = 'user.fusedaap.pinned'
+	cachedAttr = 'user.fusedaap.cached'
+
 	def __init__(self, *args, **kw):
 		fuse.Fuse.__init__(self, *args, **kw)
+		Inode.setDefaults()
 		self.dirSup = DirSupervisor()
+		self.blockCache = BlockCache()
+		self.fetcher = Fetcher(self.blockCache)
+		self.prefetcher = Prefetcher(self.fetcher)
+		self.prefetchTracks = 0 # following tracks to prefetch on open
+		self.openCounts = {} # song -> files open on it
+		self.songClasses = {} # song -> {transfer class: files open in it}
+		self.recentOpens = {} # pid -> [(time, song)] opened recently
+		self.bulkFiles = 4
+		self.bulkWindow = 30
+		self.openLock = threading.Lock()
+		self.pins = {} # path -> {song: True} for the songs pinned under it
+		self.pinLock = threading.Lock()
+		self.hostManager = None # made by setup()
+		self.profiler = None
+		# mount options, see main()
+		self.servicecache = None
+		self.cachesize = 64
+		self.pinsize = 256
+		self.readahead = 512
+		self.segments = 1
+		self.maxconnections = 4
+		self.prefetch = 0
+		self.bandwidth = 0
+		self.profile = None
+		self.eventlog = None
+		self.shutdowntimeout = 5
+
+	def setup(self):
+		"""Applies the mount options and makes the HostManager, with the
+		directory handlers, profiler and /.stats files, and returns it.
+		Services are not discovered until the filesystem is mounted."""
+		self.blockCache.maxBytes = int(self.cachesize) * 1024 * 1024
+		self.blockCache.maxPinnedBytes = int(self.pinsize) * 1024 * 1024
+		self.fetcher.readahead = int(self.readahead) * 1024
+		self.fetcher.segments = int(self.segments)
+		self.prefetchTracks = int(self.prefetch)
+		hostMan = HostManager(None, int(self.maxconnections),
+			int(self.bandwidth) * 1024, self.fetcher.stats)
+		hostMan.addHandler(HostDirHandler(self.dirSup.requestDirLease("/hosts")))
+		hostMan.addHandler(ArtistDirHandler(self.dirSup.requestDirLease("/artists")))
+		hostMan.addHandler(PinHandler(self))
+		self.profiler = Profiler(self.fetcher.stats)
+		if self.profile is not None:
+			for method in ('getattr', 'readdir', 'open', 'read'):
+				self.profiler.instrument(self, method)
+			self.profiler.instrument(hostMan, 'addHost')
+			hostMan.profiler = self.profiler
+			self.dirSup.addVirtualFile('/.stats/profile', self.profiler.report)
+			self.profiler.dumpStats(float(self.profile))
+		self.addStatsFiles(hostMan)
+		self.hostManager = hostMan
+		return hostMan
+
+	def shutdown(self, timeout=None):
+		"""Stops discovery, prefetching and profiling, and closes the
+		connections to every host, failing the transfers in flight,
+		within timeout seconds (shutdowntimeout by default) in all.
+		Whatever is still running after that is left to the process
+		exit.  Logs how long each step took and returns the times in
+		seconds by step."""
+		if timeout is None:
+			timeout = float(self.shutdowntimeout)
+		start = time.time()
+		deadline = start + timeout
+		timings = {}
+		hostMan = self.hostManager
+		if hostMan is not None:
+			hostMan.stopDiscovery(max(0, deadline - time.time()))
+		timings['discovery'] = time.time() - start
+		mark = time.time()
+		self.prefetcher.close()
+		threads = [self.prefetcher.thread]
+		if self.profiler is not None:
+			self.profiler.close()
+			threads.append(self.profiler.thread)
+		running = []
+		if hostMan is not None:
+			running = hostMan.closeAllConnections(max(0,
+				deadline - time.time()))
+		timings['connections'] = time.time() - mark
+		mark = time.time()
+		running += _joinAll([t for t in threads if t is not None], deadline)
+		timings['threads'] = time.time() - mark
+		timings['total'] = time.time() - start
+		logger.info("Shut down in %.3f s: discovery %.3f s, connections "
+			"%.3f s, threads %.3f s", timings['total'], timings['discovery'],
+			timings['connections'], timings['threads'])
+		if running:
+			logger.info("Not waiting for %s", [t.getName() for t in running])
+		return timings
+
+	def fsinit(self):
+		"""Called by fuse once the filesystem is mounted.  Starts
+		discovering services in the background, so that the mount can be
+		used straight away."""
+		if self.hostManager is not None:
+			self.hostManager.startDiscovery(self.servicecache)
 	
+	def addStatsFiles(self, hostManager):
+		"""Adds the files of the /.stats directory, each made when read:
+		cache (block cache and fetches), hosts (connected hosts), threads
+		and zeroconf."""
+		for name, getStats in (('cache', self.getStats),
+			('hosts', hostManager.getStats), ('threads', _threadStats),
+			('zeroconf', hostManager.getZeroconfStats)):
+			self.dirSup.addVirtualFile('/.stats/%s'%name,
+				lambda getStats=getStats: Zeroconf.formatStats(getStats()))
+
+	def getStats(self):
+		"""Returns a dictionary of the block cache's occupancy and hits,
+		the fetches in flight and queued, and the files open."""
+		counters = self.fetcher.stats.snapshot()
+		result = {}
+		for name in ('cache.hits', 'cache.misses', 'fetch.requests',
+			'fetch.bytes'):
+			result[name] = counters.get(name, 0)
+		cache = self.blockCache
+		result['cache.bytes'] = cache.bytes
+		result['cache.maxBytes'] = cache.maxBytes
+		result['cache.blocks'] = len(cache)
+		result['cache.pinnedBytes'] = cache.pinnedBytes
+		result['cache.pinnedTracks'] = len(cache.pinned)
+		result['cache.pinnedSize'] = cache.pinnedSize
+		result['cache.maxPinnedBytes'] = cache.maxPinnedBytes
+		result['fetch.pending'] = len(self.fetcher.pending)
+		result['prefetch.queued'] = len(self.prefetcher.queued)
+		result['files.open'] = sum(self.openCounts.values())
+		return result
+
 	def getattr(self, path):
 		inode = self.dirSup.fetchInode(path)
 		if inode is None:
-			logger.info("could not find inode: %s"%path)
+			lookupLog.log("could not find inode: %s", path)
 			return -errno.ENOENT
 		return inode
 
@@ -171,10 +1189,8 @@ class DaapFS(fuse.Fuse):
 		if directory == None:
 			directory = {} # ls will still work even after host has disconnected
 		for r in ['.', '..'] +  directory.children.keys():
-			logger.info("readdir: %s"%r)
 			if r is ' ' or r is '' or r is None:
-				logger.info("ERR readdir: read filename error: '%s'"%r)
-				pass
+				logger.info("ERR readdir: read filename error: '%s'", r)
 			else:
 				yield fuse.Direntry(r.encode(sys.getdefaultencoding(), "ignore"))
 
@@ -185,23 +1201,261 @@ class DaapFS(fuse.Fuse):
 		accmode = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
 		if (flags & accmode) != os.O_RDONLY:
 			return -errno.EACCES
+		if isinstance(inode, VirtualFile):
+			# the contents may change size after getattr
+			return fuse.FuseFileInfo(direct_io=True)
+		if isinstance(inode, SongInode):
+			priority = self.transferClass(inode.song)
+			self.openLock.acquire()
+			self.openCounts[inode.song] = self.openCounts.get(inode.song, 0) + 1
+			classes = self.songClasses.setdefault(inode.song, {})
+			classes[priority] = classes.get(priority, 0) + 1
+			self.openLock.release()
+			if priority != BULK: # else it will read the whole track itself
+				self.prefetcher.add(inode.song, inode.st_size, Prefetcher.OPEN)
+				for song in self.followingSongs(path, self.prefetchTracks):
+					self.prefetcher.add(song.song, song.st_size, Prefetcher.OPEN)
+			return OpenTrack(inode.song, priority)
+
+	def songClass(self, song):
+		"""Returns the most urgent transfer class song is open in, or
+		INTERACTIVE if it is not open."""
+		classes = self.songClasses.get(song)
+		if not classes:
+			return INTERACTIVE
+		return min(classes.keys())
+
+	def transferClass(self, song):
+		"""Returns the transfer class for reads of song by the calling
+		process: BULK if it has opened more than bulkFiles tracks in the
+		last bulkWindow seconds, as a copy or a tag scan does, and
+		INTERACTIVE otherwise."""
+		pid = self.GetContext()['pid']
+		now = time.time()
+		self.openLock.acquire()
+		try:
+			if len(self.recentOpens) > 64:
+				for p, opens in self.recentOpens.items():
+					if now - opens[-1][0] >= self.bulkWindow:
+						del self.recentOpens[p]
+			opens = [(t, s) for t, s in self.recentOpens.get(pid, [])
+				if now - t < self.bulkWindow and s != song]
+			opens.append((now, song))
+			self.recentOpens[pid] = opens
+		finally:
+			self.openLock.release()
+		if len(opens) > self.bulkFiles:
+			return BULK
+		return INTERACTIVE
+
+	def release(self, path, flags, fh=None):
+		"""Stops prefetching a track once nothing has it open, so that
+		programs that only read tags don't fetch whole tracks."""
+		inode = self.dirSup.fetchInode(path)
+		if not isinstance(inode, SongInode):
+			return
+		self.openLock.acquire()
+		classes = self.songClasses.get(inode.song, {})
+		if fh is not None:
+			priority = fh.priority
+		elif classes:
+			priority = max(classes.keys())
+		else:
+			priority = None
+		if priority in classes:
+			classes[priority] -= 1
+			if not classes[priority]:
+				del classes[priority]
+		count = self.openCounts.get(inode.song, 0) - 1
+		if count > 0:
+			self.openCounts[inode.song] = count
+		else:
+			self.openCounts.pop(inode.song, None)
+			self.songClasses.pop(inode.song, None)
+		self.openLock.release()
+		if count <= 0:
+			self.prefetcher.cancel(inode.song)
+
+	def followingSongs(self, path, count):
+		"""Returns the SongInodes of up to count files after path in its
+		directory, in name order."""
+		if count <= 0:
+			return []
+		directory = self.dirSup.fetchInode(os.path.dirname(path))
+		if directory is None:
+			return []
+		name = os.path.basename(path)
+		names = [n for n in directory.children.keys() if n > name]
+		names.sort()
+		songs = []
+		for n in names:
+			inode = directory.children.get(n)
+			if isinstance(inode, SongInode):
+				songs.append(inode)
+				if len(songs) == count:
+					break
+		return songs
+
+	def songInodes(self, inode):
+		"""Returns the SongInodes at or below inode."""
+		if isinstance(inode, SongInode):
+			return [inode]
+		songs = []
+		if not isinstance(inode, DirInode):
+			return songs
+		for child in inode.children.values():
+			songs.extend(self.songInodes(child))
+		return songs
+
+	def pin(self, path):
+		"""Keeps the tracks at or below path cached, fetching them now.
+		Pins are kept by path, so calling it again pins the tracks that
+		have appeared there since, e.g. when a host reconnects.  Returns
+		-ENOSPC, pinning nothing, if the pinned tracks would take more
+		than the block cache's maxPinnedBytes."""
+		cache = self.blockCache
+		self.pinLock.acquire()
+		try:
+			pinned = self.pins.get(path, {})
+			songs = {}
+			for inode in self.songInodes(self.dirSup.fetchInode(path)):
+				if inode.song not in pinned:
+					songs[inode.song] = inode.st_size
+			size = 0
+			for song, songSize in songs.items():
+				if not cache.isPinned(song):
+					size += songSize
+			if size and cache.pinnedSize + size > cache.maxPinnedBytes:
+				logger.info("Not pinning %s: %d MB would be pinned, of %d MB",
+					path, (cache.pinnedSize + size) / 1048576,
+					cache.maxPinnedBytes / 1048576)
+				return -errno.ENOSPC
+			self.pins[path] = pinned
+			for song, songSize in songs.items():
+				pinned[song] = True
+				cache.pin(song, songSize)
+		finally:
+			self.pinLock.release()
+		for song, songSize in songs.items():
+			self.prefetcher.add(song, songSize, Prefetcher.PIN)
+
+	def unpin(self, path):
+		self.pinLock.acquire()
+		pinned = self.pins.pop(path, {})
+		self.pinLock.release()
+		for song in pinned:
+			self.blockCache.unpin(song)
+
+	def repin(self):
+		"""Pins the tracks that have appeared under the pinned paths."""
+		for path in self.pins.keys():
+			self.pin(path)
+
+	def dropSongs(self, match):
+		"""Forgets the songs for which match(song) is true, e.g. those of
+		a host that has gone: drops their cached blocks and their pins,
+		and stops fetching them.  The paths stay pinned."""
+		self.pinLock.acquire()
+		for pinned in self.pins.values():
+			for song in [s for s in pinned if match(s)]:
+				del pinned[song]
+		self.pinLock.release()
+		self.prefetcher.drop(match)
+		self.blockCache.drop(match)
+
+	def cachedPercent(self, inode):
+		"""Returns the percentage of the tracks at or below inode that is
+		cached."""
+		total = cached = 0
+		for song in self.songInodes(inode):
+			blocks = (song.st_size + blockSize - 1) / blockSize
+			total += blocks
+			for index in range(blocks):
+				if (song.song, index) in self.blockCache:
+					cached += 1
+		if total == 0:
+			return 100
+		return cached * 100 / total
+
+	def getxattr(self, path, name, size):
+		"""Reports whether a file or directory is pinned, as '1' or '0' in
+		user.fusedaap.pinned, and how much of it is cached, as a
+		percentage in user.fusedaap.cached."""
+		inode = self.dirSup.fetchInode(path)
+		if inode is None:
+			return -errno.ENOENT
+		if isinstance(inode, VirtualFile):
+			return -errno.ENODATA
+		if name == self.pinAttr:
+			if isinstance(inode, DirInode):
+				value = str(int(path in self.pins))
+			else:
+				value = str(int(path in self.pins or
+					self.blockCache.isPinned(inode.song)))
+		elif name == self.cachedAttr:
+			value = str(self.cachedPercent(inode))
+		else:
+			return -errno.ENODATA
+		if size == 0:
+			return len(value)
+		return value
+
+	def listxattr(self, path, size):
+		inode = self.dirSup.fetchInode(path)
+		if inode is None:
+			return -errno.ENOENT
+		names = [self.pinAttr, self.cachedAttr]
+		if isinstance(inode, VirtualFile):
+			names = []
+		if size == 0:
+			return len("".join(names)) + len(names)
+		return names
+
+	def setxattr(self, path, name, value, flags):
+		"""Setting user.fusedaap.pinned to 1 on a file or directory keeps
+		its tracks cached for offline play, unless they would take more
+		than -o pinsize MB with those pinned already (ENOSPC); setting it
+		to 0 lets them be evicted again."""
+		inode = self.dirSup.fetchInode(path)
+		if inode is None:
+			return -errno.ENOENT
+		if name != self.pinAttr or isinstance(inode, VirtualFile):
+			return -errno.ENOTSUP
+		if value.strip() in ('1', 'yes', 'true'):
+			return self.pin(path)
+		elif value.strip() in ('0', 'no', 'false'):
+			self.unpin(path)
+		else:
+			return -errno.EINVAL
+
+	def removexattr(self, path, name):
+		inode = self.dirSup.fetchInode(path)
+		if inode is None:
+			return -errno.ENOENT
+		if name != self.pinAttr or isinstance(inode, VirtualFile):
+			return -errno.ENODATA
+		self.unpin(path)
 	
-	def read(self, path, size, offset):
+	def read(self, path, size, offset, fh=None):
+		"""Reads from a file.  Track data is fetched in the transfer class
+		of the file handle fh, or the most urgent its track is open in."""
 		inode = self.dirSup.fetchInode(path)
 		if inode is None:
 			return -errno.ENOENT
-		name = inode.name
-		slen = inode.st_size
-		song = inode.song
-
-		if offset < slen:
-			if offset + size > slen:
-				size = slen - offset
-			req = song.requestRange(offset, size)
-			buf = req.read(size)
+		if isinstance(inode, VirtualFile):
+			return inode.generate()[offset:offset+size]
+		if not isinstance(inode, SongInode):
+			return -errno.EISDIR
+		if fh is not None:
+			priority = fh.priority
 		else:
-			buf = ''
-		return buf
+			priority = self.songClass(inode.song)
+		try:
+			return self.fetcher.read(inode.song, inode.st_size, offset, size,
+				priority)
+		except (IOError, socket.error, httplib.HTTPException), e:
+			logger.info("Could not read %s: %s", path, e)
+			return -errno.EIO
 
 
 
@@ -209,69 +1463,216 @@ class HostManager(object):
 	"""
 	This class manages zeroconf hosts.
 	"""
-	def __init__(self):
+	def __init__(self, serviceCache=None, maxConnections=4, bandwidth=0,
+		stats=None):
 		self.__closed = False #if true, don't connect to any new hosts
 		self.listeners = []
 		self.allHosts = []
 		self.connectedSessions = {} # name -> DAAPSession, use to dissconnect
+		self.connecting = {} # name -> AdvancedDAAPClient still listing
+		self.threads = [] # connecting to hosts and logging out of them
+		self.trackCounts = {} # stripped name -> tracks listed so far
+		if serviceCache is None:
+			serviceCache = ServiceCache()
+		self.serviceCache = serviceCache
+		self.maxConnections = maxConnections # per host, for track data
+		self.bandwidth = bandwidth # per host, bytes per second
+		self.stats = stats # for the connection pools
+		self.profiler = None # times each host's DAAP requests if set
+		self.zeroconf = None # browsing for services, once started
+		self.discovery = None # thread starting it
+		self.discoveryLock = threading.Lock() # for zeroconf and __closed
 	
 	
+	def startDiscovery(self, serviceCachePath=None):
+		"""Starts browsing for DAAP services from a new thread, loading
+		the service cache from serviceCachePath first if given.  Setting
+		up Zeroconf takes time and can block, e.g. on DNS, and nothing
+		else needs to wait for it."""
+		self.discovery = threading.Thread(target=self.discover,
+			args=(serviceCachePath,))
+		self.discovery.setDaemon(True)
+		self.discovery.start()
+
+	def discover(self, serviceCachePath=None):
+		if serviceCachePath is not None:
+			self.serviceCache = ServiceCache(serviceCachePath)
+		try:
+			zeroconf = Zeroconf.Zeroconf()
+		except socket.error, e:
+			logger.error("Could not discover services: %s", e)
+			return
+		self.discoveryLock.acquire()
+		try:
+			stopping = self.__closed
+			if not stopping:
+				self.zeroconf = zeroconf
+				zeroconf.addServiceListener(daapZConfType, self)
+		finally:
+			self.discoveryLock.release()
+		if stopping:
+			zeroconf.close()
+
+	def stopDiscovery(self, timeout=None):
+		"""Stops browsing for services, and connecting to new hosts,
+		once discovery has started if it is starting.  Waits up to
+		timeout seconds, or for as long as it takes if None; discovery
+		that is still starting then closes Zeroconf itself."""
+		self.discoveryLock.acquire()
+		self.__closed = True
+		self.discoveryLock.release()
+		if timeout is None:
+			deadline = None
+		else:
+			deadline = time.time() + timeout
+		if self.discovery is not None:
+			_joinAll([self.discovery], deadline)
+		# set by now, or discover() will see __closed and close it
+		self.discoveryLock.acquire()
+		zeroconf = self.zeroconf
+		self.discoveryLock.release()
+		if zeroconf is not None:
+			if deadline is None:
+				zeroconf.close()
+			else:
+				zeroconf.close(max(0, deadline - time.time()))
+
+	def startThread(self, target, *args):
+		"""Runs target(*args) from a new daemon thread, which
+		closeAllConnections() waits for.  Connecting to a host or logging
+		out of one can block for as long as the host takes to answer, so
+		they are not left to keep the process from exiting."""
+		self.threads = [t for t in self.threads if t.isAlive()]
+		thread = threading.Thread(target=target, args=args)
+		thread.setDaemon(True)
+		thread.start()
+		self.threads.append(thread)
+		return thread
+
+	def getZeroconfStats(self):
+		"""Returns Zeroconf's statistics, or none before it starts."""
+		if self.zeroconf is None:
+			return {}
+		return self.zeroconf.getStats()
+
 	def addHandler(self, listener):
 		"""Adds a handler that will be called on the following events:
 		
 		newHost(host, songs): a new hostname with a list of track objects
+		addSongs(host, songs): more track objects for the host, as the
+			rest of its listing arrives
+		hostListed(host): the host's listing has ended, or stopped
+			after some tracks
 		delHost(host): the host has disconnected
 		"""
 		self.listeners.append(listener)
 
 	
-	def addHost(self, name, addr):
+	def addHost(self, name, addresses, port=daapPort):
 		"""Trys to connect to daap server. If able to connect, get song
 		listing.
+
+		addresses is a list of the server's IPv4 and IPv6 addresses as
+		strings; the one that accepts a connection fastest is used.
 		"""
 		if self.__closed:
-			return # do not add host if closed
-		stripName = _cleanStripName(name)
-		address = str(socket.inet_ntoa(addr))
-		port = daapPort
+			return False # do not add host if closed
+		stripName = nameTable.intern(_cleanStripName(name))
+		if port is None:
+			port = daapPort
+		address = _fastestAddress(addresses, port)
+		if address is None:
+			logger.info("Could not reach %s at any of %s"%(stripName, addresses))
+			return False
 		client = AdvancedDAAPClient()
-		tracks = []
+		if self.profiler is not None:
+			self.profiler.instrument(client, 'request', 'daap.request')
+			self.profiler.instrument(client, 'fetchRange', 'daap.fetchRange')
+		count = 0
+		self.connecting[name] = client
 		try:
 			client.connect (address, port)
+			client.pool = ConnectionPool(address, port, self.maxConnections,
+				bandwidth=self.bandwidth, stats=self.stats)
+			if self.__closed: # closeAllConnections() missed this pool
+				client.pool.close()
 			session = client.login() 
 			database = session.library()
-			tracks = database.tracks()
+			for tracks in client.iterTracks(database, listingChunk):
+				if count == 0:
+					logger.info("!!!\n!!! :) !!! Connected to %s\n!!!"%stripName)
+					self.connectedSessions[name] = session
+				for listener in self.listeners:
+					if count == 0:
+						listener.newHost(stripName, tracks)
+					else:
+						listener.addSongs(stripName, tracks)
+				count += len(tracks)
+				self.trackCounts[stripName] = count
+				logger.debug("Listed %d tracks from %s", count, stripName)
 		except Exception, e:
-			logger.info("Could not connect to %s: %s"%(stripName, e))
-		if len(tracks) > 0:
-			logger.info("!!!\n!!! :) !!! Connected to %s\n!!!"%stripName)
-			self.connectedSessions[name] = session
-			for listener in self.listeners:
-				listener.newHost(stripName, tracks)
+			logger.info("Could not connect to %s after %d tracks: %s"% \
+				(stripName, count, e))
+		self.connecting.pop(name, None)
+		if count > 0:
+			if not self.__closed:
+				for listener in self.listeners:
+					listener.hostListed(stripName)
+			return True
 		else:
 			try:
 				session.logout() #make sure we don't keep an open connection
 			except:
 				pass
 			logger.info("failed to get find any tracks from %s"%stripName)
+			return False
 			
 		
 	def addService(self, zeroconf, type, name):
-		"""Listener method called when new zeroconf service is detected."""
+		"""Listener method called when new zeroconf service is detected.
+		
+		If the service is in the service cache, connects to its cached
+		address straight away instead of waiting for it to resolve.
+		"""
 		if self.__closed:
 			return #do NOT add service if closed
 		self.allHosts.append(name)
-		ServiceResolver(zeroconf, Zeroconf.ServiceInfo(type, name), self, 3000)
+		cached = self.serviceCache.get(name)
+		if cached is None:
+			ServiceResolver(zeroconf, Zeroconf.ServiceInfo(type, name), self, 3000)
+		else:
+			addresses, port = cached
+			logger.info("Using cached address for %s: %s"%(name, addresses))
+			self.startThread(self.addCachedHost, zeroconf, type, name,
+				addresses, port)
+
+	def addCachedHost(self, zeroconf, type, name, addresses, port):
+		"""Connects to a service at its cached address while resolving it
+		in the background to refresh the cache.  If the cached address
+		does not work, falls back to connecting once it resolves."""
+		info = Zeroconf.ServiceInfo(type, name)
+		info.asyncRequest(zeroconf, 3000, self.rememberService)
+		if not self.addHost(name, addresses, port) and not self.__closed:
+			logger.info("Cached address for %s failed, resolving"%name)
+			self.serviceCache.remove(name)
+			ServiceResolver(zeroconf, Zeroconf.ServiceInfo(type, name), self, 3000)
+
+	def rememberService(self, info, result):
+		"""Adds a resolved service to the service cache.  Called on the
+		Zeroconf engine thread, so the cache is saved later, from its own
+		thread."""
+		if result and info.getExpirationTime() is not None:
+			self.serviceCache.put(info.name, info.getAddresses(), info.port,
+				info.getExpirationTime() / 1000.0)
 		
 	def removeService(self, zeroconf, type, name):
 		"""Listener method called when zeroconf service disconnects."""
 		stripName = _cleanStripName(name)
 		if self.connectedSessions.has_key(name):
-			try: 
-				self.connectedSessesions[name].logout()
-			except:
-				pass
-			del self.connectedSessions[name]
+			# not from the engine thread, as the host may not answer
+			self.startThread(self.logout, name,
+				self.connectedSessions.pop(name))
+			self.trackCounts.pop(stripName, None)
 			self.allHosts.remove(name)
 			for listener in self.listeners:
 				listener.delHost(stripName)
@@ -282,57 +1683,347 @@ class HostManager(object):
 				logger.info("value error ex. in HM.removeService for %s"%name)
 		logger.info("Service %s disconneted"%stripName)
 
-	def closeAllConnections(self):
-		"""Closes all open DAAPSession connections."""
-		self.__closed = True
+	def getStats(self):
+		"""Returns a dictionary of the number of services seen and hosts
+		connected, and of each host's address, tracks and connections
+		in use, idle and waited for."""
+		result = {'services': len(self.allHosts),
+			'hosts': len(self.connectedSessions)}
 		for name, session in self.connectedSessions.items():
-			try:
-				session.logout()
-			except:
-				pass
+			host = _cleanStripName(name)
+			pool = session.connection.pool
+			result['address %s'%host] = '%s:%s'%(pool.host, pool.port)
+			result['tracks %s'%host] = self.trackCounts.get(host, 0)
+			result['connections.active %s'%host] = pool.active
+			result['connections.idle %s'%host] = len(pool.idle)
+			result['connections.waiting %s'%host] = len(pool.waiting)
+		return result
+
+	def logout(self, name, session):
+		"""Fails the transfers in flight to a host, then logs out of it."""
+		start = time.time()
+		session.connection.pool.close(abort=True)
+		try:
+			session.logout()
+		except:
+			pass
+		logger.debug("Logged out of %s in %.3f s", name, time.time() - start)
+
+	def closeAllConnections(self, timeout=None):
+		"""Closes all open DAAPSession connections, failing the transfers
+		in flight and stopping hosts that are still being listed, and
+		logs out of every host at once.  Waits up to timeout seconds for
+		the logouts and hosts being connected to, or for as long as they
+		take if None.  Returns the threads still running."""
+		self.__closed = True
+		if timeout is None:
+			deadline = None
+		else:
+			deadline = time.time() + timeout
+		self.serviceCache.save()
+		for client in self.connecting.values():
+			if client.pool is not None:
+				client.pool.close(abort=True)
+		sessions = self.connectedSessions.items()
 		self.connectedSessions.clear()
-
+		for name, session in sessions:
+			self.startThread(self.logout, name, session)
+		running = _joinAll(self.threads, deadline)
+		if running:
+			logger.info("%d hosts still closing after %s s", len(running),
+				timeout)
+		return running
+
+
+
+class ConnectionPool(object):
+	"""Keeps HTTP connections to a DAAP server for reuse, and shapes the
+	transfers made over them so that a slow server is not swamped.
+
+	At most maxConnections are in use at once, and unless there is only
+	one, the last is kept for INTERACTIVE transfers.  Transfers waiting
+	for one are served by class, INTERACTIVE before PREFETCH before
+	BULK, and in order within a class.  If bandwidth (bytes per second) is
+	set, a token bucket holding up to a quarter second of it delays
+	transfers so that they average no more.  The time transfers wait
+	is recorded in stats as queue.<class>.ms and throttle.ms.
+
+	Closing the pool fails waiting transfers, and with abort, shuts down
+	the connections in use so that transfers in flight fail too.
+	"""
+	def __init__(self, host, port, maxConnections=4, timeout=30,
+		bandwidth=0, stats=None):
+		self.host = host
+		self.port = port
+		self.maxConnections = maxConnections
+		self.timeout = timeout
+		self.idle = []
+		self.busy = [] # connections handed out by get()
+		self.active = 0
+		self.waiting = [] # (priority, sequence) of waiting transfers
+		self.sequence = 0
+		self.closed = False
+		self.condition = threading.Condition()
+		self.bandwidth = bandwidth
+		self.tokens = bandwidth / 4.0
+		self.filled = time.time()
+		self.bucketLock = threading.Lock()
+		if stats is None:
+			stats = Zeroconf.Stats()
+		self.stats = stats
+
+	def get(self, priority=INTERACTIVE, length=0):
+		"""Returns a connection for a transfer of length bytes in the
+		given class, waiting for a free one and for bandwidth.  Give it
+		back with put()."""
+		start = time.time()
+		self.condition.acquire()
+		try:
+			self.sequence += 1
+			turn = (priority, self.sequence)
+			self.waiting.append(turn)
+			limit = self.maxConnections
+			if priority != INTERACTIVE and limit > 1:
+				limit -= 1
+			try:
+				while not self.closed and (self.active >= limit
+					or min(self.waiting) != turn):
+					self.condition.wait()
+			finally:
+				self.waiting.remove(turn)
+			if self.closed:
+				raise IOError("connection pool for %s is closed"%self.host)
+			self.active += 1
+			if self.waiting:
+				self.condition.notifyAll() # the next may fit too
+			connection = None
+			if self.idle:
+				connection = self.idle.pop()
+		finally:
+			self.condition.release()
+		self.stats.add('queue.%s.ms'%transferClasses[priority],
+			(time.time() - start) * 1000)
+		try:
+			self.throttle(length)
+			if connection is None:
+				connection = httplib.HTTPConnection(self.host, self.port,
+					timeout=self.timeout)
+			self.condition.acquire()
+			try:
+				if self.closed:
+					raise IOError("connection pool for %s is closed"%self.host)
+				self.busy.append(connection)
+			finally:
+				self.condition.release()
+		except IOError:
+			self.put(connection, False)
+			raise
+		return connection
+
+	def throttle(self, length):
+		"""Waits until the bucket has tokens, then takes length from it.
+		The bucket may go into debt, which later transfers wait off,
+		unless the pool is closed meanwhile."""
+		if not self.bandwidth:
+			return
+		self.bucketLock.acquire()
+		now = time.time()
+		self.tokens = min(self.bandwidth / 4.0,
+			self.tokens + (now - self.filled) * self.bandwidth)
+		self.filled = now
+		delay = 0
+		if self.tokens < 0:
+			delay = -self.tokens / self.bandwidth
+		self.tokens -= length
+		self.bucketLock.release()
+		if delay:
+			self.stats.add('throttle.ms', delay * 1000)
+			deadline = time.time() + delay
+			self.condition.acquire()
+			try:
+				while not self.closed and time.time() < deadline:
+					self.condition.wait(deadline - time.time())
+				if self.closed:
+					raise IOError("connection pool for %s is closed"%self.host)
+			finally:
+				self.condition.release()
+
+	def put(self, connection, reuse=True):
+		"""Gives back a connection from get().  It is kept for reuse unless
+		reuse is false."""
+		self.condition.acquire()
+		self.active -= 1
+		if connection in self.busy:
+			self.busy.remove(connection)
+		if reuse and not self.closed:
+			self.idle.append(connection)
+			connection = None
+		self.condition.notifyAll()
+		self.condition.release()
+		if connection is not None:
+			connection.close()
+
+	def close(self, abort=False):
+		"""Closes the idle connections; connections in use are closed as
+		they are given back.  With abort, the sockets of connections in
+		use are shut down too, failing their transfers straight away."""
+		self.condition.acquire()
+		self.closed = True
+		idle = self.idle
+		self.idle = []
+		busy = list(self.busy)
+		self.condition.notifyAll()
+		self.condition.release()
+		for connection in idle:
+			connection.close()
+		if abort:
+			for connection in busy:
+				sock = connection.sock
+				if sock is not None:
+					try:
+						sock.shutdown(socket.SHUT_RDWR)
+					except socket.error:
+						pass
 
 
 class AdvancedDAAPClient(daap.DAAPClient):
-	"""An extension of daap.DAAPClient with added method getResponse with headers that allows passing other headers to the daap server."""
+	"""An extension of daap.DAAPClient that fetches track data over
+	pooled connections, with other http headers such as Range.
+
+	It can be shared by threads: track data never uses the client's own
+	socket, requests on that socket are serialized, and request ids
+	are handed out atomically, so every request has its own id and
+	validation hash."""
 	def __init__(self):
 		daap.DAAPClient.__init__(self)
-
-
-	def _getResponseWithHeaders(self, daapclient, r, params = {}, gzip = 1, 
-			headers={}):
-		"""
-		Like daap.DAAPClient._get_response() but with the ability to add other http headers.
-		"""
+		self.pool = None # set once connected
+		self.lock = threading.Lock() # for self.socket
+		self.idLock = threading.Lock()
+
+	def nextRequestId(self):
+		"""Returns the id for a new request in this session."""
+		self.idLock.acquire()
+		self.request_id += 1
+		requestId = self.request_id
+		self.idLock.release()
+		return requestId
+
+	def request(self, r, params = {}, answers = 1):
+		"""Like daap.DAAPClient.request(), but one thread at a time, and
+		holding the id lock, so that the request_id it sends, and hashes,
+		is not changed by a concurrent fetchRange() in between.  Fetches
+		wait for their ids until it is answered."""
+		self.lock.acquire()
+		try:
+			self.idLock.acquire()
+			try:
+				return daap.DAAPClient.request(self, r, params, answers)
+			finally:
+				self.idLock.release()
+		finally:
+			self.lock.release()
+
+	def iterTracks(self, database, chunkSize):
+		"""Yields the Tracks of database in lists of up to chunkSize, as
+		the listing arrives, so that the whole listing is never held in
+		memory at once.  The tracks are the rows of a new TrackTable."""
+		table = TrackTable(database)
+		tracks = []
+		for fields in self.iterItems(database, {'meta': trackMeta}):
+			tracks.append(table.append(fields))
+			if len(tracks) == chunkSize:
+				yield tracks
+				tracks = []
+		if tracks:
+			yield tracks
+
+	def itemField(self, database, id, meta):
+		"""Returns the value of the listing field meta for item id, or
+		None if the server has none."""
+		code = fieldCodes[meta]
+		query = urllib.quote("'dmap.itemid:%d'"%id, ':')
+		for fields in self.iterItems(database, {'meta': meta,
+			'query': query}):
+			if fields.get('miid', id) == id:
+				return fields.get(code)
+		return None
+
+	def iterItems(self, database, params):
+		"""Yields the decoded fields of each item of a listing of
+		database, as it arrives.  The listing is fetched compressed if
+		the server will."""
+		params = dict(params)
+		params['session-id'] = database.session.sessionid
+		path, headers = self._requestHeaders(
+			"/databases/%s/items"%database.id, params, self.nextRequestId(),
+			{'Accept-encoding': 'gzip'})
+		connection = self.pool.get()
+		reuse = False
+		try:
+			connection.request('GET', path, None, headers)
+			response = connection.getresponse()
+			if response.status != 200:
+				raise IOError("Could not list %s: HTTP %d"%(path,
+					response.status))
+			body = response
+			if response.getheader('Content-Encoding') == 'gzip':
+				body = _GzipReader(response)
+			for item in _iterListing(body):
+				yield _decodeItem(item)
+			reuse = not response.will_close
+		finally:
+			self.pool.put(connection, reuse)
+
+	def _requestHeaders(self, r, params, requestId, headers = {}):
+		"""Returns the request path with params and the DAAP headers for
+		request requestId, added to headers."""
 		if params:
 			l = ['%s=%s' % (k, v) for k, v in params.iteritems()]
 			r = '%s?%s' % (r, '&'.join(l))
-		hdrs = {
+		headers = dict(headers)
+		headers.update({
 			'Client-DAAP-Version': '3.0',
 			'Client-DAAP-Access-Index': '2',
-		}
-		headers.update(hdrs)
-		if gzip: headers['Accept-encoding'] = 'gzip'
-		if daapclient.request_id > 0:
-			headers[ 'Client-DAAP-Request-ID' ] = daapclient.request_id
-		if (daapclient._old_itunes):
+			'Client-DAAP-Request-ID': requestId,
+		})
+		if (self._old_itunes):
 			headers[ 'Client-DAAP-Validation' ] = daap.hash_v2(r, 2)
 		else:
 			headers[ 'Client-DAAP-Validation' ] = daap.hash_v3(r, 2, \
-				daapclient.request_id)
-		# there are servers that don't allow >1 download from a single HTTP
-		# session, or something. Reset the connection each time. Thanks to
-		# Fernando Herrera for this one.
-		daapclient.socket.close()
-		daapclient.socket.connect()
-		try:
-			daapclient.socket.request('GET', r, None, headers)
-		except CannotSendRequest, e:
-			logger.error("Error sending request : %s"%e);
-		response    = daapclient.socket.getresponse()
-		return response
-	
+				requestId)
+		return r, headers
+
+	def fetchRange(self, r, params, offset, length, priority=INTERACTIVE):
+		"""Returns length bytes from offset of the file at r, fetched over
+		a connection from self.pool in the given transfer class.
+
+		Connections are kept open between requests when the server allows
+		it.  Some servers don't allow >1 download from a single HTTP
+		session, so a request that fails is retried once on a new
+		connection.
+		"""
+		range = {'Range' : 'bytes=%d-%d'%(offset, offset+length-1)}
+		for attempt in (1, 2):
+			path, headers = self._requestHeaders(r, params,
+				self.nextRequestId(), range)
+			connection = self.pool.get(priority, length)
+			try:
+				connection.request('GET', path, None, headers)
+				response = connection.getresponse()
+				data = response.read()
+			except (httplib.HTTPException, socket.error), e:
+				self.pool.put(connection, False)
+				if attempt == 2:
+					raise IOError("Could not fetch %s: %s"%(r, e))
+				continue
+			self.pool.put(connection, not response.will_close)
+			break
+		if response.status == 200: # the server ignored the range
+			return data[offset:offset+length]
+		elif response.status != 206:
+			raise IOError("Could not fetch %s: HTTP %d"%(r, response.status))
+		return data
+
 
 
 class DirSupervisor(object):
@@ -364,6 +2055,19 @@ class DirSupervisor(object):
 			self.__fsRoot.addChild(localRoot)
 			return LocalDirManager(localRoot)
 	
+	def addVirtualFile(self, path, generate):
+		"""Adds a VirtualFile at path, made by generate(), creating its
+		directories as needed.  They are outside of any lease, so they
+		should start with a '.'."""
+		folders = path.strip('/').split('/')
+		name = folders.pop()
+		curdir = self.__fsRoot
+		for f in folders:
+			if not curdir.children.has_key(f):
+				curdir.addChild(DirInode(f))
+			curdir = curdir.children[f]
+		curdir.addChild(VirtualFile(name, generate))
+
 	def fetchInode(self, path):
 		"""Returns the Inode for the given path, or None if not found."""
 		if path == '/':
@@ -419,7 +2123,7 @@ class LocalDirManager(object):
 					e.errno = errno.ENOENT
 					raise e
 			else:
-				newdir = DirInode(f)
+				newdir = DirInode(nameTable.intern(f))
 				curdir.addChild(newdir)
 				curdir = newdir
 		return curdir
@@ -496,8 +2200,11 @@ class HostDirHandler(object):
 		self.dirMan = directoryManager
 
 	def newHost(self, host, songs):
+		self.addSongs(host, songs)
+
+	def addSongs(self, host, songs):
 		for song in songs: 
-			trackNumber = song.atom.getAtom('astn') #get track-number
+			trackNumber = song.trackNumber
 			if trackNumber is not None:
 				fileName = "%s-%s-%02d-%s.%s" % (song.artist, song.album,\
 				int(trackNumber), song.name, song.type)
@@ -506,12 +2213,14 @@ class HostDirHandler(object):
 				song.name, song.type)
 			fileName = _getCleanName(fileName)
 			putDir = self.dirMan.mkDir("/%s/%s/%s"% \
-				(host, _getCleanName(song.artist),
-					_getCleanName(song.album)))
+				(host, nameTable.clean(song.artist),
+					nameTable.clean(song.album)))
 			if not putDir.children.has_key(fileName):
 				songNode = SongInode(fileName, song.size, song=song)
 				putDir.addChild(songNode)
-				logger.info("Add %s/%s/%s"%(host, putDir.name, songNode.name))
+				trackLog.log("Add %s/%s/%s", host, putDir.name, songNode.name)
+	def hostListed(self, host):
+		pass
 	def delHost(self, host):
 		self.dirMan.rrmInode("/%s"%host)
 
@@ -531,9 +2240,13 @@ class ArtistDirHandler(object):
 		self.dirMan = directoryManager
 
 	def newHost(self, host, songs):
-		sngList = []
+		self.hosts[host] = []
+		self.addSongs(host, songs)
+
+	def addSongs(self, host, songs):
+		sngList = self.hosts[host]
 		for song in songs: 
-			trackNumber = song.atom.getAtom('astn')
+			trackNumber = song.trackNumber
 			if trackNumber is not None:
 				fileName = "%02d-%s.%s"%(int(trackNumber), song.name, song.type)
 			else:
@@ -541,13 +2254,13 @@ class ArtistDirHandler(object):
 
 			fileName = _getCleanName(fileName)
 			directory = "/%s/%s"% \
-				(_getCleanName(song.artist), _getCleanName(song.album))
+				(nameTable.clean(song.artist), nameTable.clean(song.album))
 			putDir = self.dirMan.mkDir(directory)
 			if not putDir.children.has_key(fileName):
 				songNode = SongInode(fileName, song.size, song=song)
 				putDir.addChild(songNode)
-				logger.info("art: Add %s/%s/%s"%\
-					(host, putDir.name, songNode.name))
+				trackLog.log("art: Add %s/%s/%s", host, putDir.name,
+					songNode.name)
 				sngList.append("%s/%s"%(directory, fileName))
 			else:
 				#song already here by other host 
@@ -556,10 +2269,12 @@ class ArtistDirHandler(object):
 				if not putDir.children.has_key(fileName):
 					songNode = SongInode(fileName, song.size, song=song)
 					putDir.addChild(songNode)
-					logger.info("Add %s/%s/%s"%\
-						(host, putDir.name, songNode.name))
+					trackLog.log("art: Add %s/%s/%s", host, putDir.name,
+						songNode.name)
 					sngList.append("%s/%s"%(directory, fileName))
-		self.hosts[host] = sngList
+
+	def hostListed(self, host):
+		pass
 
 	def delHost(self, host):
 		if host in self.hosts:
@@ -567,6 +2282,34 @@ class ArtistDirHandler(object):
 			map(self.dirMan.rrmInode, sngList)
 
 
+
+class PinHandler(object):
+	"""Keeps the pins of a DaapFS in step with hosts coming and going.
+	Pinned paths are pinned again once a host's tracks are listed, once
+	per listing rather than per chunk of it, so that pins last across
+	reconnects, and a host's tracks are dropped from the cache when it
+	leaves, since they can't be read or unpinned through the filesystem
+	any more.  Added after the directory handlers, so the tracks are in
+	the tree when it sees them."""
+	def __init__(self, fs):
+		self.fs = fs
+		self.tables = {} # host -> TrackTable of its tracks
+
+	def newHost(self, host, songs):
+		self.tables[host] = songs[0].table
+
+	def addSongs(self, host, songs):
+		pass
+
+	def hostListed(self, host):
+		self.fs.repin()
+
+	def delHost(self, host):
+		table = self.tables.pop(host, None)
+		if table is not None:
+			self.fs.dropSongs(lambda song: song.table is table)
+
+
 		
 def _cleanStripName(name):
 	"""Returns a filesystem friendly name for a host."""
@@ -576,6 +2319,145 @@ def _cleanStripName(name):
 		cleanName = 'no_name'
 	return cleanName
 	
+def _fastestAddress(addresses, port, timeout=2.0):
+	"""Returns the address from the list that accepts a TCP connection
+	on port first, or None if none of them do within timeout seconds.
+
+	All of the addresses are tried at once, so an unreachable address
+	(e.g. an IPv6 address on a routed path) does not hold up a good one.
+	Returns as soon as one connects or all of them have failed.
+	"""
+	if len(addresses) < 2:
+		if addresses:
+			return addresses[0]
+		return None
+	result = []
+	failed = []
+	lock = threading.Lock()
+	found = threading.Event() # set once one connects or all have failed
+	def probe(address):
+		try:
+			s = socket.create_connection((address, port), timeout)
+			s.close()
+		except (socket.error, socket.timeout):
+			lock.acquire()
+			failed.append(address)
+			if len(failed) == len(addresses):
+				found.set()
+			lock.release()
+			return
+		result.append(address)
+		found.set()
+	for address in addresses:
+		t = threading.Thread(target=probe, args=(address,))
+		t.setDaemon(True)
+		t.start()
+	found.wait(timeout)
+	if result:
+		return result[0]
+	return None
+
+def _readFully(f, length):
+	"""Returns length bytes read from f, raising IOError if it ends
+	first."""
+	chunks = []
+	while length > 0:
+		chunk = f.read(length)
+		if not chunk:
+			raise IOError("DMAP data ended %d bytes early"%length)
+		chunks.append(chunk)
+		length -= len(chunk)
+	return ''.join(chunks)
+
+def _readAtomHeader(f):
+	"""Returns the code and length of the next DMAP atom in f."""
+	header = _readFully(f, 8)
+	return header[:4], struct.unpack('!I', header[4:])[0]
+
+class _GzipReader(object):
+	"""Reads gzip compressed data from a file as it is uncompressed."""
+	def __init__(self, f):
+		self.f = f
+		self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		self.buffer = ''
+		self.offset = 0 # of the unread data in buffer
+
+	def read(self, length):
+		if self.offset + length > len(self.buffer):
+			chunks = [self.buffer[self.offset:]]
+			available = len(chunks[0])
+			while available < length:
+				data = self.f.read(16384)
+				if not data:
+					chunks.append(self.decompressor.flush())
+					break
+				chunks.append(self.decompressor.decompress(data))
+				available += len(chunks[-1])
+			self.buffer = ''.join(chunks)
+			self.offset = 0
+		data = self.buffer[self.offset:self.offset+length]
+		self.offset += len(data)
+		return data
+
+_intFormats = {1: '!B', 2: '!H', 4: '!I', 8: '!Q'}
+
+def _decodeItem(item):
+	"""Returns a dictionary of the fields in an mlit atom that are in
+	fieldCodes, by DMAP code.  Strings are decoded from UTF-8."""
+	fields = {}
+	offset = 8
+	end = len(item)
+	while offset + 8 <= end:
+		code = item[offset:offset+4]
+		length = struct.unpack('!I', item[offset+4:offset+8])[0]
+		offset += 8
+		if code in stringCodes:
+			fields[code] = item[offset:offset+length].decode('utf-8', 'replace')
+		elif code in intCodes and length in _intFormats:
+			fields[code] = struct.unpack(_intFormats[length],
+				item[offset:offset+length])[0]
+		offset += length
+	return fields
+
+def _iterListing(f):
+	"""Yields each mlit atom of the adbs listing read from f, header
+	included, reading no more of f than the atom."""
+	code, length = _readAtomHeader(f)
+	if code != 'adbs':
+		raise IOError("Expected a DMAP listing, got %r"%code)
+	while length > 0:
+		code, size = _readAtomHeader(f)
+		length -= 8 + size
+		if code != 'mlcl':
+			_readFully(f, size)
+			continue
+		while size > 0:
+			code, itemSize = _readAtomHeader(f)
+			size -= 8 + itemSize
+			item = _readFully(f, itemSize)
+			if code == 'mlit':
+				yield code + struct.pack('!I', itemSize) + item
+
+def _threadStats():
+	"""Returns a dictionary of the number of threads, in all and by
+	name with the digits taken out, e.g. 'threads Thread-'."""
+	threads = threading.enumerate()
+	result = {'threads': len(threads)}
+	for thread in threads:
+		name = 'threads %s'%thread.getName().rstrip('0123456789')
+		result[name] = result.get(name, 0) + 1
+	return result
+
+def _joinAll(threads, deadline=None):
+	"""Waits for threads to finish until deadline, a time.time(), or for
+	as long as they take if None.  Returns those still running."""
+	for thread in threads:
+		if deadline is None:
+			thread.join()
+		else:
+			thread.join(max(0, deadline - time.time()))
+	return [t for t in threads if t.isAlive()]
+
 def _getCleanName(name):
 	"""Returns a filesystem friendly string.
 	
@@ -595,25 +2477,42 @@ def main():
 	usage = """Fusedaap :""" + fuse.Fuse.fusage
 	server = DaapFS()
 	server.fuse_args.setmod('foreground')
-	server.parse(errex=1)
+	server.parser.add_option(mountopt="servicecache", metavar="PATH",
+		help="remember resolved shares in PATH across mounts")
+	server.parser.add_option(mountopt="cachesize", metavar="MB",
+		help="memory for cached track data [default: %default]")
+	server.parser.add_option(mountopt="pinsize", metavar="MB",
+		help="most memory for pinned tracks [default: %default]")
+	server.parser.add_option(mountopt="readahead", metavar="KB",
+		help="track data to fetch ahead of a read [default: %default]")
+	server.parser.add_option(mountopt="segments", metavar="N",
+		help="split large fetches into N parallel requests [default: %default]")
+	server.parser.add_option(mountopt="maxconnections", metavar="N",
+		help="connections to use per share [default: %default]")
+	server.parser.add_option(mountopt="bandwidth", metavar="KB",
+		help="bandwidth to use per share in KB/s, 0 for no limit [default: %default]")
+	server.parser.add_option(mountopt="prefetch", metavar="N",
+		help="also prefetch the next N tracks of an album [default: %default]")
+	server.parser.add_option(mountopt="profile", metavar="SECONDS",
+		help="time filesystem operations and DAAP requests, shown in "
+		"/.stats/profile and logged every SECONDS (0 for never)")
+	server.parser.add_option(mountopt="eventlog", metavar="PATH",
+		help="log events to PATH as JSON, one a line")
+	server.parser.add_option(mountopt="shutdowntimeout", metavar="SECONDS",
+		help="time to disconnect from shares in when unmounted "
+		"[default: %default]")
+	server.parse(values=server, errex=1)
+	if server.eventlog is not None:
+		enableEventLog(server.eventlog)
 	server.multithreaded = True
-	hostMan = HostManager()
-	hdh = HostDirHandler(server.dirSup.requestDirLease("/hosts"))
-	hostMan.addHandler(hdh)
-	adh = ArtistDirHandler(server.dirSup.requestDirLease("/artists"))
-	hostMan.addHandler(adh)
-	r = Zeroconf.Zeroconf()
-	r.addServiceListener(daapZConfType, hostMan)
+	server.setup()
 	try:
 		server.main() # main loop
 	except:
 		print 'Exiting . . .'
-		r.close()
-		return
 	logger.info("closing zeroconf in main")
 	print "Disconnecting from services . . ."
-	r.close() # close zeroconf first so no new servers are connected to
-	hostMan.closeAllConnections() 
+	server.shutdown()
 	
 
 
@@ -28,8 +28,19 @@ __author__ = "Peter Sanford"
 __email__ = "peter dot sanford at wheaton dot edu"
 __version__ = "0.2.1"
 
+import BaseHTTPServer
+import SocketServer
 import fusedaap
+import json
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 
 
 class Test_getCleanName(unittest.TestCase):
@@ -246,7 +257,1331 @@ class Test_DirSupervisor_fetchInode(unittest.TestCase):
 		self.assertEquals(node, None)
 
 
-		
+
+class Test_fastestAddress(unittest.TestCase):
+	def setUp(self):
+		self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.server.bind(('127.0.0.1', 0))
+		self.server.listen(5)
+		self.port = self.server.getsockname()[1]
+
+	def tearDown(self):
+		self.server.close()
+
+	def test_fastestAddressReachable(self):
+		"""_fastestAddress should return the address that accepts a
+		connection."""
+		self.assertEqual('127.0.0.1', fusedaap._fastestAddress(
+			['127.0.0.2', '127.0.0.1'], self.port))
+
+	def test_fastestAddressNoneReachable(self):
+		"""_fastestAddress should return None if no address accepts a
+		connection."""
+		self.server.close()
+		start = time.time()
+		self.assertEqual(None, fusedaap._fastestAddress(
+			['127.0.0.2', '127.0.0.1'], self.port, 5))
+		self.assert_(time.time() - start < 1) # refused, not timed out
+
+	def test_fastestAddressSingle(self):
+		"""_fastestAddress should not probe a single address."""
+		self.assertEqual('10.0.0.1', fusedaap._fastestAddress(
+			['10.0.0.1'], self.port))
+
+
+class Test_ServiceCache(unittest.TestCase):
+	name = 'music._daap._tcp.local.'
+
+	def setUp(self):
+		fd, self.path = tempfile.mkstemp()
+		os.close(fd)
+		os.remove(self.path)
+
+	def tearDown(self):
+		if os.path.exists(self.path):
+			os.remove(self.path)
+
+	def test_getCached(self):
+		"""ServiceCache.get should return a service until it expires."""
+		cache = fusedaap.ServiceCache()
+		cache.put(self.name, ['10.0.0.1'], 3689, time.time() + 60)
+		cache.put('old', ['10.0.0.2'], 3689, time.time() - 1)
+		self.assertEqual((['10.0.0.1'], 3689), cache.get(self.name))
+		self.assertEqual(None, cache.get('old'))
+		self.assertEqual(None, cache.get('missing'))
+
+	def test_remove(self):
+		"""ServiceCache.remove should forget a service."""
+		cache = fusedaap.ServiceCache()
+		cache.put(self.name, ['10.0.0.1'], 3689, time.time() + 60)
+		cache.remove(self.name)
+		self.assertEqual(None, cache.get(self.name))
+
+	def test_persist(self):
+		"""A ServiceCache with a path should load what an earlier one saved,
+		leaving out expired services."""
+		cache = fusedaap.ServiceCache(self.path, saveDelay=0.05)
+		cache.put(self.name, ['10.0.0.1', 'fe80::1%2'], 3689, time.time() + 60)
+		cache.put('soon', ['10.0.0.2'], 3689, time.time() + 0.1)
+		time.sleep(0.2)
+		cache = fusedaap.ServiceCache(self.path)
+		self.assertEqual((['10.0.0.1', 'fe80::1%2'], 3689), cache.get(self.name))
+		self.assertEqual({}, dict([(k, v) for k, v in cache.services.items()
+			if k != self.name]))
+
+	def test_saveLater(self):
+		"""ServiceCache.put should not write the file itself, but leave
+		that to one save after saveDelay, or to save()."""
+		cache = fusedaap.ServiceCache(self.path, saveDelay=0.1)
+		cache.put(self.name, ['10.0.0.1'], 3689, time.time() + 60)
+		cache.put('other', ['10.0.0.2'], 3689, time.time() + 60)
+		self.assertFalse(os.path.exists(self.path))
+		timer = cache.saveTimer
+		timer.join(1)
+		self.assertTrue(os.path.exists(self.path))
+		self.assertEqual(2, len(fusedaap.ServiceCache(self.path).services))
+		self.assertEqual(None, cache.saveTimer)
+		cache = fusedaap.ServiceCache(self.path, saveDelay=60)
+		cache.remove(self.name)
+		timer = cache.saveTimer
+		cache.save()
+		self.assertEqual(None, cache.saveTimer)
+		self.assertTrue(timer.finished.isSet()) # cancelled
+		self.assertEqual(1, len(fusedaap.ServiceCache(self.path).services))
+
+	def test_corruptFile(self):
+		"""ServiceCache should start empty if its file is unreadable."""
+		f = open(self.path, 'w')
+		f.write('not a pickle')
+		f.close()
+		cache = fusedaap.ServiceCache(self.path)
+		self.assertEqual(None, cache.get(self.name))
+
+
+class FakeSong(object):
+	"""A track whose fetchRange() serves bytes from memory."""
+	def __init__(self, size, delay=0):
+		self.data = ''.join([chr(i % 251) for i in range(size)])
+		self.delay = delay
+		self.calls = []
+		self.priorities = []
+		self.running = 0
+		self.mostRunning = 0
+		self.lock = threading.Lock()
+
+	def fetchRange(self, offset, length, priority=fusedaap.INTERACTIVE):
+		self.lock.acquire()
+		self.calls.append((offset, length))
+		self.priorities.append(priority)
+		self.running += 1
+		self.mostRunning = max(self.mostRunning, self.running)
+		self.lock.release()
+		time.sleep(self.delay)
+		self.lock.acquire()
+		self.running -= 1
+		self.lock.release()
+		return self.data[offset:offset+length]
+
+
+class FakeTrack(FakeSong):
+	"""A FakeSong with the fields the directory handlers use, and the
+	table of the host it comes from."""
+	def __init__(self, table, name, size, delay=0):
+		FakeSong.__init__(self, size, delay)
+		self.table = table
+		self.name = name
+		self.artist = 'artist'
+		self.album = 'album'
+		self.type = 'mp3'
+		self.trackNumber = None
+		self.size = size
+
+
+class FailingSong(FakeSong):
+	"""A FakeSong whose first fetches fail."""
+	def __init__(self, size, failures):
+		FakeSong.__init__(self, size)
+		self.failures = failures
+
+	def fetchRange(self, offset, length, priority=fusedaap.INTERACTIVE):
+		if self.failures:
+			self.failures -= 1
+			raise IOError("lost")
+		return FakeSong.fetchRange(self, offset, length, priority)
+
+
+class Test_Inode(unittest.TestCase):
+	def test_defaults(self):
+		"""Inodes should share the mount's owner and times rather than
+		each holding their own."""
+		song = fusedaap.SongInode('song', 1234)
+		directory = fusedaap.DirInode('dir')
+		self.assertEqual(os.getuid(), song.st_uid)
+		self.assertEqual(directory.st_mtime, song.st_mtime)
+		for name in ('st_uid', 'st_gid', 'st_atime', 'st_mtime', 'st_ctime'):
+			self.assert_(name not in song.__dict__, name)
+
+	def test_getattr(self):
+		"""DaapFS.getattr should answer with the inode itself."""
+		fs = fusedaap.DaapFS()
+		manager = fs.dirSup.requestDirLease('/hosts')
+		song = fusedaap.SongInode('song', 1234)
+		manager.mkDir('/host').addChild(song)
+		stat = fs.getattr('/hosts/host/song')
+		self.assert_(stat is song)
+		self.assertEqual(1234, stat.st_size)
+		self.assertEqual(fusedaap.stat.S_IFREG | 0444, stat.st_mode)
+		self.assertEqual(2, fs.getattr('/').st_nlink)
+		self.assertEqual(-fusedaap.errno.ENOENT, fs.getattr('/hosts/none'))
+
+
+class Test_Profiler(unittest.TestCase):
+	def test_instrument(self):
+		"""Instrumented methods should be timed, and their errors and the
+		bytes they read counted."""
+		class Target(object):
+			def read(self, size):
+				return 'x' * size
+			def open(self, path):
+				if path == 'missing':
+					return -fusedaap.errno.ENOENT
+				if path == 'broken':
+					raise IOError(path)
+			def readdir(self, path):
+				yield '.'
+				yield '..'
+		target = Target()
+		profiler = fusedaap.Profiler()
+		for method in ('read', 'open', 'readdir'):
+			profiler.instrument(target, method)
+		self.assertEqual('xxx', target.read(3))
+		target.read(5)
+		target.open('here')
+		target.open('missing')
+		self.assertRaises(IOError, target.open, 'broken')
+		self.assertEqual(['.', '..'], target.readdir('/'))
+		stats = profiler.stats.snapshot()
+		self.assertEqual(2, stats['op.read.ms']['count'])
+		self.assertEqual(8, stats['op.read.bytes'])
+		self.assertEqual(2, stats['op.open.ms']['count'])
+		self.assertEqual(2, stats['op.open.errors'])
+		self.assertEqual(1, stats['op.readdir.ms']['count'])
+
+	def test_report(self):
+		"""The report should include the block cache's hit ratio."""
+		profiler = fusedaap.Profiler()
+		profiler.stats.incr('cache.hits', 3)
+		profiler.stats.incr('cache.misses')
+		self.assert_('cache.hitRatio: 0.750\n' in profiler.report())
+
+
+class Test_VirtualFile(unittest.TestCase):
+	def setUp(self):
+		self.fs = fusedaap.DaapFS()
+		self.contents = ['first\n']
+		self.fs.dirSup.addVirtualFile('/.stats/test', lambda: self.contents[0])
+
+	def test_read(self):
+		"""A virtual file should be made afresh for each getattr and
+		read."""
+		self.assertEqual(6, self.fs.getattr('/.stats/test').st_size)
+		self.assertEqual('first\n', self.fs.read('/.stats/test', 4096, 0))
+		self.contents[0] = 'second\n'
+		self.assertEqual(7, self.fs.getattr('/.stats/test').st_size)
+		self.assertEqual('cond\n', self.fs.read('/.stats/test', 4096, 2))
+		self.assert_(self.fs.open('/.stats/test', os.O_RDONLY).direct_io)
+		self.assertEqual(['.', '..', 'test'],
+			[e.name for e in self.fs.readdir('/.stats', 0)])
+
+	def test_notSong(self):
+		"""A virtual file should not be pinned, or leased out."""
+		self.assertEqual(-fusedaap.errno.ENOTSUP, self.fs.setxattr(
+			'/.stats/test', fusedaap.DaapFS.pinAttr, '1', 0))
+		self.assertEqual(-fusedaap.errno.ENODATA, self.fs.getxattr(
+			'/.stats/test', fusedaap.DaapFS.pinAttr, 0))
+		self.fs.pin('/')
+		self.assertRaises(Exception, self.fs.dirSup.requestDirLease, '/.stats')
+
+
+class Test_DaapFS_stats(unittest.TestCase):
+	def setUp(self):
+		self.fs = fusedaap.DaapFS()
+		self.hostMan = fusedaap.HostManager()
+		class FakeZeroconf(object):
+			def getStats(self):
+				return {'cache.size': 12}
+		self.hostMan.zeroconf = FakeZeroconf()
+		self.fs.addStatsFiles(self.hostMan)
+
+	def test_files(self):
+		"""/.stats should list its files, each made when read."""
+		self.assertEqual(['cache', 'hosts', 'threads', 'zeroconf'],
+			sorted(self.fs.dirSup.fetchInode('/.stats').children.keys()))
+		self.assertEqual('cache.size: 12\n',
+			self.fs.read('/.stats/zeroconf', 4096, 0))
+		self.assert_('threads MainThread: 1\n' in
+			self.fs.read('/.stats/threads', 4096, 0))
+		self.fs.blockCache.put((FakeSong(10), 0), 'x' * 10)
+		self.assert_('cache.bytes: 10\n' in
+			self.fs.read('/.stats/cache', 4096, 0))
+
+	def test_hosts(self):
+		"""/.stats/hosts should show each connected host's tracks and
+		connections."""
+		pool = fusedaap.ConnectionPool('10.0.0.2', 3689, 2)
+		pool.get()
+		class session(object):
+			class connection(object):
+				pass
+		session.connection.pool = pool
+		name = 'music.' + fusedaap.daapZConfType
+		self.hostMan.connectedSessions[name] = session
+		self.hostMan.allHosts.append(name)
+		self.hostMan.trackCounts['music'] = 1500
+		text = self.fs.read('/.stats/hosts', 4096, 0)
+		for line in ('address music: 10.0.0.2:3689', 'tracks music: 1500',
+			'connections.active music: 1', 'connections.waiting music: 0',
+			'hosts: 1', 'services: 1'):
+			self.assert_(line + '\n' in text, line)
+
+
+class Counted(object):
+	"""Counts how often it is formatted."""
+	formatted = 0
+	def __str__(self):
+		Counted.formatted += 1
+		return 'counted'
+
+
+class Test_logging(unittest.TestCase):
+	def setUp(self):
+		self.level = fusedaap.logger.level
+		self.path = tempfile.mktemp()
+		self.handler = fusedaap.EventLogHandler(self.path)
+		Counted.formatted = 0
+
+	def tearDown(self):
+		fusedaap.logger.removeHandler(self.handler)
+		fusedaap.logger.setLevel(self.level)
+		self.handler.close()
+		os.remove(self.path)
+
+	def test_disabled(self):
+		"""Nothing should be formatted while logging is off."""
+		fusedaap.logger.setLevel(fusedaap.logging.WARNING)
+		log = fusedaap.SampledLog()
+		for i in range(100):
+			log.log("Add %s", Counted())
+		self.assertEqual(0, Counted.formatted)
+
+	def test_sampled(self):
+		"""SampledLog should log at most rate messages a second, and say
+		how many it skipped."""
+		fusedaap.logger.addHandler(self.handler)
+		fusedaap.logger.setLevel(fusedaap.logging.DEBUG)
+		log = fusedaap.SampledLog(rate=3)
+		for i in range(10):
+			log.log("Add %s %d", Counted(), i)
+		log.second -= 1 # as if a second went by
+		log.log("Add %s %d", Counted(), 10)
+		self.handler.flush()
+		events = [json.loads(l) for l in open(self.path)]
+		self.assertEqual(4, Counted.formatted)
+		self.assertEqual(['Add counted 0', 'Add counted 1', 'Add counted 2',
+			'Add counted 10 (7 similar skipped)'],
+			[e['message'] for e in events])
+
+	def test_events(self):
+		"""Event log lines should be JSON with the message template and
+		arguments."""
+		fusedaap.logger.addHandler(self.handler)
+		fusedaap.logger.setLevel(fusedaap.logging.DEBUG)
+		fusedaap.logger.info("Listed %d tracks from %s", 500, u'host')
+		try:
+			raise IOError('lost')
+		except IOError:
+			fusedaap.logger.exception("Could not read %s", '/a')
+		self.handler.flush()
+		first, second = [json.loads(l) for l in open(self.path)]
+		self.assertEqual('Listed %d tracks from %s', first['event'])
+		self.assertEqual([500, 'host'], first['args'])
+		self.assertEqual('INFO', first['level'])
+		self.assertEqual('Listed 500 tracks from host', first['message'])
+		self.assert_('IOError: lost' in second['exception'])
+
+
+class Test_DaapFS_startup(unittest.TestCase):
+	def test_discoverAfterMount(self):
+		"""The filesystem should be usable before discovery has started,
+		and stopping discovery should wait for it to start."""
+		fs = fusedaap.DaapFS()
+		fs.servicecache = '/nonexistent/services'
+		hostMan = fs.setup()
+		self.assertEqual(None, hostMan.zeroconf)
+		self.assertEqual(['.', '..', '.stats', 'artists', 'hosts'],
+			sorted([e.name for e in fs.readdir('/', 0)]))
+		started = threading.Event()
+		release = threading.Event()
+		paths = []
+		def discover(path):
+			paths.append(path)
+			started.set()
+			release.wait(5)
+		hostMan.discover = discover
+		fs.fsinit()
+		started.wait(5)
+		self.assertEqual(['/nonexistent/services'], paths)
+		self.assertEqual({}, hostMan.getZeroconfStats())
+		threading.Timer(0.1, release.set).start()
+		start = time.time()
+		hostMan.stopDiscovery()
+		self.assert_(time.time() - start >= 0.05)
+		self.failIf(hostMan.discovery.isAlive())
+
+
+class StalledHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""Reads a request and does not answer it until server.release is
+	set."""
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		self.server.stalled.set()
+		self.server.release.wait(5)
+
+
+class StuckSession(object):
+	"""A session whose host does not answer its logout."""
+	def __init__(self, pool, release, loggedOut):
+		self.connection = fusedaap.AdvancedDAAPClient()
+		self.connection.pool = pool
+		self.release = release
+		self.loggedOut = loggedOut
+
+	def logout(self):
+		self.loggedOut.append(self)
+		self.release.wait(5)
+
+
+class Test_shutdown(unittest.TestCase):
+	def setUp(self):
+		self.server = SocketServer.ThreadingTCPServer(('127.0.0.1', 0),
+			StalledHandler)
+		self.server.daemon_threads = True
+		self.server.stalled = threading.Event()
+		self.server.release = threading.Event()
+		threading.Thread(target=self.server.serve_forever).start()
+		self.pool = fusedaap.ConnectionPool('127.0.0.1',
+			self.server.server_address[1], 2)
+		self.loggedOut = []
+
+	def tearDown(self):
+		self.server.release.set()
+		self.server.shutdown()
+		self.server.server_close()
+
+	def addSessions(self, hostMan, count):
+		for i in range(count):
+			hostMan.connectedSessions['host%d'%i] = StuckSession(self.pool,
+				self.server.release, self.loggedOut)
+
+	def test_abortFetch(self):
+		"""Closing a pool with abort should fail the fetches in flight
+		straight away."""
+		client = fusedaap.AdvancedDAAPClient()
+		client.pool = self.pool
+		errors = []
+		def fetch():
+			try:
+				client.fetchRange('/databases/1/items/1.mp3',
+					{'session-id': 1}, 0, 1000)
+			except IOError, e:
+				errors.append(e)
+		t = threading.Thread(target=fetch)
+		t.start()
+		self.server.stalled.wait(2)
+		start = time.time()
+		self.pool.close(abort=True)
+		t.join(2)
+		self.failIf(t.isAlive())
+		self.assert_(time.time() - start < 1)
+		self.assertEqual(1, len(errors))
+		self.assertEqual(0, self.pool.active)
+
+	def test_closeAllConnections(self):
+		"""Hosts should be logged out of at once, waiting no longer than
+		the timeout for them."""
+		hostMan = fusedaap.HostManager()
+		self.addSessions(hostMan, 3)
+		start = time.time()
+		running = hostMan.closeAllConnections(0.2)
+		self.assert_(time.time() - start < 1)
+		self.assertEqual(3, len(running))
+		self.assertEqual(3, len(self.loggedOut))
+		self.assertEqual({}, hostMan.connectedSessions)
+		self.assert_(self.pool.closed)
+		self.server.release.set()
+		self.assertEqual([], fusedaap._joinAll(running, time.time() + 2))
+
+	def test_daapFS(self):
+		"""DaapFS.shutdown() should finish within its timeout and return
+		how long each step took."""
+		fs = fusedaap.DaapFS()
+		fs.shutdowntimeout = 0.2
+		hostMan = fs.setup()
+		self.addSessions(hostMan, 2)
+		timings = fs.shutdown()
+		self.assertEqual(['connections', 'discovery', 'threads', 'total'],
+			sorted(timings.keys()))
+		self.assert_(timings['total'] < 1, timings)
+		self.assertEqual(2, len(self.loggedOut))
+
+
+class Test_HostManager_discovery(unittest.TestCase):
+	def test_stopWhileStarting(self):
+		"""Zeroconf should be closed if it is made after discovery was
+		stopped."""
+		release = threading.Event()
+		made = []
+		class SlowZeroconf(object):
+			def __init__(self):
+				release.wait(5)
+				self.closed = False
+				made.append(self)
+			def addServiceListener(self, type, listener):
+				pass
+			def close(self, timeout=1.0):
+				self.closed = True
+		hostMan = fusedaap.HostManager()
+		original = fusedaap.Zeroconf.Zeroconf
+		fusedaap.Zeroconf.Zeroconf = SlowZeroconf
+		try:
+			hostMan.startDiscovery()
+			hostMan.stopDiscovery(0.05)
+			release.set()
+			hostMan.discovery.join(2)
+		finally:
+			fusedaap.Zeroconf.Zeroconf = original
+		self.assertEqual(None, hostMan.zeroconf)
+		self.assert_(made[0].closed)
+
+
+class Test_BlockCache(unittest.TestCase):
+	def test_evictLeastRecentlyUsed(self):
+		"""BlockCache should evict the least recently used blocks once it
+		holds more than maxBytes."""
+		cache = fusedaap.BlockCache(30)
+		cache.put('a', 'x' * 10)
+		cache.put('b', 'x' * 10)
+		cache.put('c', 'x' * 10)
+		cache.get('a')
+		cache.put('d', 'x' * 10)
+		self.assertEqual(None, cache.get('b'))
+		self.assertEqual('x' * 10, cache.get('a'))
+		self.assertEqual(3, len(cache))
+		self.assertEqual(30, cache.bytes)
+
+	def test_replace(self):
+		"""Putting a cached block again should replace it."""
+		cache = fusedaap.BlockCache(100)
+		cache.put('a', 'x' * 10)
+		cache.put('a', 'y' * 20)
+		self.assertEqual('y' * 20, cache.get('a'))
+		self.assertEqual(20, cache.bytes)
+
+
+class Test_BlockCache_pin(unittest.TestCase):
+	def test_pinnedNotEvicted(self):
+		"""Blocks of a pinned song should stay cached, cached before or
+		after it was pinned, and be evictable again once unpinned."""
+		cache = fusedaap.BlockCache(20)
+		cache.put(('a', 0), 'x' * 10)
+		cache.pin('a')
+		cache.put(('a', 1), 'x' * 10)
+		for i in range(5):
+			cache.put(('b', i), 'y' * 10)
+		self.assertEqual('x' * 10, cache.get(('a', 0)))
+		self.assertEqual('x' * 10, cache.get(('a', 1)))
+		self.assertEqual(20, cache.bytes)
+		cache.unpin('a')
+		self.assertEqual(20, cache.bytes)
+		self.assertEqual(0, cache.pinnedBytes)
+		self.assertEqual(2, len(cache))
+
+	def test_drop(self):
+		"""BlockCache.drop should remove the blocks and pins of the songs
+		matched."""
+		cache = fusedaap.BlockCache(40)
+		cache.pin('a', 30)
+		cache.put(('a', 0), 'x' * 10)
+		cache.put(('b', 0), 'y' * 10)
+		cache.put(('c', 0), 'z' * 10)
+		self.assertEqual(30, cache.pinnedSize)
+		cache.drop(lambda song: song in ('a', 'b'))
+		self.assertEqual((10, 0, 0, 1), (cache.bytes, cache.pinnedBytes,
+			cache.pinnedSize, len(cache)))
+		self.failIf(cache.isPinned('a'))
+		cache.put(('d', 0), 'w' * 30) # the heap skips the dropped blocks
+		self.assertEqual(40, cache.bytes)
+
+
+class Test_Fetcher(unittest.TestCase):
+	blockSize = fusedaap.blockSize
+
+	def setUp(self):
+		self.cache = fusedaap.BlockCache()
+		self.fetcher = fusedaap.Fetcher(self.cache, readahead=4*self.blockSize)
+
+	def test_readAcrossBlocks(self):
+		"""Fetcher.read should return the requested bytes wherever they
+		fall, and nothing past the end of the track."""
+		song = FakeSong(3 * self.blockSize + 100)
+		for offset, length in ((0, 10), (self.blockSize - 5, 10),
+			(100, 2 * self.blockSize), (3 * self.blockSize + 90, 4096)):
+			self.assertEqual(song.data[offset:offset+length],
+				self.fetcher.read(song, len(song.data), offset, length))
+		self.assertEqual('', self.fetcher.read(song, len(song.data),
+			len(song.data), 10))
+
+	def test_readahead(self):
+		"""A miss should fetch the readahead window in one request, so
+		that the following sequential reads are served from the cache."""
+		song = FakeSong(8 * self.blockSize)
+		for offset in range(0, 4 * self.blockSize, 4096):
+			self.fetcher.read(song, len(song.data), offset, 4096)
+		self.assertEqual([(0, 4 * self.blockSize)], song.calls)
+		self.fetcher.read(song, len(song.data), 4 * self.blockSize, 4096)
+		self.assertEqual((4 * self.blockSize, 4 * self.blockSize), song.calls[1])
+
+	def test_readaheadStopsAtCachedBlock(self):
+		"""The readahead window should not fetch blocks already cached."""
+		song = FakeSong(8 * self.blockSize)
+		self.fetcher.read(song, len(song.data), 2 * self.blockSize, 1)
+		self.fetcher.read(song, len(song.data), 0, 1)
+		self.assertEqual((0, 2 * self.blockSize), song.calls[1])
+
+	def test_coalesce(self):
+		"""Concurrent reads of overlapping ranges should share one fetch."""
+		song = FakeSong(4 * self.blockSize, delay=0.2)
+		results = {}
+		def read(offset):
+			results[offset] = self.fetcher.read(song, len(song.data), offset, 8192)
+		threads = [threading.Thread(target=read, args=(offset,))
+			for offset in (0, 4096, self.blockSize + 10)]
+		for t in threads:
+			t.start()
+			time.sleep(0.02)
+		for t in threads:
+			t.join()
+		self.assertEqual([(0, 4 * self.blockSize)], song.calls)
+		for offset, data in results.items():
+			self.assertEqual(song.data[offset:offset+8192], data)
+		self.assertEqual(2, self.fetcher.stats.snapshot()['fetch.coalesced'])
+		self.assertEqual({}, self.fetcher.pending)
+
+	def test_coalescedFailure(self):
+		"""Readers waiting on a fetch that fails should fail too."""
+		errors = []
+		def fetchRange(offset, length, priority):
+			time.sleep(0.1)
+			raise IOError("connection reset")
+		song = FakeSong(self.blockSize)
+		song.fetchRange = fetchRange
+		def read():
+			try:
+				self.fetcher.read(song, len(song.data), 0, 10)
+			except IOError, e:
+				errors.append(e)
+		threads = [threading.Thread(target=read) for i in range(2)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEqual(2, len(errors))
+		self.assertEqual({}, self.fetcher.pending)
+
+	def test_segmented(self):
+		"""With segments, a large fetch should be split into parallel
+		range requests and reassembled in order."""
+		self.fetcher.segments = 4
+		self.fetcher.minSegment = self.blockSize
+		song = FakeSong(4 * self.blockSize, delay=0.1)
+		data = self.fetcher.read(song, len(song.data), 0, len(song.data))
+		self.assertEqual(song.data, data)
+		calls = song.calls[:]
+		calls.sort()
+		self.assertEqual([(i * self.blockSize, self.blockSize) for i in range(4)],
+			calls)
+		self.assert_(song.mostRunning > 1)
+
+	def test_segmentFails(self):
+		"""A failed segment should fail the read and cache nothing."""
+		self.fetcher.segments = 2
+		self.fetcher.minSegment = self.blockSize
+		song = FakeSong(2 * self.blockSize)
+		def fetchRange(offset, length, priority):
+			if offset:
+				raise IOError("connection reset")
+			return song.data[offset:offset+length]
+		song.fetchRange = fetchRange
+		self.assertRaises(IOError, self.fetcher.read, song, len(song.data), 0, 10)
+		self.assertEqual(0, len(self.cache))
+
+
+def waitFor(condition, timeout=2.0):
+	end = time.time() + timeout
+	while not condition() and time.time() < end:
+		time.sleep(0.01)
+
+
+class Test_Prefetcher(unittest.TestCase):
+	blockSize = fusedaap.blockSize
+
+	def setUp(self):
+		self.cache = fusedaap.BlockCache(64 * self.blockSize)
+		self.fetcher = fusedaap.Fetcher(self.cache, readahead=2*self.blockSize)
+		self.prefetcher = fusedaap.Prefetcher(self.fetcher)
+
+	def tearDown(self):
+		self.prefetcher.close()
+
+	def cached(self, song):
+		return len([i for i in range(len(song.data) / self.blockSize)
+			if (song, i) in self.cache])
+
+	def test_wholeTrack(self):
+		"""Prefetcher should fetch every block of a track it is given."""
+		song = FakeSong(8 * self.blockSize)
+		self.prefetcher.add(song, len(song.data), fusedaap.Prefetcher.OPEN)
+		waitFor(lambda: self.cached(song) == 8)
+		self.assertEqual(8, self.cached(song))
+		self.assertEqual(4, len(song.calls))
+
+	def test_cancel(self):
+		"""A cancelled prefetch should stop, unless the song is pinned."""
+		song = FakeSong(16 * self.blockSize, delay=0.05)
+		self.prefetcher.add(song, len(song.data), fusedaap.Prefetcher.OPEN)
+		waitFor(lambda: song.calls)
+		self.prefetcher.cancel(song)
+		time.sleep(0.2)
+		self.assert_(self.cached(song) < 16)
+		self.prefetcher.add(song, len(song.data), fusedaap.Prefetcher.PIN)
+		self.prefetcher.cancel(song)
+		waitFor(lambda: self.cached(song) == 16)
+		self.assertEqual(16, self.cached(song))
+
+	def test_retryPinned(self):
+		"""A pinned track that fails to fetch should be tried again."""
+		self.prefetcher.retryDelay = 0.05
+		song = FailingSong(4 * self.blockSize, 2)
+		self.cache.pin(song, len(song.data))
+		self.prefetcher.add(song, len(song.data), fusedaap.Prefetcher.PIN)
+		waitFor(lambda: self.cached(song) == 4)
+		self.assertEqual(4, self.cached(song))
+		self.assertEqual({}, self.prefetcher.failures)
+
+	def test_tooLargeForCache(self):
+		"""An open file's track bigger than a quarter of the cache should
+		not be prefetched."""
+		song = FakeSong(17 * self.blockSize)
+		self.prefetcher.add(song, len(song.data), fusedaap.Prefetcher.OPEN)
+		time.sleep(0.1)
+		self.assertEqual([], song.calls)
+
+
+class Test_DaapFS_prefetch(unittest.TestCase):
+	blockSize = fusedaap.blockSize
+
+	def setUp(self):
+		self.fs = fusedaap.DaapFS()
+		self.fs.prefetchTracks = 1
+		dirMan = self.fs.dirSup.requestDirLease("/hosts")
+		album = dirMan.mkDir("/host/artist/album")
+		self.songs = []
+		for i in range(3):
+			song = FakeSong(2 * self.blockSize)
+			self.songs.append(song)
+			album.addChild(fusedaap.SongInode("%02d.mp3" % i,
+				len(song.data), song=song))
+
+	def tearDown(self):
+		self.fs.prefetcher.close()
+
+	def test_openPrefetchesFollowing(self):
+		"""Opening a track should prefetch it and the next tracks of the
+		album."""
+		self.fs.open("/hosts/host/artist/album/00.mp3", os.O_RDONLY)
+		waitFor(lambda: self.songs[1].calls)
+		self.assertEqual([(0, 2 * self.blockSize)], self.songs[0].calls)
+		self.assertEqual([(0, 2 * self.blockSize)], self.songs[1].calls)
+		self.assertEqual([], self.songs[2].calls)
+
+	def test_bulkReader(self):
+		"""A process opening many tracks should read them as BULK
+		transfers, without prefetching them."""
+		album = self.fs.dirSup.fetchInode("/hosts/host/artist/album")
+		for i in range(self.fs.bulkFiles):
+			song = FakeSong(self.blockSize)
+			album.addChild(fusedaap.SongInode("x%02d.mp3" % i,
+				len(song.data), song=song))
+		self.fs.prefetchTracks = 0
+		names = album.children.keys()
+		names.sort()
+		for name in names:
+			self.fs.open("/hosts/host/artist/album/" + name, os.O_RDONLY)
+		last = album.children[names[-1]]
+		self.assertEqual(fusedaap.BULK, self.fs.songClass(last.song))
+		self.fs.read("/hosts/host/artist/album/" + names[-1], 4096, 0)
+		time.sleep(0.1)
+		self.assertEqual([fusedaap.BULK], last.song.priorities)
+		self.assertEqual(fusedaap.INTERACTIVE,
+			self.fs.songClass(self.songs[0]))
+
+	def test_twoHandles(self):
+		"""A bulk reader opening a track that a player has open should not
+		slow down the player's reads."""
+		path = "/hosts/host/artist/album/00.mp3"
+		player = self.fs.open(path, os.O_RDONLY)
+		album = self.fs.dirSup.fetchInode("/hosts/host/artist/album")
+		for i in range(self.fs.bulkFiles):
+			album.addChild(fusedaap.SongInode("x%02d.mp3" % i,
+				self.blockSize, song=FakeSong(self.blockSize)))
+		self.fs.GetContext = lambda: {'uid': 0, 'gid': 0, 'pid': 2}
+		for i in range(self.fs.bulkFiles):
+			self.fs.open("/hosts/host/artist/album/x%02d.mp3" % i, os.O_RDONLY)
+		copier = self.fs.open(path, os.O_RDONLY)
+		self.assertEqual(fusedaap.INTERACTIVE, player.priority)
+		self.assertEqual(fusedaap.BULK, copier.priority)
+		priorities = []
+		def read(song, size, offset, length, priority):
+			priorities.append(priority)
+			return ''
+		self.fs.fetcher.read = read
+		self.fs.read(path, 4096, 0, player)
+		self.fs.read(path, 4096, 0, copier)
+		self.fs.read(path, 4096, 0)
+		self.assertEqual([fusedaap.INTERACTIVE, fusedaap.BULK,
+			fusedaap.INTERACTIVE], priorities)
+		self.fs.release(path, 0, player)
+		self.assertEqual(fusedaap.BULK, self.fs.songClass(self.songs[0]))
+		self.fs.release(path, 0, copier)
+		self.failIf(self.songs[0] in self.fs.songClasses)
+		self.failIf(self.songs[0] in self.fs.openCounts)
+
+	def test_pinDirectory(self):
+		"""Setting the pinned attribute on a directory should fetch and
+		keep all of its tracks."""
+		path = "/hosts/host/artist"
+		self.assertEqual('0', self.fs.getxattr(path, self.fs.pinAttr, 100))
+		self.fs.setxattr(path, self.fs.pinAttr, '1', 0)
+		self.assertEqual('1', self.fs.getxattr(path, self.fs.pinAttr, 100))
+		waitFor(lambda: self.fs.getxattr(path, self.fs.cachedAttr, 100) == '100')
+		self.assertEqual('100', self.fs.getxattr(path, self.fs.cachedAttr, 100))
+		for song in self.songs:
+			self.assert_(self.fs.blockCache.isPinned(song))
+		self.fs.removexattr(path, self.fs.pinAttr)
+		self.assertEqual('0', self.fs.getxattr(path, self.fs.pinAttr, 100))
+		self.assertEqual(0, self.fs.blockCache.pinnedBytes)
+
+
+class Test_DaapFS_pins(unittest.TestCase):
+	blockSize = fusedaap.blockSize
+	album = '/artists/artist/album'
+
+	def setUp(self):
+		self.fs = fusedaap.DaapFS()
+		self.hostMan = self.fs.setup()
+
+	def tearDown(self):
+		self.fs.prefetcher.close()
+
+	def listHost(self, count=3, chunk=None):
+		"""Lists a host of count tracks of two blocks, with a new table,
+		as when it connects, in chunks of chunk tracks, and returns the
+		tracks."""
+		table = object()
+		tracks = [FakeTrack(table, 't%d'%i, 2 * self.blockSize)
+			for i in range(count)]
+		chunk = chunk or count
+		for start in range(0, count, chunk):
+			for listener in self.hostMan.listeners:
+				if start == 0:
+					listener.newHost('host', tracks[:chunk])
+				else:
+					listener.addSongs('host', tracks[start:start + chunk])
+		for listener in self.hostMan.listeners:
+			listener.hostListed('host')
+		return tracks
+
+	def delHost(self):
+		for listener in self.hostMan.listeners:
+			listener.delHost('host')
+
+	def cached(self):
+		return self.fs.getxattr(self.album, self.fs.cachedAttr, 100)
+
+	def test_limit(self):
+		"""Pinning more than maxPinnedBytes of tracks should fail, without
+		pinning any of them."""
+		self.fs.blockCache.maxPinnedBytes = 3 * self.blockSize
+		self.listHost()
+		self.assertEqual(-fusedaap.errno.ENOSPC,
+			self.fs.setxattr(self.album, self.fs.pinAttr, '1', 0))
+		self.assertEqual('0', self.fs.getxattr(self.album, self.fs.pinAttr, 100))
+		self.assertEqual(0, self.fs.blockCache.pinnedSize)
+		self.assertEqual(None, self.fs.setxattr(self.album + '/t0.mp3',
+			self.fs.pinAttr, '1', 0))
+		self.assertEqual(2 * self.blockSize, self.fs.blockCache.pinnedSize)
+
+	def test_hostLeaves(self):
+		"""A host's tracks should be dropped from the cache when it
+		leaves, and pinned again when it comes back."""
+		self.listHost()
+		self.fs.setxattr(self.album, self.fs.pinAttr, '1', 0)
+		waitFor(lambda: self.cached() == '100')
+		self.assertEqual('100', self.cached())
+		self.delHost()
+		cache = self.fs.blockCache
+		self.assertEqual((0, 0, 0, 0), (len(cache), cache.pinnedBytes,
+			cache.pinnedSize, len(cache.pinned)))
+		tracks = self.listHost()
+		self.assertEqual('1', self.fs.getxattr(self.album, self.fs.pinAttr, 100))
+		waitFor(lambda: self.cached() == '100')
+		self.assertEqual('100', self.cached())
+		for track in tracks:
+			self.assert_(cache.isPinned(track))
+		self.fs.removexattr(self.album, self.fs.pinAttr)
+		self.assertEqual((0, 0), (cache.pinnedSize, len(cache.pinned)))
+
+	def test_repinOncePerListing(self):
+		"""Pinned paths should be pinned again once a listing ends, not
+		for each chunk of it."""
+		self.listHost()
+		self.fs.setxattr(self.album, self.fs.pinAttr, '1', 0)
+		self.delHost()
+		repins = []
+		repin = self.fs.repin
+		def countRepin():
+			repins.append(True)
+			repin()
+		self.fs.repin = countRepin
+		tracks = self.listHost(6, 2)
+		self.assertEqual(1, len(repins))
+		for track in tracks:
+			self.assert_(self.fs.blockCache.isPinned(track))
+
+
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""Serves Range requests of server.data, recording request ids."""
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		requestId = self.headers.getheader('Client-DAAP-Request-ID')
+		self.server.requestIds.append(requestId)
+		if self.headers.getheader('Range') is None: # e.g. /logout
+			self.server.plainRequests.append((requestId,
+				self.headers.getheader('Client-DAAP-Validation')))
+			self.send_response(200)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+		self.server.fetchIds.append(requestId)
+		first, last = self.headers.getheader('Range')[6:].split('-')
+		data = self.server.data[int(first):int(last)+1]
+		self.send_response(206)
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+
+class Test_AdvancedDAAPClient_fetchRange(unittest.TestCase):
+	def setUp(self):
+		self.server = SocketServer.ThreadingTCPServer(('127.0.0.1', 0), RangeHandler)
+		self.server.daemon_threads = True
+		self.server.data = ''.join([chr(i % 251) for i in range(65536)])
+		self.server.requestIds = []
+		self.server.plainRequests = []
+		self.server.fetchIds = []
+		threading.Thread(target=self.server.serve_forever).start()
+		self.client = fusedaap.AdvancedDAAPClient()
+		self.client.pool = fusedaap.ConnectionPool('127.0.0.1',
+			self.server.server_address[1], 4)
+
+	def tearDown(self):
+		self.client.pool.close()
+		self.server.shutdown()
+		self.server.server_close()
+
+	def test_concurrentFetches(self):
+		"""Concurrent fetches should each get their own request id and the
+		right data, over no more connections than the pool allows."""
+		errors = []
+		def fetch(offset):
+			for i in range(5):
+				data = self.client.fetchRange('/databases/1/items/1.mp3',
+					{'session-id': 1}, offset, 1000)
+				if data != self.server.data[offset:offset+1000]:
+					errors.append(offset)
+		threads = [threading.Thread(target=fetch, args=(i * 1000,))
+			for i in range(8)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEqual([], errors)
+		ids = self.server.requestIds
+		self.assertEqual(40, len(ids))
+		self.assertEqual(40, len(dict.fromkeys(ids)))
+		self.assertEqual(40, self.client.request_id)
+		self.assert_(len(self.client.pool.idle) <= 4)
+
+	def test_requestIds(self):
+		"""Requests on the client's own connection should be sent by
+		daap.DAAPClient, with no id before the first fetch and after that
+		the last fetch's, which concurrent fetches should not change
+		between the header and the validation hash."""
+		hash_v3 = fusedaap.daap.hash_v3
+		fusedaap.daap.hash_v3 = lambda r, n, requestId: str(requestId)
+		try:
+			self.checkRequestIds()
+		finally:
+			fusedaap.daap.hash_v3 = hash_v3
+
+	def checkRequestIds(self):
+		self.client.socket = fusedaap.httplib.HTTPConnection('127.0.0.1',
+			self.server.server_address[1])
+		self.client.request('/logout', {'session-id': 1}, 0)
+		self.assertEqual([(None, '0')], self.server.plainRequests)
+		del self.server.requestIds[:], self.server.plainRequests[:]
+		del self.server.fetchIds[:]
+		def fetch():
+			for i in range(5):
+				self.client.fetchRange('/databases/1/items/1.mp3',
+					{'session-id': 1}, 0, 1000)
+		def request():
+			for i in range(5):
+				self.client.request('/logout', {'session-id': 1}, 0)
+		threads = [threading.Thread(target=target)
+			for target in (fetch, request) * 4]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEqual(40, len(self.server.requestIds))
+		self.assertEqual(20, self.client.request_id)
+		self.assertEqual(20, len(dict.fromkeys(self.server.fetchIds)))
+		self.assertEqual(20, len(self.server.plainRequests))
+		for requestId, validation in self.server.plainRequests:
+			if requestId is None:
+				self.assertEqual('0', validation)
+			else:
+				self.assertEqual(requestId, validation)
+		self.client.socket.close()
+
+
+def atom(code, data):
+	return code + struct.pack('!I', len(data)) + data
+
+def listing(count):
+	"""Returns an adbs listing of count tracks."""
+	items = ''.join([atom('mlit', atom('miid', struct.pack('!I', i + 1)) +
+		atom('minm', 'Track %d' % (i + 1))) for i in range(count)])
+	return atom('adbs', atom('mstt', struct.pack('!I', 200)) +
+		atom('mrco', struct.pack('!I', count)) + atom('mlcl', items))
+
+
+class TrickleFile(object):
+	"""A file that returns at most a few bytes per read, as a socket
+	might, and remembers how far it has been read."""
+	def __init__(self, data):
+		self.data = data
+		self.offset = 0
+
+	def read(self, length):
+		length = min(length, 7)
+		data = self.data[self.offset:self.offset+length]
+		self.offset += len(data)
+		return data
+
+
+class Test_iterListing(unittest.TestCase):
+	def test_items(self):
+		"""_iterListing should yield every mlit atom, reading only as far
+		as the item it yields."""
+		data = listing(3)
+		f = TrickleFile(data)
+		items = fusedaap._iterListing(f)
+		first = items.next()
+		self.assertEqual(atom('mlit', atom('miid', struct.pack('!I', 1)) +
+			atom('minm', 'Track 1')), first)
+		self.assert_(f.offset < len(data))
+		self.assertEqual(2, len(list(items)))
+		self.assertEqual(len(data), f.offset)
+
+	def test_truncated(self):
+		"""A listing that ends early should raise IOError."""
+		data = listing(3)[:-5]
+		self.assertRaises(IOError, list,
+			fusedaap._iterListing(TrickleFile(data)))
+
+	def test_notListing(self):
+		"""Anything but an adbs listing should raise IOError."""
+		self.assertRaises(IOError, list,
+			fusedaap._iterListing(TrickleFile(atom('mlog', ''))))
+
+
+class ListingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""Serves server.data in response to anything."""
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		self.server.paths.append(self.path)
+		data = self.server.data
+		self.send_response(200)
+		if getattr(self.server, 'gzip', False):
+			compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+			data = compressor.compress(data) + compressor.flush()
+			self.send_header('Content-Encoding', 'gzip')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+
+class FakeDatabase(object):
+	id = 1
+	class session(object):
+		sessionid = 5
+
+
+class Test_AdvancedDAAPClient_iterTracks(unittest.TestCase):
+	def setUp(self):
+		self.server = SocketServer.ThreadingTCPServer(('127.0.0.1', 0),
+			ListingHandler)
+		self.server.daemon_threads = True
+		self.server.data = listing(1201)
+		self.server.paths = []
+		threading.Thread(target=self.server.serve_forever).start()
+		self.client = fusedaap.AdvancedDAAPClient()
+		self.client.pool = fusedaap.ConnectionPool('127.0.0.1',
+			self.server.server_address[1], 4)
+
+	def tearDown(self):
+		self.client.pool.close()
+		self.server.shutdown()
+		self.server.server_close()
+
+	def test_chunks(self):
+		"""iterTracks should yield the tracks in chunks, in order, and give
+		the connection back to the pool."""
+		chunks = list(self.client.iterTracks(FakeDatabase(), 500))
+		self.assertEqual([500, 500, 201], [len(c) for c in chunks])
+		self.assertEqual(1, chunks[0][0].id)
+		self.assertEqual(u'Track 1201', chunks[2][-1].name)
+		self.assert_(self.server.paths[0].startswith('/databases/1/items?'))
+		self.assertEqual(0, self.client.pool.active)
+
+	def test_gzip(self):
+		"""A compressed listing should be read as it arrives."""
+		self.server.gzip = True
+		tracks = sum(self.client.iterTracks(FakeDatabase(), 500), [])
+		self.assertEqual(1201, len(tracks))
+		self.assertEqual(u'Track 600', tracks[599].name)
+		self.assertEqual(0, self.client.pool.active)
+
+	def test_field(self):
+		"""Track.field should ask the server for just that field of just
+		that track."""
+		self.server.data = atom('adbs', atom('mlcl', atom('mlit',
+			atom('miid', struct.pack('!I', 7)) + atom('asgn', 'Jazz'))))
+		database = FakeDatabase()
+		database.session = FakeDatabase.session()
+		database.session.connection = self.client
+		track = fusedaap.TrackTable(database).append({'miid': 7})
+		self.assertEqual(u'Jazz', track.field('daap.songgenre'))
+		self.assert_('meta=daap.songgenre' in self.server.paths[0])
+		self.assert_("query=%27dmap.itemid:7%27" in self.server.paths[0])
+
+
+class Test_TrackTable(unittest.TestCase):
+	def test_rows(self):
+		"""Tracks should read their fields back from the table, share
+		repeated values, and compare equal by row."""
+		table = fusedaap.TrackTable(FakeDatabase())
+		first = table.append({'miid': 3, 'minm': u'Caf\xe9', 'asar': u'A',
+			'asal': u'B', 'asfm': u'mp3', 'assz': 5000000000, 'astn': 2})
+		second = table.append({'miid': 4, 'asar': u'A', 'asfm': u'mp3'})
+		self.assertEqual((3, u'Caf\xe9', u'A', u'B', u'mp3', 5000000000, 2),
+			(first.id, first.name, first.artist, first.album, first.type,
+			first.size, first.trackNumber))
+		self.assertEqual((4, None, u'A', None, 0, None), (second.id,
+			second.name, second.artist, second.album, second.size,
+			second.trackNumber))
+		self.assertEqual([u'A', u'B', u'mp3', None], table.values)
+		self.assertEqual(2, len(table))
+		self.assertEqual(first, fusedaap.Track(table, 0))
+		self.assertEqual(hash(first), hash(fusedaap.Track(table, 0)))
+		self.assertNotEqual(first, second)
+		self.assertNotEqual(first,
+			fusedaap.Track(fusedaap.TrackTable(FakeDatabase()), 0))
+
+
+class Test_NameTable(unittest.TestCase):
+	def test_intern(self):
+		"""Equal strings should intern to one object of their own type,
+		and the duplicates be counted."""
+		names = fusedaap.NameTable()
+		first = u''.join([u'Art', u'ist'])
+		second = u''.join([u'Arti', u'st'])
+		self.assert_(names.intern(first) is first)
+		self.assert_(names.intern(second) is first)
+		self.assertEqual(str, type(names.intern('Artist')))
+		self.assertEqual(None, names.intern(None))
+		stats = names.stats.snapshot()
+		self.assertEqual(2, stats['intern.strings'])
+		self.assertEqual(1, stats['intern.hits'])
+		self.assertEqual(sys.getsizeof(second), stats['intern.bytesSaved'])
+
+	def test_clean(self):
+		"""Cleaned names should be computed once and interned."""
+		names = fusedaap.NameTable()
+		cleaned = names.clean(u'AC/DC: Live')
+		self.assertEqual('AC_DC__Live', cleaned)
+		self.assert_(names.clean(u'AC/DC: Live') is cleaned)
+		self.assert_(names.clean(u'AC:DC/ Live') is cleaned)
+		self.assertEqual('none', names.clean(None))
+		stats = names.stats.snapshot()
+		self.assertEqual(3, stats['intern.cleaned'])
+		self.assertEqual(1, stats['intern.cleanHits'])
+
+	def test_directories(self):
+		"""Directories made for different tracks should share their name
+		objects, as names and as keys."""
+		manager = fusedaap.LocalDirManager(fusedaap.DirInode('hosts'))
+		first = manager.mkDir('/host/%s/%s' % ('Art', 'Album'))
+		second = manager.mkDir('/%s/%s/%s' % ('host', 'Art', 'Album 2'))
+		artist = manager.fetchInode('/host/Art')
+		self.assert_(first.name is fusedaap.nameTable.intern(''.join(['Al', 'bum'])))
+		for name, inode in artist.children.items():
+			self.assert_(name is inode.name)
+			self.assert_(name is fusedaap.nameTable.intern(name))
+
+
+class Test_decodeItem(unittest.TestCase):
+	def test_fields(self):
+		"""_decodeItem should decode the known fields by type and skip
+		the rest."""
+		item = atom('mlit', atom('miid', struct.pack('!I', 3)) +
+			atom('astn', struct.pack('!H', 12)) +
+			atom('xxxx', 'unknown') +
+			atom('asar', u'Bj\xf6rk'.encode('utf-8')) +
+			atom('assz', struct.pack('!I', 4000000)))
+		self.assertEqual({'miid': 3, 'astn': 12, 'asar': u'Bj\xf6rk',
+			'assz': 4000000}, fusedaap._decodeItem(item))
+
+	def test_gzipReader(self):
+		"""_GzipReader should return exactly what is asked for, across
+		the compressed reads."""
+		data = listing(300)
+		compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+		reader = fusedaap._GzipReader(TrickleFile(compressor.compress(data) +
+			compressor.flush()))
+		self.assertEqual(data[:8], reader.read(8))
+		self.assertEqual(data[8:5000], reader.read(4992))
+		self.assertEqual(data[5000:], reader.read(len(data)))
+		self.assertEqual('', reader.read(8))
+
+
+class Test_ConnectionPool(unittest.TestCase):
+	def test_limit(self):
+		"""ConnectionPool.get should wait while maxConnections are in use,
+		and reuse connections given back."""
+		pool = fusedaap.ConnectionPool('127.0.0.1', 3689, 1)
+		first = pool.get()
+		got = []
+		t = threading.Thread(target=lambda: got.append(pool.get()))
+		t.start()
+		time.sleep(0.1)
+		self.assertEqual([], got)
+		pool.put(first)
+		t.join(1)
+		self.assertEqual([first], got)
+
+	def test_priority(self):
+		"""Waiting transfers should get connections by class, then in
+		order, and their waits should be recorded by class."""
+		pool = fusedaap.ConnectionPool('127.0.0.1', 3689, 1)
+		first = pool.get()
+		order = []
+		def get(priority):
+			pool.put(pool.get(priority))
+			order.append(priority)
+		threads = []
+		for priority in (fusedaap.BULK, fusedaap.PREFETCH, fusedaap.BULK,
+			fusedaap.INTERACTIVE):
+			t = threading.Thread(target=get, args=(priority,))
+			t.start()
+			threads.append(t)
+			time.sleep(0.05)
+		pool.put(first)
+		for t in threads:
+			t.join()
+		self.assertEqual([fusedaap.INTERACTIVE, fusedaap.PREFETCH,
+			fusedaap.BULK, fusedaap.BULK], order)
+		stats = pool.stats.snapshot()
+		self.assertEqual(2, stats['queue.interactive.ms']['count'])
+		self.assertEqual(2, stats['queue.bulk.ms']['count'])
+
+	def test_reservedForInteractive(self):
+		"""The last free connection should be kept for INTERACTIVE
+		transfers."""
+		pool = fusedaap.ConnectionPool('127.0.0.1', 3689, 2)
+		pool.get(fusedaap.BULK)
+		got = []
+		def get():
+			try:
+				got.append(pool.get(fusedaap.BULK))
+			except IOError:
+				got.append(None)
+		t = threading.Thread(target=get)
+		t.start()
+		time.sleep(0.1)
+		self.assertEqual([], got)
+		pool.get(fusedaap.INTERACTIVE)
+		pool.close()
+		t.join(1)
+		self.assertEqual([None], got)
+
+	def test_bandwidth(self):
+		"""Transfers should be delayed to average the pool's bandwidth."""
+		pool = fusedaap.ConnectionPool('127.0.0.1', 3689, 1, bandwidth=400000)
+		start = time.time()
+		for i in range(5):
+			pool.put(pool.get(length=100000))
+		elapsed = time.time() - start
+		self.assert_(0.6 < elapsed < 1.2, elapsed)
+		self.assertEqual(3, pool.stats.snapshot()['throttle.ms']['count'])
+
+	def test_closeWhileThrottled(self):
+		"""Closing the pool should end a wait for bandwidth."""
+		pool = fusedaap.ConnectionPool('127.0.0.1', 3689, 2, bandwidth=1000)
+		pool.put(pool.get(length=100000)) # 100 s of debt
+		threading.Timer(0.1, pool.close).start()
+		start = time.time()
+		self.assertRaises(IOError, pool.get)
+		self.assert_(time.time() - start < 1)
+		self.assertEqual(0, pool.active)
+
+	def test_closed(self):
+		"""ConnectionPool.get should fail once the pool is closed."""
+		pool = fusedaap.ConnectionPool('127.0.0.1', 3689, 1)
+		pool.close()
+		self.assertRaises(IOError, pool.get)
 
 
 if __name__ == "__main__":